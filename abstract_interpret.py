@@ -1,4 +1,7 @@
-from ir import Block, Operation, Constant, Value
+from typing import Optional
+
+from ir import Block, Operation, Constant, Value, OpTable, bit_width, wrap_int
+from knownbits import KnownBits
 
 
 class Parity: 
@@ -32,6 +35,8 @@ class Parity:
         else:
             return ODD
 
+    sub = add   # a - b has the parity of a + b
+
     def lshift(self, other):
         if other is ODD:
             return EVEN
@@ -49,7 +54,7 @@ ODD = Parity("ODD")
 
 def _analyze_parity(bb: Block):
     """Derive all parity information from the basic block."""
-    parity = {v: BOTTOM for v in bb}
+    parity: OpTable[Parity] = OpTable(bb, BOTTOM)
     parity_of = lambda value: Parity.const(value) if isinstance(value, Constant) \
         else parity[value]
 
@@ -63,7 +68,7 @@ def _analyze_parity(bb: Block):
 
 def simplify(bb: Block) -> Block:
     """Simplify by removing redundant odd/even check"""
-    parity = {v: BOTTOM for v in bb}
+    parity: OpTable[Parity] = OpTable(bb, BOTTOM)
     parity_of = lambda value: Parity.const(value) if isinstance(value, Constant) \
         else parity[value]
     get_transfer = lambda op: getattr(Parity, op.name)(*(parity_of(arg.find()) for arg in op.args))
@@ -88,3 +93,73 @@ def simplify(bb: Block) -> Block:
                 parity[op] = get_transfer(op)
 
     return opt_bb
+
+
+_ARITHMETIC_OPS = {"add", "sub", "mul", "lshift", "bitand"}
+
+
+def _known_bits(op: Operation, args: list[KnownBits]) -> KnownBits:
+    """Transfer functions of the known bits analysis, for the current
+    bit width"""
+    width = bit_width()
+    result = _unbounded_known_bits(op, args, width)
+    if width is not None and op.name in _ARITHMETIC_OPS:
+        return result.wrapped(width)
+    return result
+
+
+def _unbounded_known_bits(op: Operation, args: list[KnownBits],
+                          width: Optional[int]) -> KnownBits:
+    match op.name:
+        case "add":
+            return args[0] + args[1]
+        case "sub":
+            return args[0] - args[1]
+        case "bitand":
+            return args[0] & args[1]
+        case "lshift":
+            shift = args[1]
+            if shift.is_constant() and shift.ones >= 0:
+                # everything is shifted out from `width` on
+                amount = shift.ones if width is None else min(shift.ones, width)
+                return args[0] << amount
+        case "mul":
+            if args[0].is_constant() and args[1].is_constant():
+                return KnownBits.from_constant(args[0].ones * args[1].ones)
+    return KnownBits.all_unknown()
+
+
+def simplify_masks(bb: Block) -> Block:
+    """Remove the bitands the known bits of their operands make
+    redundant: bitand(x, 7) is x when x is known to be in range(8), the
+    modulo of a non-negative x by 8, and 0 when x is a multiple of 8.
+    Other ops whose known bits are all known become constants."""
+    known: OpTable[KnownBits] = OpTable(bb, KnownBits.all_unknown())
+
+    def known_of(value: Value) -> KnownBits:
+        if isinstance(value, Constant):
+            if type(value.value) is int:
+                return KnownBits.from_constant(wrap_int(value.value))
+            return KnownBits.all_unknown()
+        bits = known.get(value) if isinstance(value, Operation) else None
+        return KnownBits.all_unknown() if bits is None else bits
+
+    opt_bb = Block()
+    for op in bb:
+        args = [op.arg(i) for i in range(len(op.args))]
+        bits = [known_of(arg) for arg in args]
+        if op.name == "bitand":
+            # every bit of x that may be 1 is known to be 1 in the mask
+            if bits[0].may_be_ones() & ~bits[1].ones == 0:
+                op.make_equal_to(args[0])
+                continue
+            if bits[1].may_be_ones() & ~bits[0].ones == 0:
+                op.make_equal_to(args[1])
+                continue
+        result = _known_bits(op, bits)
+        if result.is_constant() and op.name in _ARITHMETIC_OPS:
+            op.make_equal_to(Constant(result.ones))
+            continue
+        opt_bb.append(op)
+        known[op] = result
+    return opt_bb
@@ -0,0 +1,179 @@
+from typing import Any
+
+import numpy as np
+
+from ir import Block, bit_width, wrap_int
+from interpret import frame_program
+
+
+# largest magnitude that int64 arithmetic handles exactly
+_INT64_BOUND = 2**63 - 1
+_ARITHMETIC_OPS = frozenset(["add", "sub", "mul", "lshift", "bitand"])
+
+
+class BatchObj:
+    """Columnar runtime representation of an `alloc` over a whole
+    batch: one column of values per field, shared by all the rows."""
+
+    def __init__(self):
+        self.content: dict[int, tuple[Any, int]] = {}
+
+    def store(self, idx: int, value: Any, bound: int):
+        self.content[idx] = (value, bound)
+
+    def load(self, idx: int) -> tuple[Any, int]:
+        return self.content[idx]
+
+
+def _wrap_column(value: Any, width: int) -> Any:
+    """value wrapped to `width` bits, arrays as int64"""
+    if not isinstance(value, np.ndarray):
+        return wrap_int(value)
+    if value.dtype == object:
+        return np.array([wrap_int(int(v)) for v in value.flat],
+                        dtype=np.int64).reshape(value.shape)
+    # int64 arithmetic wraps modulo 2**64, a multiple of 2**width
+    value = value.astype(np.int64, copy=False)
+    if width == 64:
+        return value
+    sign = 1 << (width - 1)
+    return ((value + sign) & ((1 << width) - 1)) - sign
+
+
+def _as_column(value: Any) -> tuple[Any, int]:
+    """Turn an input into an array plus a bound on its magnitude.
+    Columns are int64 when every value fits, object (Python ints)
+    otherwise."""
+    column = np.asarray(value)
+    if column.size == 0:
+        return column.astype(np.int64), 0
+    if column.dtype != object and not np.issubdtype(column.dtype, np.integer):
+        raise TypeError(f"batch arguments must be integers, not {column.dtype}")
+    width = bit_width()
+    if width is not None:
+        column = _wrap_column(column, width)
+    if column.dtype == object:
+        bound = max(abs(int(v)) for v in column.flat)
+    else:
+        bound = max(abs(int(column.min())), abs(int(column.max())))
+    if bound <= _INT64_BOUND:
+        return column.astype(np.int64), bound
+    return column.astype(object), bound
+
+
+def _exact(x: Any, y: Any, bound: int) -> tuple[Any, Any]:
+    """Make the operands safe for an op whose result is within
+    `bound`: keep int64 when it can't overflow, else use Python ints.
+    With a bit width, int64 overflow is fine: the result is wrapped
+    anyway."""
+    if bound <= _INT64_BOUND or bit_width() is not None:
+        return x, y
+    if isinstance(x, np.ndarray):
+        x = x.astype(object)
+    if isinstance(y, np.ndarray):
+        y = y.astype(object)
+    return x, y
+
+
+def _lshift(x: Any, shift: Any, width: int) -> Any:
+    """x << shift wrapped to width bits. Shifts of 64 or more aren't
+    defined for int64, shifting by at most width - 1 and then by one
+    more for the rest gives the same low bits."""
+    if isinstance(shift, np.ndarray):
+        return (x << np.minimum(shift, width - 1)) << (shift >= width)
+    return (x << min(shift, width - 1)) << int(shift >= width)
+
+
+def _max_shift(shift: Any) -> int:
+    if isinstance(shift, np.ndarray):
+        if shift.size == 0:
+            return 0
+        low, high = int(shift.min()), int(shift.max())
+    else:
+        low = high = shift
+    if low < 0:
+        raise ValueError("negative shift count")
+    return high
+
+
+def interpret_batch(bb: Block, *arg_arrays) -> Any:
+    """Run bb once over whole batches of arguments.
+
+    Every argument is an array (or a scalar, broadcast to the batch);
+    each op is evaluated element-wise with NumPy, so one walk over the
+    ops computes the results of all the rows. The result is the
+    column `interpret(bb, *row)` would return row by row, with exactly
+    the same values: int64 is used as long as the magnitudes tracked
+    for every value prove it can't overflow, Python ints otherwise.
+    With a bit width set, every value is int64 and wrapped after each
+    op.
+    Objects are represented by a `BatchObj` holding one column per
+    field.
+    """
+    columns = [_as_column(arg) for arg in arg_arrays]
+    shape = np.broadcast_shapes(*(column.shape for column, _ in columns))
+
+    program = frame_program(bb)
+    regs = program.new_frame()
+    width = bit_width()
+    # bounds[reg] >= abs(every value in regs[reg]), for integer values
+    bounds: list[int] = [0] * len(program.code) + [
+        abs(c) if isinstance(c, int) else 0 for c in program.constants
+    ]
+    for pos, (name, a) in enumerate(program.code):
+        match name:
+            case "getarg":
+                regs[pos], bounds[pos] = columns[regs[a[0]]]
+            case "alloc":
+                regs[pos] = BatchObj()
+            case "load":
+                obj = regs[a[0]]
+                if not isinstance(obj, BatchObj):
+                    raise TypeError("can only load from objects allocated in the block")
+                regs[pos], bounds[pos] = obj.load(regs[a[1]])
+            case "store":
+                obj = regs[a[0]]
+                if not isinstance(obj, BatchObj):
+                    raise TypeError("can only store to objects allocated in the block")
+                obj.store(regs[a[1]], regs[a[2]], bounds[a[2]])
+            case "print":
+                res = regs[a[0]]
+                if not isinstance(res, (np.ndarray, BatchObj)):
+                    # only depends on constants, same value in every row
+                    res = np.full(shape, res, dtype=np.asarray(res).dtype)
+                print(res)
+                return res
+            case "add":
+                bound = bounds[a[0]] + bounds[a[1]]
+                x, y = _exact(regs[a[0]], regs[a[1]], bound)
+                regs[pos], bounds[pos] = x + y, bound
+            case "sub":
+                bound = bounds[a[0]] + bounds[a[1]]
+                x, y = _exact(regs[a[0]], regs[a[1]], bound)
+                regs[pos], bounds[pos] = x - y, bound
+            case "mul":
+                bound = bounds[a[0]] * bounds[a[1]]
+                x, y = _exact(regs[a[0]], regs[a[1]], bound)
+                regs[pos], bounds[pos] = x * y, bound
+            case "lshift":
+                shift = _max_shift(regs[a[1]])
+                if width is not None:
+                    bound = bounds[a[0]] << min(shift, width)
+                    regs[pos] = _lshift(regs[a[0]], regs[a[1]], width)
+                    bounds[pos] = bound
+                else:
+                    bound = bounds[a[0]] << shift
+                    x, y = _exact(regs[a[0]], regs[a[1]], bound)
+                    regs[pos], bounds[pos] = x << y, bound
+            case "bitand":
+                # both fit in n-bit two's complement, so does the result
+                bound = 1 << max(bounds[a[0]], bounds[a[1]]).bit_length()
+                x, y = _exact(regs[a[0]], regs[a[1]], bound)
+                regs[pos], bounds[pos] = x & y, bound
+            case "escape":
+                pass    # do nothing
+            case _:
+                raise NotImplementedError(f"Operation {name} not implemented")
+        if width is not None and name in _ARITHMETIC_OPS:
+            regs[pos] = _wrap_column(regs[pos], width)
+            bounds[pos] = min(bounds[pos], 1 << (width - 1))
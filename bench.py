@@ -0,0 +1,670 @@
+"""Benchmarks for the toy optimizer.
+
+Run all of them with `python bench.py`, or a selection with
+`python bench.py <name> [<name> ...]`.
+"""
+import contextlib
+import gc
+import os
+import pickle
+import io
+import sys
+import tempfile
+import time
+import tracemalloc
+from typing import Callable
+
+from ir import Block, bb_to_str, read_blocks, union_find_stats, bit_width_mode
+from compact_block import CompactBlock
+from interpret import Obj, interpret, interpret_compiled, compile_block, execute
+from passes import constfold, cse, strength_reduce
+from passes import alloc_removal, optimize_load_store, fused_optimize
+from passes import dce, compact, compact_stream
+from passes import MACHINE_COSTS
+from passes import stream, constfold_stream, cse_stream, strength_reduce_stream
+from passes import alloc_removal_stream, optimize_load_store_stream
+from rewrite import RuleSet, peephole, ALGEBRAIC_RULES, STRENGTH_REDUCTION_RULES
+
+
+BENCHMARKS: dict[str, Callable[[], None]] = {}
+
+
+def benchmark(func):
+    BENCHMARKS[func.__name__] = func
+    return func
+
+
+def best_time(func, *args, repeat: int = 3) -> float:
+    """Best wall time of `repeat` runs, in seconds"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func(*args)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+def allocated(func, *args):
+    """Return (result, bytes still allocated by func when it returns)"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        res = func(*args)
+        after = tracemalloc.get_traced_memory()[0]
+    finally:
+        tracemalloc.stop()
+    return res, after - before
+
+
+def quiet(func, *args):
+    """Call func, swallowing what `print` ops write to stdout"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        return func(*args)
+
+
+def synthetic_trace(bb, n: int):
+    """Fill `bb` with roughly `n` ops of a trace that looks like a
+    loop body: arithmetic with redundant subexpressions and a
+    short-lived allocation per iteration. Returns bb."""
+    a = bb.getarg(0)
+    b = bb.getarg(1)
+    acc = a
+    while len(bb) < n:
+        t = bb.add(acc, b)
+        u = bb.mul(b, 3)
+        v = bb.add(acc, b)
+        obj = bb.alloc()
+        bb.store(obj, 0, u)
+        w = bb.load(obj, 0)
+        acc = bb.add(w, v)
+        acc = bb.add(acc, t)
+    bb.print(acc)
+    return bb
+
+
+def report(title: str, rows: list[tuple], header: tuple):
+    print(f"\n{title}")
+    print("  " + "".join(f"{h:>20}" for h in header))
+    for row in rows:
+        cells = []
+        for cell in row:
+            if isinstance(cell, float):
+                cells.append(f"{cell:>20.4f}")
+            else:
+                cells.append(f"{cell:>20}")
+        print("  " + "".join(cells))
+
+
+@benchmark
+def compact_block():
+    """Memory and time of list-of-objects Block vs CompactBlock"""
+    rows = []
+    for n in (10_000, 100_000):
+        for cls in (Block, CompactBlock):
+            bb, size = allocated(synthetic_trace, cls(), n)
+            build = best_time(lambda: synthetic_trace(cls(), n))
+            run = best_time(quiet, interpret, bb, 1, 2)
+            to_str = best_time(bb_to_str, bb)
+            rows.append((n, cls.__name__, size // 1024, build, run, to_str))
+    report("Block vs CompactBlock", rows,
+           ("ops", "backend", "KiB", "build s", "interpret s", "bb_to_str s"))
+
+
+@benchmark
+def union_find():
+    """find() chain lengths per pass over a long trace"""
+    bb = synthetic_trace(Block(), 100_000)
+    rows = []
+    for opt in (constfold, cse, strength_reduce, alloc_removal,
+                optimize_load_store):
+        with union_find_stats() as stats:
+            start = time.perf_counter()
+            bb = quiet(opt, bb)
+            elapsed = time.perf_counter() - start
+        rows.append((opt.__name__, stats.finds, stats.unions,
+                     stats.average_length, stats.max_length, elapsed))
+    report("find() per pass (100k ops)", rows,
+           ("pass", "finds", "unions", "avg chain", "max chain", "s"))
+
+
+@benchmark
+def cse_scaling():
+    """cse() time per op should stay flat as the trace grows"""
+    rows = []
+    for n in (10_000, 100_000, 1_000_000):
+        bb = synthetic_trace(Block(), n)
+        start = time.perf_counter()
+        opt_bb = cse(bb)
+        elapsed = time.perf_counter() - start
+        rows.append((n, len(opt_bb), elapsed, elapsed / n * 1e6))
+    report("cse scaling", rows, ("ops in", "ops out", "s", "us/op"))
+
+
+def store_heavy_trace(n_objects: int, n_offsets: int, rounds: int) -> Block:
+    """Loads from every (object, offset) pair, then rounds of stores,
+    so the compile-time heap holds thousands of live entries"""
+    bb = Block()
+    objs = [bb.getarg(i) for i in range(n_objects)]
+    for _ in range(rounds):
+        for offset in range(n_offsets):
+            for obj in objs:
+                bb.load(obj, offset)
+            bb.store(objs[offset % n_objects], offset, offset)
+    return bb
+
+
+@benchmark
+def load_store_scaling():
+    """optimize_load_store time per op with many live heap entries"""
+    rows = []
+    for n_objects in (100, 1_000, 10_000):
+        bb = store_heavy_trace(n_objects, 10, 3)
+        start = time.perf_counter()
+        opt_bb = optimize_load_store(bb)
+        elapsed = time.perf_counter() - start
+        rows.append((n_objects * 10, len(bb), len(opt_bb), elapsed,
+                     elapsed / len(bb) * 1e6))
+    report("optimize_load_store scaling", rows,
+           ("live pairs", "ops in", "ops out", "s", "us/op"))
+
+
+def main_example() -> Block:
+    """The example of interpret.py's __main__"""
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, var0)
+    var1 = bb.load(obj, 0)
+    bb.print(var1)
+    return bb
+
+
+def calls(func, bb, times: int):
+    for i in range(times):
+        func(bb, i, 2)
+
+
+@benchmark
+def compiled_interpreter():
+    """interpret vs the cached compiled form of a block"""
+    rows = []
+    bb = main_example()
+    for func in (interpret, execute, interpret_compiled):
+        elapsed = best_time(quiet, calls, func, bb, 100_000)
+        rows.append(("example x 1e5", func.__name__, elapsed))
+    for n in (1_000, 100_000):
+        bb = synthetic_trace(Block(), n)
+        # a fresh copy of the block has nothing cached yet
+        compile_time = best_time(compile_block, Block(bb), repeat=1)
+        rows.append((f"{n} ops", "compile_block", compile_time))
+        for func in (interpret, execute, interpret_compiled):
+            elapsed = best_time(quiet, calls, func, bb, 10)
+            rows.append((f"{n} ops x 10", func.__name__, elapsed))
+    report("compiled interpreter", rows, ("workload", "runner", "s"))
+
+
+@benchmark
+def batch_interpret():
+    """interpret_batch throughput vs a loop of scalar calls"""
+    import numpy as np
+    from batch_interpret import interpret_batch
+
+    bb = synthetic_trace(Block(), 200)
+    rows = []
+    for n in (1_000, 100_000):
+        xs, ys = np.arange(n), np.arange(n) % 17
+        xs_list, ys_list = xs.tolist(), ys.tolist()
+        scalar = best_time(quiet, lambda: [execute(bb, x, y)
+                                           for x, y in zip(xs_list, ys_list)],
+                           repeat=1)
+        batch = best_time(quiet, interpret_batch, bb, xs, ys)
+        rows.append((n, "execute loop", scalar, n / scalar))
+        rows.append((n, "interpret_batch", batch, n / batch))
+    report("batched interpretation (200 op block)", rows,
+           ("rows", "runner", "s", "rows/s"))
+
+
+@benchmark
+def bytecode_vm():
+    """Register bytecode VM vs the other execution paths"""
+    from bytecode import lower
+
+    rows = []
+    for n in (1_000, 100_000):
+        bb = synthetic_trace(Block(), n)
+        lower_time = best_time(lower, bb, repeat=1)
+        program = lower(bb)
+        rows.append((f"{n} ops", "lower", lower_time, program.nregs))
+        for name, func in (("interpret", interpret), ("execute", execute),
+                           ("interpret_compiled", interpret_compiled),
+                           ("Program.run", lambda bb, *args: program.run(*args))):
+            elapsed = best_time(quiet, calls, func, bb, 10)
+            rows.append((f"{n} ops x 10", name, elapsed, ""))
+    report("bytecode VM", rows, ("workload", "runner", "s", "registers"))
+
+
+def sequential_pipeline(bb: Block) -> Block:
+    for opt in (constfold, cse, strength_reduce, alloc_removal,
+                optimize_load_store):
+        bb = opt(bb)
+    return bb
+
+
+def peak_allocated(func, *args):
+    """Return (result, peak bytes allocated while func ran)"""
+    tracemalloc.start()
+    try:
+        res = func(*args)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return res, peak
+
+
+@benchmark
+def fused():
+    """Sequential pipeline vs fused_optimize: latency, memory, quality"""
+    rows = []
+    for n in (10_000, 100_000):
+        for opt in (sequential_pipeline, fused_optimize):
+            # a fresh trace every run, the passes consume their input
+            elapsed = best_time(
+                lambda: quiet(opt, synthetic_trace(Block(), n)), repeat=5)
+            elapsed -= best_time(lambda: synthetic_trace(Block(), n), repeat=5)
+            opt_bb, peak = peak_allocated(quiet, opt, synthetic_trace(Block(), n))
+            rows.append((n, opt.__name__, len(opt_bb), elapsed, peak // 1024))
+    report("fused optimizer", rows, ("ops", "optimizer", "ops out", "s", "peak KiB"))
+
+
+def trace_with_dead_code(n: int) -> Block:
+    """synthetic_trace plus what recorded traces tend to carry
+    around: values only written to a frame object that never escapes,
+    and reads whose result is never used"""
+    bb = Block()
+    a = bb.getarg(0)
+    b = bb.getarg(1)
+    frame = bb.alloc()
+    acc = a
+    while len(bb) < n:
+        t = bb.add(acc, b)
+        bb.store(frame, 0, t)           # frame is never read
+        bb.store(frame, 1, bb.mul(t, 3))
+        bb.load(frame, 0)               # unused
+        obj = bb.alloc()
+        bb.store(obj, 0, t)
+        acc = bb.add(bb.load(obj, 0), b)
+    bb.print(acc)
+    return bb
+
+
+@benchmark
+def dead_code():
+    """How much dce removes on top of the pipeline"""
+    rows = []
+    for name, build in (("synthetic", lambda n: synthetic_trace(Block(), n)),
+                        ("dead code", trace_with_dead_code)):
+        bb = build(100_000)
+        ops_in = len(bb)
+        opt_bb = quiet(sequential_pipeline, bb)
+        start = time.perf_counter()
+        dce_bb = dce(opt_bb)
+        elapsed = time.perf_counter() - start
+        run_before = best_time(quiet, calls, execute, opt_bb, 10)
+        run_after = best_time(quiet, calls, execute, dce_bb, 10)
+        rows.append((name, ops_in, len(opt_bb), len(dce_bb), elapsed,
+                     run_before, run_after))
+    report("dce after the pipeline (100k ops)", rows,
+           ("trace", "ops in", "pipeline", "+ dce", "dce s",
+            "exec before s", "exec after s"))
+
+
+def parity_trace(n: int) -> Block:
+    """A trace only using the ops the parity analysis knows about"""
+    bb = Block()
+    a = bb.getarg(0)
+    b = bb.getarg(1)
+    acc = a
+    while len(bb) < n:
+        acc = bb.add(bb.lshift(acc, 1), b)
+        acc = bb.dummy(acc)
+    return bb
+
+
+@benchmark
+def side_tables():
+    """Parity analysis and printing on large blocks"""
+    from abstract_interpret import _analyze_parity
+
+    rows = []
+    for n in (100_000, 1_000_000):
+        bb = parity_trace(n)
+        rows.append((n, "_analyze_parity", best_time(_analyze_parity, bb)))
+        rows.append((n, "bb_to_str", best_time(bb_to_str, bb)))
+    report("analyses over ops", rows, ("ops", "analysis", "s"))
+
+
+def optimized_trace(n: int, compacted: bool) -> Block:
+    """Only the optimized block survives, plus whatever it reaches"""
+    opt_bb = quiet(sequential_pipeline, synthetic_trace(Block(), n))
+    if compacted:
+        compact(opt_bb)
+    gc.collect()
+    return opt_bb
+
+
+@benchmark
+def compaction():
+    """Memory the optimized block keeps alive with and without compact"""
+    rows = []
+    for n in (10_000, 100_000):
+        kept, retained = allocated(optimized_trace, n, False)
+        _, compacted = allocated(optimized_trace, n, True)
+        elapsed = best_time(compact, Block(kept), repeat=1)
+        rows.append((n, len(kept), retained // 1024, compacted // 1024,
+                     (retained - compacted) // 1024, elapsed))
+    report("compact after the pipeline", rows,
+           ("ops in", "ops out", "retained KiB", "compacted KiB",
+            "reclaimed KiB", "compact s"))
+
+
+def constant_heavy_trace(n: int) -> Block:
+    """Arithmetic and stores whose operands are mostly small
+    constants, and repeated stores of the same constant"""
+    bb = Block()
+    a = bb.getarg(0)
+    obj = bb.getarg(1)
+    i = 0
+    while len(bb) < n:
+        t = bb.add(a, i % 64)
+        bb.mul(t, 3)
+        bb.mul(t, 3)
+        bb.store(obj, i % 8, 1000 + i % 4)
+        bb.store(obj, i % 8, 1000 + i % 4)
+        bb.lshift(bb.add(a, i % 64), 2)
+        i += 1
+    return bb
+
+
+@benchmark
+def constants():
+    """Memory and cse/load-store time on constant-heavy blocks"""
+    rows = []
+    for n in (10_000, 100_000):
+        bb, size = allocated(constant_heavy_trace, n)
+        cse_time = best_time(lambda: cse(constant_heavy_trace(n)), repeat=1)
+        cse_time -= best_time(constant_heavy_trace, n, repeat=1)
+        load_store = best_time(optimize_load_store, bb)
+        rows.append((n, size // 1024, cse_time, load_store,
+                     len(optimize_load_store(bb))))
+    report("constant-heavy blocks", rows,
+           ("ops", "KiB", "cse s", "load/store s", "load/store out"))
+
+
+@benchmark
+def parse():
+    """read_blocks throughput on a trace file"""
+    rows = []
+    for n_blocks, n in ((1_000, 100), (10, 10_000)):
+        with tempfile.TemporaryFile("w+") as f:
+            for i in range(n_blocks):
+                f.write(bb_to_str(synthetic_trace(Block(), n)) + "\n\n")
+            size = f.tell()
+
+            def read_all():
+                f.seek(0)
+                return sum(len(bb) for bb in read_blocks(f))
+
+            ops = read_all()
+            elapsed = best_time(read_all)
+        rows.append((n_blocks, ops, size // 1024, elapsed,
+                     size / elapsed / 2**20, ops / elapsed))
+    report("parsing trace files", rows,
+           ("blocks", "ops", "KiB", "s", "MiB/s", "ops/s"))
+
+
+def touch_all(bb) -> int:
+    """Decode every op and argument of bb"""
+    return sum(len(op.args) for op in bb)
+
+
+@benchmark
+def serialization():
+    """serialize vs pickle: size, encode, open and full decode time"""
+    import serialize
+
+    rows = []
+    for n in (10_000, 100_000):
+        bb = synthetic_trace(Block(), n)
+        for name, dumps, loads in (("pickle", pickle.dumps, pickle.loads),
+                                   ("serialize", serialize.dumps, serialize.loads)):
+            data = dumps(bb)
+            rows.append((n, name, len(data) // 1024, best_time(dumps, bb),
+                         best_time(loads, data),
+                         best_time(lambda: touch_all(loads(data)))))
+    report("serialization", rows,
+           ("ops", "format", "KiB", "encode s", "open s", "open+decode s"))
+
+
+def trace_shape(shape: int, n: int) -> Block:
+    """synthetic_trace with a store of `shape` in front, so there are
+    as many different blocks as shapes"""
+    bb = Block()
+    bb.store(bb.getarg(2), 0, shape)
+    return synthetic_trace(bb, n)
+
+
+@benchmark
+def optimization_cache():
+    """Repeated trace shapes with and without OptimizationCache"""
+    from optcache import OptimizationCache
+
+    workload = [(shape, 1_000) for _ in range(10) for shape in range(50)]
+    cache = OptimizationCache(sequential_pipeline, maxsize=64)
+    rows = []
+    for name, opt in (("uncached", sequential_pipeline), ("cached", cache)):
+        start = time.perf_counter()
+        for shape, n in workload:
+            quiet(opt, trace_shape(shape, n))
+        rows.append((name, len(workload), time.perf_counter() - start))
+    stats = cache.stats
+    report("optimization cache (50 shapes x 10, 1000 ops)", rows,
+           ("pipeline", "blocks", "s"))
+    report("cache statistics", [(stats.hit_rate, stats.average_hit_latency * 1e3,
+                                 stats.average_miss_latency * 1e3)],
+           ("hit rate", "hit ms", "miss ms"))
+
+
+@benchmark
+def parallel_scaling():
+    """optimize_many over 1..N worker processes"""
+    from parallel import optimize_many
+
+    counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    rows = []
+    for workers in counts:
+        # fresh blocks, workers=1 optimizes them in place
+        blocks = [synthetic_trace(Block(), 2_000) for _ in range(200)]
+        start = time.perf_counter()
+        optimize_many(blocks, sequential_pipeline, workers=workers)
+        elapsed = time.perf_counter() - start
+        rows.append((workers, len(blocks), elapsed, len(blocks) / elapsed))
+    report(f"parallel optimization ({os.cpu_count()} CPUs, 2000 ops per block)",
+           rows, ("workers", "blocks", "s", "blocks/s"))
+
+
+def recorded_trace(n: int):
+    """The ops of synthetic_trace, yielded while they are recorded
+    instead of being kept in a Block"""
+    bb = Block()
+    a = bb.getarg(0)
+    b = bb.getarg(1)
+    acc = a
+    recorded = 0
+    while recorded < n:
+        t = bb.add(acc, b)
+        u = bb.mul(b, 3)
+        v = bb.add(acc, b)
+        obj = bb.alloc()
+        bb.store(obj, 0, u)
+        w = bb.load(obj, 0)
+        acc = bb.add(w, v)
+        acc = bb.add(acc, t)
+        recorded += len(bb)
+        yield from bb
+        bb.clear()
+    yield bb.print(acc)
+
+
+def streamed_pipeline(n: int, *extra) -> Block:
+    return Block(stream(recorded_trace(n), constfold_stream, cse_stream,
+                        strength_reduce_stream, alloc_removal_stream,
+                        optimize_load_store_stream, *extra))
+
+
+@benchmark
+def streaming():
+    """Sequential Block pipeline vs streaming passes: memory and latency"""
+    rows = []
+    for n in (10_000, 100_000):
+        def blocks():
+            return sequential_pipeline(synthetic_trace(Block(), n))
+
+        def first_op():
+            return next(stream(recorded_trace(n), constfold_stream, cse_stream,
+                               strength_reduce_stream, alloc_removal_stream,
+                               optimize_load_store_stream))
+
+        for name, run in (("blocks", blocks),
+                          ("stream", lambda: streamed_pipeline(n)),
+                          ("stream + compact", lambda: streamed_pipeline(
+                              n, compact_stream))):
+            opt_bb, peak = peak_allocated(run)
+            rows.append((n, name, len(opt_bb), best_time(run, repeat=1),
+                         peak // 1024))
+        rows.append((n, "stream 1st op", 1, best_time(first_op), ""))
+    report("streaming passes", rows, ("ops", "pipeline", "ops out", "s", "peak KiB"))
+
+
+
+@benchmark
+def rewrite_rules():
+    """peephole latency as the number of rules grows"""
+    n = 50_000
+    rows = []
+    for extra in (0, 100, 1000, 10_000):
+        rules = RuleSet([*(rule.text for rule in STRENGTH_REDUCTION_RULES.rules),
+                         *(rule.text for rule in ALGEBRAIC_RULES.rules)])
+        # rules that never fire: other constants and other ops
+        for i in range(extra // 2):
+            rules.add(f"add(x, {i + 1000}) -> x")
+            rules.add(f"op{i}(x, y) -> x")
+        bb = constant_heavy_trace(n)
+        seconds = best_time(peephole, bb, rules, repeat=1)
+        rows.append((len(rules), len(bb), seconds,
+                     seconds / len(bb) * 1e9, sum(rules.counts.values())))
+    report("rewrite rules", rows, ("rules", "ops", "s", "ns/op", "fired"))
+
+
+def scaled_index_trace(n: int) -> Block:
+    """Address-like arithmetic: muls of values by small constants"""
+    bb = Block()
+    i = bb.getarg(0)
+    acc = bb.getarg(1)
+    k = 0
+    while len(bb) < n:
+        for factor in (8, 1, 3, 10, 4, 12, -1, 16):
+            acc = bb.add(acc, bb.mul(bb.add(i, k), factor))
+        k += 1
+    bb.print(acc)
+    return bb
+
+
+@benchmark
+def mul_lowering():
+    """Interpreted time of muls by constants, lowered per cost model"""
+    from bytecode import lower
+
+    n = 20_000
+    rows = []
+    for name, opt in (("mul", lambda bb: bb),
+                      ("interpreter costs", lambda bb: strength_reduce(bb)),
+                      ("machine costs", lambda bb: strength_reduce(bb, MACHINE_COSTS))):
+        bb = opt(scaled_index_trace(n))
+        program = lower(bb)
+        for runner, func in (("interpret", interpret), ("execute", execute),
+                             ("Program.run", lambda bb, *args: program.run(*args))):
+            elapsed = best_time(quiet, func, bb, 7, 2**70)
+            rows.append((name, len(bb), runner, elapsed))
+    report("mul lowering", rows, ("muls", "ops", "runner", "s"))
+
+
+def constant_derived_trace(n: int) -> Block:
+    """Ops that only depend on constants, identities and loads of
+    fields holding constants"""
+    bb = Block()
+    acc = bb.getarg(0)
+    obj = bb.getarg(1)
+    i = 0
+    while len(bb) < n:
+        bb.store(obj, 0, i % 7)
+        k = bb.load(obj, 0)
+        scale = bb.bitand(bb.add(k, 8), 7)
+        acc = bb.add(acc, bb.mul(scale, 1))
+        acc = bb.sub(bb.lshift(acc, bb.sub(k, k)), 0)
+        acc = bb.bitand(acc, -1)
+        i += 1
+    bb.print(acc)
+    return bb
+
+
+@benchmark
+def constant_folding():
+    """Interpreted time before and after constfold"""
+    n = 50_000
+    rows = []
+    for name, opt in (("none", lambda bb: bb), ("constfold", constfold)):
+        bb = constant_derived_trace(n)
+        fold_time = best_time(opt, bb, repeat=1)
+        opt_bb = opt(constant_derived_trace(n))
+        for runner, func in (("interpret", interpret), ("execute", execute)):
+            elapsed = best_time(quiet, func, opt_bb, 3, Obj())
+            rows.append((name, fold_time, len(opt_bb), runner, elapsed))
+    report("constant folding", rows, ("pass", "pass s", "ops", "runner", "s"))
+
+
+def shift_chain_trace(n: int) -> Block:
+    """Values shifted left by a word over and over, as unbounded ints
+    they grow by 64 bits per step"""
+    bb = Block()
+    acc = bb.getarg(0)
+    const = 1
+    while len(bb) < n:
+        acc = bb.add(bb.lshift(acc, 64), acc)
+        const = bb.add(bb.lshift(const, 64), 1)
+        acc = bb.bitand(acc, const)
+    bb.print(bb.bitand(acc, 255))
+    return bb
+
+
+@benchmark
+def bit_width():
+    """Unbounded ints vs 64 bit wrapping on a trace of large shifts"""
+    n = 3_000
+    rows = []
+    for width in (None, 64):
+        with bit_width_mode(width):
+            bb = shift_chain_trace(n)
+            fold_time = best_time(constfold, shift_chain_trace(n), repeat=1)
+            _, fold_peak = peak_allocated(constfold, shift_chain_trace(n))
+            rows.append((str(width), "constfold", fold_time, fold_peak))
+            for runner in (interpret, execute, interpret_compiled):
+                elapsed = best_time(quiet, runner, bb, 3)
+                _, peak = peak_allocated(quiet, runner, bb, 3)
+                rows.append((str(width), runner.__name__, elapsed, peak))
+    report("bit width", rows, ("width", "runner", "s", "peak bytes"))
+
+
+if __name__ == "__main__":
+    names = sys.argv[1:] or list(BENCHMARKS)
+    for name in names:
+        BENCHMARKS[name]()
@@ -0,0 +1,232 @@
+from array import array
+import struct
+import sys
+from typing import Any
+
+from ir import Block, Constant, Operation, OpTable, int_ops
+from interpret import Obj, get_num
+from compact_block import constant_key
+
+
+# Opcodes and their operands. `dst`/`src`/`a`/`b`/`obj` are register
+# numbers, `idx`/`field` are immediate ints.
+GETARG = 0      # dst, idx
+ALLOC = 1       # dst
+LOAD = 2        # dst, obj, field
+STORE = 3       # obj, field, src
+PRINT = 4       # src
+ADD = 5         # dst, a, b
+MUL = 6         # dst, a, b
+LSHIFT = 7      # dst, a, b
+BITAND = 8      # dst, a, b
+SUB = 9         # dst, a, b
+
+_BINOPS = {"add": ADD, "sub": SUB, "mul": MUL, "lshift": LSHIFT,
+           "bitand": BITAND}
+
+_MAGIC = b"TOYBC\x00"
+# magic, number of registers, code length and number of constants,
+# followed by the code as little-endian int64s and the constants
+_HEADER = struct.Struct("<6sQQQ")
+# the code is an array of int64, the same in memory and in the file
+_CODE = "q"
+
+
+class Program:
+    """A Block lowered to register bytecode.
+
+    The register file starts with one register per entry of
+    `constants`, followed by `nregs` registers for the values computed
+    by the code.
+    """
+
+    def __init__(self, code: array, nregs: int, constants: list[Any]):
+        self.code = code
+        self.nregs = nregs
+        self.constants = constants
+
+    def run(self, *args) -> Any:
+        """Execute the program, same result as interpret(bb, *args)
+        with the current bit width"""
+        code = self.code
+        wrap, lshift = int_ops()
+        regs: list[Any] = [wrap(const) for const in self.constants]
+        regs += [None] * self.nregs
+        pc = 0
+        end = len(code)
+        while pc < end:
+            opcode = code[pc]
+            if opcode == ADD:
+                regs[code[pc + 1]] = wrap(regs[code[pc + 2]] + regs[code[pc + 3]])
+                pc += 4
+            elif opcode == MUL:
+                regs[code[pc + 1]] = wrap(regs[code[pc + 2]] * regs[code[pc + 3]])
+                pc += 4
+            elif opcode == LOAD:
+                regs[code[pc + 1]] = regs[code[pc + 2]].load(code[pc + 3])
+                pc += 4
+            elif opcode == STORE:
+                regs[code[pc + 1]].store(code[pc + 2], regs[code[pc + 3]])
+                pc += 4
+            elif opcode == LSHIFT:
+                regs[code[pc + 1]] = lshift(regs[code[pc + 2]], regs[code[pc + 3]])
+                pc += 4
+            elif opcode == BITAND:
+                regs[code[pc + 1]] = wrap(regs[code[pc + 2]] & regs[code[pc + 3]])
+                pc += 4
+            elif opcode == SUB:
+                regs[code[pc + 1]] = wrap(regs[code[pc + 2]] - regs[code[pc + 3]])
+                pc += 4
+            elif opcode == GETARG:
+                regs[code[pc + 1]] = wrap(args[code[pc + 2]])
+                pc += 3
+            elif opcode == ALLOC:
+                regs[code[pc + 1]] = Obj()
+                pc += 2
+            elif opcode == PRINT:
+                res = regs[code[pc + 1]]
+                print(res)
+                return res
+            else:
+                raise ValueError(f"invalid opcode {opcode} at {pc}")
+        return None
+
+    def to_bytes(self) -> bytes:
+        """Serialize the program. Only int constants are supported."""
+        code = self.code
+        if code.typecode != _CODE or sys.byteorder != "little":
+            code = array(_CODE, code)
+            if sys.byteorder != "little":
+                code.byteswap()
+        parts = [_HEADER.pack(_MAGIC, self.nregs, len(code),
+                              len(self.constants)),
+                 code.tobytes()]
+        for const in self.constants:
+            if type(const) is not int:
+                raise ValueError(f"can't serialize constant {const!r}")
+            data = const.to_bytes((const.bit_length() + 8) // 8, "little",
+                                  signed=True)
+            parts.append(struct.pack("<Q", len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    @classmethod
+    def from_bytes(cls, data: bytes) -> "Program":
+        magic, nregs, codelen, nconsts = _HEADER.unpack_from(data)
+        if magic != _MAGIC:
+            raise ValueError("not a serialized Program")
+        pos = _HEADER.size
+        code = array(_CODE)
+        code.frombytes(data[pos:pos + codelen * code.itemsize])
+        if sys.byteorder != "little":
+            code.byteswap()
+        pos += codelen * code.itemsize
+        constants = []
+        for _ in range(nconsts):
+            (size,) = struct.unpack_from("<Q", data, pos)
+            pos += 8
+            constants.append(int.from_bytes(data[pos:pos + size], "little",
+                                            signed=True))
+            pos += size
+        return cls(code, nregs, constants)
+
+
+# the argument positions holding immediates instead of registers
+_IMMEDIATES = {"getarg": (0,), "load": (1,), "store": (1,)}
+
+
+def lower(bb: Block) -> Program:
+    """Lower bb to register bytecode.
+
+    Registers are allocated by a linear scan over the block: a value
+    gets a register when it's defined and gives it back after its last
+    use, so the register file is only as large as the number of values
+    live at the same time.
+    """
+    # first walk: constants and the last use of each value
+    constants: list[Any] = []
+    const_regs: dict[tuple, int] = {}
+    last_use: OpTable[int] = OpTable()
+
+    def const_key(const: Constant) -> tuple:
+        # by type and bits, 0.0 and -0.0 need different registers
+        try:
+            return constant_key(const.value)
+        except TypeError:   # unhashable, gets a register of its own
+            return (Constant, id(const))
+
+    for pos, op in enumerate(bb):
+        immediates = _IMMEDIATES.get(op.name, ())
+        for i in range(len(op.args)):
+            arg = op.arg(i)
+            if isinstance(arg, Operation):
+                last_use[arg] = pos
+            elif i not in immediates:
+                key = const_key(arg)
+                if key not in const_regs:
+                    const_regs[key] = len(constants)
+                    constants.append(arg.value)
+        if op.name == "print":
+            break
+
+    # second walk: emit code, value registers come after the constants
+    code = array(_CODE)
+    registers: OpTable[int] = OpTable()
+    free: list[int] = []
+    nregs = 0
+
+    def reg(value) -> int:
+        if isinstance(value, Constant):
+            return const_regs[const_key(value)]
+        assert value in registers, "Basic block not valid"
+        return registers[value]
+
+    def release(pos: int, op: Operation):
+        """Free the registers of the args that die at pos"""
+        for i in range(len(op.args)):
+            arg = op.arg(i)
+            if isinstance(arg, Operation) and last_use.get(arg) == pos \
+                    and arg in registers:
+                free.append(registers[arg])
+                del registers[arg]
+
+    def define(op: Operation) -> int:
+        nonlocal nregs
+        if free:
+            register = free.pop()
+        else:
+            register = len(constants) + nregs
+            nregs += 1
+        if op in last_use:
+            registers[op] = register
+        else:   # never used, free again right away
+            free.append(register)
+        return register
+
+    for pos, op in enumerate(bb):
+        match op.name:
+            case "getarg":
+                code.extend((GETARG, define(op), get_num(op, 0)))
+            case "alloc":
+                code.extend((ALLOC, define(op)))
+            case "load":
+                obj, field = reg(op.arg(0)), get_num(op, 1)
+                release(pos, op)
+                code.extend((LOAD, define(op), obj, field))
+            case "store":
+                code.extend((STORE, reg(op.arg(0)), get_num(op, 1),
+                             reg(op.arg(2))))
+                release(pos, op)
+            case "print":
+                code.extend((PRINT, reg(op.arg(0))))
+                break   # nothing after it ever runs
+            case "add" | "sub" | "mul" | "lshift" | "bitand":
+                a, b = reg(op.arg(0)), reg(op.arg(1))
+                release(pos, op)
+                code.extend((_BINOPS[op.name], define(op), a, b))
+            case "escape":
+                release(pos, op)    # no runtime effect, emit nothing
+            case _:
+                raise NotImplementedError(f"Operation {op.name} not implemented")
+
+    return Program(code, nregs, constants)
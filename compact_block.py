@@ -0,0 +1,275 @@
+from array import array
+import struct
+from typing import Any, Iterator, Optional
+import weakref
+
+from ir import Value, Constant, Operation, Block, OpTable, new_op_id
+
+
+def constant_key(value: Any) -> tuple:
+    """The key constants are pooled by: values with equal keys can be
+    used interchangeably. Floats are keyed by their bits, 0.0 == -0.0
+    but they are different values. Raises TypeError if value isn't
+    hashable."""
+    if type(value) is float:
+        return (float, struct.pack("<d", value))
+    if type(value) is complex:
+        return (complex, struct.pack("<dd", value.real, value.imag))
+    return (type(value), value)
+
+
+class OpView(Operation):
+    """Lightweight Operation view on a single row of a CompactBlock.
+
+    All state (name, arguments and forwarding) lives in the
+    columns of the block; the view only remembers its position.
+    Views are cached weakly by the block, so as long as a view is
+    alive, every access to the same position returns the same object
+    and identity checks (`is`, dict keys) keep working.
+    """
+
+    __slots__ = ("_block", "_index", "__weakref__")
+    # CompactBlocks don't track uses
+    _users = None
+
+    def __init__(self, block: "CompactBlock", index: int):
+        self._block = block
+        self._index = index
+
+    def __repr__(self):
+        return f"OpView({self._index}, {self.name})"
+
+    @property
+    def id(self) -> int:  # type: ignore[override]
+        return self._block._op_id(self._index)
+
+    @property
+    def name(self) -> str:  # type: ignore[override]
+        block = self._block
+        return block.opnames[block.opcodes[self._index]]
+
+    @property
+    def args(self) -> list[Value]:  # type: ignore[override]
+        """A fresh list of the arguments, mutating it has no effect"""
+        block = self._block
+        start, stop = block.argstarts[self._index], block.argstarts[self._index + 1]
+        return [block._decode(slot) for slot in block.argslots[start:stop]]
+
+    @property
+    def _forwarded(self) -> Optional[Value]:
+        return self._block._forwarded.get(self._index)
+
+    @_forwarded.setter
+    def _forwarded(self, value: Optional[Value]):
+        if value is None:
+            self._block._forwarded.pop(self._index, None)
+        else:
+            self._block._forwarded[self._index] = value
+
+    def arg(self, index: int):
+        block = self._block
+        slot = block.argslots[block.argstarts[self._index] + index]
+        return block._decode(slot).find()
+
+
+class CompactBlock:
+    """Struct-of-arrays alternative to `ir.Block`.
+
+    Every operation is a row spread over flat columns:
+    - `opcodes`: index into the per-block opcode table `opnames`
+    - `argstarts`: row i has its arguments in
+      `argslots[argstarts[i]:argstarts[i + 1]]`
+    - `argslots`: >= 0 is the index of another operation of this
+      block, < 0 is `~index` into the `constants` pool
+    - `ids`: the op id of every row, so views of the same row hash the
+      same and work with `OpTable`s
+    The columns of a block loaded by `serialize` are read-only views of
+    the serialized data; the rows get their ids when first used, and
+    appending to the block copies the columns into arrays first.
+    Forwarding is sparse and only stored for the rows that
+    actually have it. Iterating or indexing yields `OpView`s, so code
+    written against `Block` (interpret, bb_to_str, the passes) runs
+    unchanged.
+    """
+
+    def __init__(self):
+        self.opnames: list[str] = []
+        self._opcode_of: dict[str, int] = {}
+        self.opcodes = array("H")
+        self.argstarts = array("q", [0])
+        self.argslots = array("q")
+        self.ids = array("q")
+        self.constants: list[Constant] = []
+        self._constant_index: dict[tuple, int] = {}
+        self._forwarded: dict[int, Value] = {}
+        # index -> weakref to the live view of that row
+        self._views: dict[int, weakref.ref] = {}
+        # ids of the rows past the end of `ids`, in loaded blocks
+        self._lazy_ids: dict[int, int] = {}
+        self._loaded = False
+
+    @classmethod
+    def from_columns(cls, opnames: list[str], opcodes, argstarts, argslots,
+                     constants) -> "CompactBlock":
+        """A block on top of existing columns: any sequences of ints
+        (e.g. memoryviews) and a sequence of Constants. Nothing is
+        copied until something is appended."""
+        res = cls()
+        res.opnames = opnames
+        res._opcode_of = {name: code for code, name in enumerate(opnames)}
+        res.opcodes = opcodes
+        res.argstarts = argstarts
+        res.argslots = argslots
+        res.constants = constants
+        res._loaded = True
+        return res
+
+    def _thaw(self):
+        """Copy loaded columns into arrays, so rows can be appended"""
+        self.opcodes = array("H", self.opcodes)
+        self.argstarts = array("q", self.argstarts)
+        self.argslots = array("q", self.argslots)
+        self.constants = list(self.constants)
+        for index, const in enumerate(self.constants):
+            try:
+                self._constant_index.setdefault(constant_key(const.value), index)
+            except TypeError:
+                pass
+        self.ids = array("q", (self._op_id(i) for i in range(len(self.opcodes))))
+        self._lazy_ids.clear()
+        self._loaded = False
+
+    def _op_id(self, index: int) -> int:
+        if index < len(self.ids):
+            return self.ids[index]
+        op_id = self._lazy_ids.get(index)
+        if op_id is None:
+            # setdefault, another thread may have assigned one already
+            op_id = self._lazy_ids.setdefault(index, new_op_id())
+        return op_id
+
+    def __len__(self) -> int:
+        return len(self.opcodes)
+
+    @property
+    def version(self) -> int:
+        # rows are only ever appended
+        return len(self.opcodes)
+
+    def __iter__(self) -> Iterator[OpView]:
+        for index in range(len(self.opcodes)):
+            yield self._view(index)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self._view(i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("CompactBlock index out of range")
+        return self._view(index)
+
+    def _view(self, index: int) -> OpView:
+        ref = self._views.get(index)
+        if ref is not None:
+            view = ref()
+            if view is not None:
+                return view
+        view = OpView(self, index)
+        self._views[index] = weakref.ref(view, self._views_cleanup(index))
+        return view
+
+    def _views_cleanup(self, index: int):
+        views = self._views
+
+        def cleanup(ref):
+            if views.get(index) is ref:
+                del views[index]
+
+        return cleanup
+
+    def _decode(self, slot: int) -> Value:
+        if slot < 0:
+            return self.constants[~slot]
+        return self._view(slot)
+
+    def _encode(self, value: Any) -> int:
+        if isinstance(value, OpView) and value._block is self:
+            return value._index
+        if isinstance(value, Value) and not isinstance(value, Constant):
+            raise ValueError(f"{value!r} is not an operation of this block")
+        if isinstance(value, Constant):
+            value = value.value
+        try:
+            key = constant_key(value)
+            index = self._constant_index.get(key)
+        except TypeError:   # unhashable constant, don't share it
+            key, index = None, None
+        if index is None:
+            index = len(self.constants)
+            self.constants.append(Constant(value))
+            if key is not None:
+                self._constant_index[key] = index
+        return ~index
+
+    def _opcode(self, opname: str) -> int:
+        code = self._opcode_of.get(opname)
+        if code is None:
+            code = len(self.opnames)
+            self.opnames.append(opname)
+            self._opcode_of[opname] = code
+        return code
+
+    def emit(self, opname: str, args) -> OpView:
+        """Append a new row; args may be plain values, Constants or
+        views of this block"""
+        if self._loaded:
+            self._thaw()
+        slots = [self._encode(arg) for arg in args]
+        self.opcodes.append(self._opcode(opname))
+        self.argslots.extend(slots)
+        self.argstarts.append(len(self.argslots))
+        self.ids.append(new_op_id())
+        return self._view(len(self.opcodes) - 1)
+
+    def append(self, op: Operation) -> OpView:
+        """Copy an Operation into the columns. Its arguments must be
+        Constants or views of this block."""
+        return self.emit(op.name, op.args)
+
+    @classmethod
+    def from_block(cls, bb: Block) -> "CompactBlock":
+        """Convert a Block, resolving forwarded arguments"""
+        res = cls()
+        views: OpTable[OpView] = OpTable()
+        for op in bb:
+            args = []
+            for i in range(len(op.args)):
+                arg = op.arg(i)
+                if isinstance(arg, Operation):
+                    assert arg in views, "Basic block not valid"
+                    arg = views[arg]
+                args.append(arg)
+            views[op] = res.emit(op.name, args)
+        return res
+
+    @staticmethod
+    def opbuilder(opname):
+
+        def build(self, *args):
+            return self.emit(opname, args)
+
+        return build
+
+    add = opbuilder("add")
+    sub = opbuilder("sub")
+    mul = opbuilder("mul")
+    getarg = opbuilder("getarg")
+    dummy = opbuilder("dummy")
+    lshift = opbuilder("lshift")
+    alloc = opbuilder("alloc")
+    load = opbuilder("load")
+    store = opbuilder("store")
+    bitand = opbuilder("bitand")
+    print = opbuilder("print")
+    escape = opbuilder("escape")
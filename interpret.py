@@ -1,6 +1,7 @@
-from typing import Any 
+from typing import Any, Callable
 
-from ir import Block, Operation, Constant, Value
+from ir import Block, Operation, Constant, Value, OpTable, forwarding_epoch
+from ir import bit_width, int_ops, wrap_int
 
 
 class Obj:
@@ -34,46 +35,247 @@ def get_num(op, idx: int = 1) -> Any:
     return op.arg(idx).value
 
 
-def argval(op, i):
+def argval(values: OpTable[Any], op, i):
+    """The runtime value of the i-th argument of op"""
     arg = op.arg(i)
     if isinstance(arg, Constant):
-        return arg.value
+        return wrap_int(arg.value)
     else:
         assert isinstance(arg, Operation) 
-        return arg.info
+        return values[arg]
 
 
 def interpret(bb: Block, *args) -> Any:
+    # the runtime value of every op, owned by this call
+    values: OpTable[Any] = OpTable(bb)
+    wrap, lshift = int_ops()
     for idx, op in enumerate(bb):
         match op.name:
             case "getarg":
-                op.info = args[get_num(op, 0)]
+                values[op] = wrap(args[get_num(op, 0)])
             case "alloc":
-                op.info = Obj()
+                values[op] = Obj()
             case "load":
                 field_num = get_num(op)
-                op.info = argval(op, 0).load(field_num)
+                values[op] = argval(values, op, 0).load(field_num)
             case "store":
-                obj = argval(op, 0)
+                obj = argval(values, op, 0)
                 field_num = get_num(op, 1)
-                field_val = argval(op, 2)
+                field_val = argval(values, op, 2)
                 obj.store(field_num, field_val)
             case "print":
-                res = argval(op, 0)
+                res = argval(values, op, 0)
                 print(res)
                 return res
             case "add":
-                op.info = argval(op, 0) + argval(op, 1)
+                values[op] = wrap(argval(values, op, 0) + argval(values, op, 1))
+            case "sub":
+                values[op] = wrap(argval(values, op, 0) - argval(values, op, 1))
             case "mul":
-                op.info = argval(op, 0) * argval(op, 1)
+                values[op] = wrap(argval(values, op, 0) * argval(values, op, 1))
             case "lshift":
-                op.info = argval(op, 0) << argval(op, 1)
+                values[op] = lshift(argval(values, op, 0), argval(values, op, 1))
+            case "bitand":
+                values[op] = wrap(argval(values, op, 0) & argval(values, op, 1))
             case "escape":
                 pass    # do nothing
             case _:
                 raise NotImplementedError(f"Operation {op.name} not implemented")
 
 
+def _generate(bb: Block) -> Callable[..., Any]:
+    """Generate a Python function doing what interpret(bb, *args)
+    does, with every argument resolved once. The code is specialized
+    to the current bit width, plain Python ints don't pay for it."""
+    wrap, lshift = int_ops()
+    namespace: dict[str, Any] = {"Obj": Obj, "wrap": wrap, "lshift": lshift}
+    varnames: OpTable[str] = OpTable()
+    # ints are wrapped to the bit width after every op
+    fmt = "{}" if bit_width() is None else "wrap({})"
+
+    def operand(value: Value) -> str:
+        if isinstance(value, Constant):
+            if type(value.value) is int:
+                return repr(wrap(value.value))
+            name = f"const{len(namespace)}"
+            namespace[name] = value.value
+            return name
+        assert isinstance(value, Operation) and value in varnames, \
+            "Basic block not valid"
+        return varnames[value]
+
+    lines = ["def compiled(*args):"]
+    for index, op in enumerate(bb):
+        var = varnames[op] = f"v{index}"
+        args = [operand(op.arg(i)) for i in range(len(op.args))]
+        match op.name:
+            case "getarg":
+                lines.append(f"{var} = " + fmt.format(f"args[{get_num(op, 0)}]"))
+            case "alloc":
+                lines.append(f"{var} = Obj()")
+            case "load":
+                lines.append(f"{var} = {args[0]}.load({get_num(op)})")
+            case "store":
+                lines.append(f"{args[0]}.store({get_num(op, 1)}, {args[2]})")
+            case "print":
+                lines.append(f"print({args[0]})")
+                lines.append(f"return {args[0]}")
+                break   # nothing after it ever runs
+            case "add":
+                lines.append(f"{var} = " + fmt.format(f"{args[0]} + {args[1]}"))
+            case "sub":
+                lines.append(f"{var} = " + fmt.format(f"{args[0]} - {args[1]}"))
+            case "mul":
+                lines.append(f"{var} = " + fmt.format(f"{args[0]} * {args[1]}"))
+            case "lshift":
+                if bit_width() is None:
+                    lines.append(f"{var} = {args[0]} << {args[1]}")
+                else:
+                    lines.append(f"{var} = lshift({args[0]}, {args[1]})")
+            case "bitand":
+                lines.append(f"{var} = " + fmt.format(f"{args[0]} & {args[1]}"))
+            case "escape":
+                pass    # do nothing
+            case _:
+                message = f"Operation {op.name} not implemented"
+                lines.append(f"raise NotImplementedError({message!r})")
+                break
+
+    source = "\n    ".join(lines) + "\n    return None\n"
+    exec(source, namespace)
+    return namespace["compiled"]
+
+
+def _resolved_args(bb: Block) -> list[Value]:
+    return [op.arg(i) for op in bb for i in range(len(op.args))]
+
+
+def _cached(bb: Block, attr: str, build: Callable[[Block], Any]) -> Any:
+    """Return build(bb), cached on the block under `attr` until the
+    block is mutated or some argument of its ops resolves to a
+    different representative. Forwarding in other blocks only costs a
+    walk over the arguments, not a rebuild.
+
+    Safe to call from several threads: at worst two of them build
+    the same thing and one result wins. Every bit width has a cache
+    of its own, threads using different ones don't evict each other.
+    """
+    width = bit_width()
+    if width is not None:
+        attr = f"{attr}_w{width}"
+    key = bb.version
+    epoch = forwarding_epoch()
+    cached = getattr(bb, attr, None)
+    if cached is not None and cached[0] == key:
+        _, built_epoch, resolved, result = cached
+        if built_epoch == epoch:
+            return result
+        # something was forwarded somewhere since, maybe not in bb
+        if _resolved_args(bb) == resolved:
+            setattr(bb, attr, (key, epoch, resolved, result))
+            return result
+    resolved = _resolved_args(bb)
+    result = build(bb)
+    setattr(bb, attr, (key, epoch, resolved, result))
+    return result
+
+
+def compile_block(bb: Block) -> Callable[..., Any]:
+    """Compile bb into a Python function taking the block arguments.
+    The result is cached on the block."""
+    return _cached(bb, "_compiled", _generate)
+
+
+def interpret_compiled(bb: Block, *args) -> Any:
+    """Like interpret, but runs the (cached) compiled form of bb"""
+    return compile_block(bb)(*args)
+
+
+class FrameProgram:
+    """bb with every argument resolved to a register number.
+
+    Registers [0, len(bb)) hold the result of the op at that position,
+    the ones after them hold the constants used by the block, int ones
+    already wrapped to the bit width.
+    """
+
+    def __init__(self, bb: Block):
+        positions: OpTable[int] = OpTable()
+        self.constants: list[Any] = []
+        self.code: list[tuple[str, tuple[int, ...]]] = []
+        for pos, op in enumerate(bb):
+            positions[op] = pos
+            # argument index and field offsets must be constants,
+            # and aren't values of the bit width
+            index = None
+            if op.name == "getarg":
+                get_num(op, 0)
+                index = 0
+            elif op.name in ("load", "store"):
+                get_num(op, 1)
+                index = 1
+            regs = []
+            for i in range(len(op.args)):
+                arg = op.arg(i)
+                if isinstance(arg, Constant):
+                    regs.append(len(bb) + len(self.constants))
+                    value = arg.value
+                    self.constants.append(value if i == index else wrap_int(value))
+                else:
+                    assert arg in positions, "Basic block not valid"
+                    regs.append(positions[arg])
+            self.code.append((op.name, tuple(regs)))
+
+    def new_frame(self) -> list[Any]:
+        return [None] * len(self.code) + self.constants
+
+
+def frame_program(bb: Block) -> FrameProgram:
+    """The (cached) FrameProgram of bb"""
+    return _cached(bb, "_frame_program", FrameProgram)
+
+
+def execute(bb: Block, *args) -> Any:
+    """Interpret bb in a frame of its own.
+
+    Runtime values live in a register list local to this call, indexed
+    by position instead of op id, and the IR is left untouched: the
+    same Block can be run by many threads at once, or while it's being
+    optimized.
+    """
+    program = frame_program(bb)
+    regs = program.new_frame()
+    wrap, lshift = int_ops()
+    for pos, (name, a) in enumerate(program.code):
+        match name:
+            case "getarg":
+                regs[pos] = wrap(args[regs[a[0]]])
+            case "alloc":
+                regs[pos] = Obj()
+            case "load":
+                regs[pos] = regs[a[0]].load(regs[a[1]])
+            case "store":
+                regs[a[0]].store(regs[a[1]], regs[a[2]])
+            case "print":
+                res = regs[a[0]]
+                print(res)
+                return res
+            case "add":
+                regs[pos] = wrap(regs[a[0]] + regs[a[1]])
+            case "sub":
+                regs[pos] = wrap(regs[a[0]] - regs[a[1]])
+            case "mul":
+                regs[pos] = wrap(regs[a[0]] * regs[a[1]])
+            case "lshift":
+                regs[pos] = lshift(regs[a[0]], regs[a[1]])
+            case "bitand":
+                regs[pos] = wrap(regs[a[0]] & regs[a[1]])
+            case "escape":
+                pass    # do nothing
+            case _:
+                raise NotImplementedError(f"Operation {name} not implemented")
+
+
 if __name__ == "__main__":
     bb = Block()
     var0 = bb.getarg(0)
@@ -83,3 +285,5 @@ if __name__ == "__main__":
     bb.print(var1)
 
     assert interpret(bb, 42) == 42
+    assert interpret_compiled(bb, 42) == 42
+    assert execute(bb, 42) == 42
@@ -1,7 +1,17 @@
-from typing import Optional, Any
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+import itertools
+import operator
+import re
+import threading
+import weakref
+from typing import Callable, Generic, Iterable, Iterator, Optional, Any, TypeVar
 
 
 class Value:
+    __slots__ = ()
+
     def __eq__(self, other):
         return self is other
 
@@ -13,19 +23,58 @@ class Value:
         raise NotImplementedError
 
 
+# the interned Constants, keyed by (type, value). Weak, so the
+# pool doesn't keep the results of every fold ever made alive.
+_constants: "weakref.WeakValueDictionary[tuple[type, Any], Constant]" = \
+    weakref.WeakValueDictionary()
+_constants_lock = threading.Lock()
+# equal values of these types can be used interchangeably. Not true
+# for e.g. floats: 0.0 == -0.0
+_INTERNED_TYPES = (int, bool, str)
+
+
 class Constant(Value):
-    def __init__(self, value: Any):
-        self.value = value
+    """A constant value. Constants of ints, bools and strs are
+    interned: equal values are the same object, so they can be
+    compared with `is`."""
+    __slots__ = ("value", "__weakref__")
+    value: Any
+
+    def __new__(cls, value: Any):
+        const: Optional[Constant]
+        if type(value) not in _INTERNED_TYPES:
+            const = super().__new__(cls)
+            const.value = value
+            return const
+        key = (type(value), value)
+        const = _constants.get(key)
+        if const is None:
+            with _constants_lock:
+                const = _constants.get(key)
+                if const is None:
+                    const = super().__new__(cls)
+                    const.value = value
+                    _constants[key] = const
+        return const
+
+    def __getnewargs__(self):
+        # unpickled Constants are interned, too
+        return (self.value,)
 
     def __repr__(self):
         return f"Constant({self.value})"
 
     def __eq__(self, other):
+        if self is other:
+            return True
         if not isinstance(other, Constant):
             return super().__eq__(other)
 
         return self.value == other.value
 
+    def __hash__(self):
+        return hash(self.value)
+
     def find(self):
         return self
 
@@ -38,27 +87,68 @@ class Constant(Value):
             value.value == self.value
 
 
+# dense ids for Operations, in creation order. next() on a count is
+# atomic, so threads creating ops never get the same id.
+_op_ids = itertools.count()
+
+
+def new_op_id() -> int:
+    return next(_op_ids)
+
+
 class Operation(Value):
+    __slots__ = ("name", "args", "_forwarded", "_users", "id")
+
     def __init__(self, name: str, args: list[Value]):
         self.name: str = name
         self.args: list[Value] = args
         self._forwarded: Optional[Value] = None
-        self.info: Any = None
+        # ops using this one, recorded by Blocks with track_uses,
+        # keyed by their id
+        self._users: Optional[dict[int, Operation]] = None
+        # never changes, unlike name, args and forwarding
+        self.id: int = next(_op_ids)
 
     def __repr__(self):
-        return f"Operation({self.name}, {self.args}, {self._forwarded}, {self.info})"
+        return f"Operation({self.name}, {self.args}, {self._forwarded})"
 
     def __hash__(self):
-        # NOTE: this is not so clean
-        return hash((self.name, id(self.args), self._forwarded))
+        return self.id
+
+    def __getstate__(self):
+        return (self.name, self.args, self._forwarded)
+
+    def __setstate__(self, state):
+        # ids are only unique within one process, an unpickled op
+        # gets a fresh one. Use-lists are rebuilt by the Block.
+        self.name, self.args, self._forwarded = state
+        self._users = None
+        self.id = next(_op_ids)
 
     def find(self) -> Value:
-        op: Value = self 
+        op: Value = self
+        length = 0
         while isinstance(op, Operation):
-            if op._forwarded is None:
-                return op
-            op = op._forwarded
-
+            forwarded = op._forwarded
+            if forwarded is None:
+                break
+            op = forwarded
+            length += 1
+
+        if length > 1:
+            # path compression: point every Operation on the
+            # chain directly to the representative, so the next
+            # find() is a single step
+            current: Optional[Value] = self
+            while current is not op:
+                assert isinstance(current, Operation)
+                next_op = current._forwarded
+                current._forwarded = op
+                current = next_op
+
+        stats = _stats.get()
+        if stats is not None:
+            stats.record_find(length)
         return op
 
     def _set_forwarded(self, value: Value):
@@ -74,10 +164,296 @@ class Operation(Value):
         # must be either a Constant or an operation
         # that we know for sure is not optimized
         # away.
-        self.find()._set_forwarded(value)
+        # That rule fixes the direction of every link,
+        # so there is no union-by-rank; find() keeps the
+        # chains short by compressing them instead.
+        old = self.find()
+        new = value.find()
+        if old is new:
+            return
+        old._set_forwarded(value)
+        if isinstance(old, Operation) and old._users is not None:
+            _move_users(old, new)
+        global _forwarding_epoch
+        _forwarding_epoch += 1
+        stats = _stats.get()
+        if stats is not None:
+            stats.unions += 1
+
+
+def _move_users(old: Operation, new: Value):
+    """After a union, the users of old use the new representative"""
+    users = old._users
+    assert users is not None
+    old._users = None
+    if not isinstance(new, Operation):
+        return  # Constants don't track their users
+    if new._users is None:
+        new._users = users
+        return
+    # merge the smaller dict into the larger one
+    if len(new._users) < len(users):
+        new._users, users = users, new._users
+    new._users.update(users)
+
+
+# bumped by every make_equal_to, lets caches notice that some
+# argument may now resolve to a different representative
+_forwarding_epoch = 0
+
+
+def forwarding_epoch() -> int:
+    return _forwarding_epoch
+
+
+class UnionFindStats:
+    """Counters about the forwarding chains walked by find()"""
+
+    def __init__(self):
+        self.finds = 0
+        self.unions = 0
+        self.total_length = 0
+        self.max_length = 0
+
+    def record_find(self, length: int):
+        self.finds += 1
+        self.total_length += length
+        if length > self.max_length:
+            self.max_length = length
+
+    def merge(self, other: "UnionFindStats"):
+        self.finds += other.finds
+        self.unions += other.unions
+        self.total_length += other.total_length
+        self.max_length = max(self.max_length, other.max_length)
+
+    @property
+    def average_length(self) -> float:
+        return self.total_length / self.finds if self.finds else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "finds": self.finds,
+            "unions": self.unions,
+            "average_length": self.average_length,
+            "max_length": self.max_length,
+        }
+
+
+# the innermost union_find_stats of the current context: every thread
+# (and asyncio task) counts into its own
+_stats: ContextVar[Optional[UnionFindStats]] = ContextVar("union_find_stats", default=None)
+
+
+@contextmanager
+def union_find_stats() -> Iterator[UnionFindStats]:
+    """Count find() chain lengths and unions while the block runs,
+    e.g. around a single pass:
+
+        with union_find_stats() as stats:
+            opt_bb = cse(bb)
+        print(stats.average_length, stats.max_length)
+
+    Nested contexts count towards the enclosing ones, too. Only the
+    finds and unions of the current thread are counted.
+    """
+    outer = _stats.get()
+    inner = UnionFindStats()
+    token = _stats.set(inner)
+    try:
+        yield inner
+    finally:
+        _stats.reset(token)
+        if outer is not None:
+            outer.merge(inner)
+
+
+# The bit widths ints can be computed with: None for unbounded Python
+# ints, otherwise wrapping two's complement of that many bits
+BIT_WIDTHS = (None, 8, 16, 32, 64)
+
+
+def _identity(value: Any) -> Any:
+    return value
+
+
+def _int_ops(width: Optional[int]) -> tuple[Callable[[Any], Any],
+                                             Callable[[Any, Any], Any]]:
+    """(wrap, lshift) for width: wrap maps an int into the range of
+    the width, lshift shifts and wraps"""
+    if width is None:
+        return _identity, operator.lshift
+    mask = (1 << width) - 1
+    sign = 1 << (width - 1)
+
+    def wrap(value: Any) -> Any:
+        if type(value) is not int:
+            return value
+        return ((value + sign) & mask) - sign
+
+    def lshift(value: Any, amount: Any) -> Any:
+        # everything is shifted out from `width` on, don't build a
+        # huge int to find that out
+        if type(amount) is int and amount > width:
+            amount = width
+        return wrap(value << amount)
+
+    return wrap, lshift
+
+
+_INT_OPS = {width: _int_ops(width) for width in BIT_WIDTHS}
+# (width, wrap, lshift) of the current context. A ContextVar, so every
+# thread (and asyncio task) has its own: new threads start unbounded.
+_int_mode: ContextVar[tuple[Optional[int], Callable[[Any], Any],
+                            Callable[[Any, Any], Any]]] = \
+    ContextVar("int_mode", default=(None, *_INT_OPS[None]))
+
+
+def _mode_of(width: Optional[int]) -> tuple:
+    if width not in _INT_OPS:
+        raise ValueError(f"unsupported bit width {width!r}, must be one of {BIT_WIDTHS}")
+    return (width, *_INT_OPS[width])
+
+
+def bit_width() -> Optional[int]:
+    """The bit width ints are computed with, None if unbounded"""
+    return _int_mode.get()[0]
+
+
+def set_bit_width(width: Optional[int]):
+    """Make interpreters and optimizations compute with wrapping ints
+    of `width` bits, or unbounded ones for None. The setting is local
+    to the current thread, other threads aren't affected."""
+    _int_mode.set(_mode_of(width))
+
+
+@contextmanager
+def bit_width_mode(width: Optional[int]) -> Iterator[None]:
+    """Compute with `width` bit ints while the block runs, in this
+    thread:
+
+        with bit_width_mode(32):
+            assert interpret(bb, 2**31 - 1) == -2**31
+    """
+    token = _int_mode.set(_mode_of(width))
+    try:
+        yield
+    finally:
+        _int_mode.reset(token)
+
+
+def int_ops() -> tuple[Callable[[Any], Any], Callable[[Any, Any], Any]]:
+    """(wrap_int, lshift_int) of the current bit width, for loops that
+    don't want to look it up for every op"""
+    _, wrap, lshift = _int_mode.get()
+    return wrap, lshift
+
+
+def wrap_int(value: Any) -> Any:
+    """value as an int of the current bit width, e.g. 255 is -1 with 8
+    bits. Anything but ints is returned unchanged."""
+    return _int_mode.get()[1](value)
+
+
+def lshift_int(value: Any, amount: Any) -> Any:
+    """value << amount with the current bit width"""
+    return _int_mode.get()[2](value, amount)
 
 
 class Block(list):
+    """A basic block: a list of Operations.
+
+    With `track_uses`, every op added to the block is recorded as a
+    user of the representatives of its arguments, so `users(op)` costs
+    time proportional to the number of users instead of a scan of the
+    block. Use-lists follow make_equal_to: the users of an op that is
+    made equal to another one move to the new representative, and
+    users that were themselves replaced are dropped lazily. Removing
+    ops from the block doesn't update the use-lists, call
+    `rebuild_uses()` after doing that.
+    """
+    # bumped by every mutation, lets caches keyed by a Block
+    # (e.g. compiled code) notice that it changed
+    version = 0
+    track_uses = False
+
+    def __init__(self, ops=(), track_uses: bool = False):
+        super().__init__(ops)
+        if track_uses:
+            self.track_uses = True
+            self.rebuild_uses()
+
+    def __getstate__(self):
+        # caches hold code objects and don't pickle
+        return {k: v for k, v in self.__dict__.items()
+                if not k.startswith("_")}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.track_uses:
+            self.rebuild_uses()
+
+    def _record_uses(self, op: Operation):
+        for arg in op.args:
+            rep = arg.find()
+            if isinstance(rep, Operation):
+                if rep._users is None:
+                    rep._users = {}
+                rep._users[op.id] = op
+
+    def append(self, op):
+        if self.track_uses:
+            self._record_uses(op)
+        super().append(op)
+
+    def extend(self, ops):
+        if self.track_uses:
+            ops = list(ops)
+            for op in ops:
+                self._record_uses(op)
+        super().extend(ops)
+
+    def insert(self, index, op):
+        if self.track_uses:
+            self._record_uses(op)
+        super().insert(index, op)
+
+    def __setitem__(self, index, value):
+        if self.track_uses:
+            if isinstance(index, slice):
+                value = list(value)
+                for op in value:
+                    self._record_uses(op)
+            else:
+                self._record_uses(value)
+        super().__setitem__(index, value)
+
+    def __iadd__(self, ops):  # type: ignore[misc]
+        self.extend(ops)
+        return self
+
+    def rebuild_uses(self):
+        """Recompute the use-lists of the ops of the block"""
+        for op in self:
+            for arg in op.args:
+                rep = arg.find()
+                if isinstance(rep, Operation):
+                    rep._users = None
+        for op in self:
+            self._record_uses(op)
+
+    def users(self, value: Value) -> list[Operation]:
+        """The ops using value (or anything equal to it)"""
+        if not self.track_uses:
+            raise ValueError("Block doesn't track uses")
+        rep = value.find()
+        if not isinstance(rep, Operation) or rep._users is None:
+            return []
+        users = rep._users
+        for key in [key for key, op in users.items()
+                    if op._forwarded is not None]:
+            del users[key]  # replaced by something else since
+        return list(users.values())
 
     @staticmethod
     def opbuilder(opname):
@@ -99,6 +475,7 @@ class Block(list):
         return build
 
     add = opbuilder("add")
+    sub = opbuilder("sub")
     mul = opbuilder("mul")
     getarg = opbuilder("getarg")
     dummy = opbuilder("dummy")
@@ -111,15 +488,158 @@ class Block(list):
     escape = opbuilder("escape")
 
 
+def _bumps_version(method):
+    @wraps(method)
+    def mutate(self, *args, **kwargs):
+        self.version += 1
+        return method(self, *args, **kwargs)
+    return mutate
+
+
+for _name in ("append", "extend", "insert", "pop", "remove", "clear",
+              "sort", "reverse", "__setitem__", "__delitem__",
+              "__iadd__", "__imul__"):
+    setattr(Block, _name,
+            _bumps_version(Block.__dict__.get(_name) or getattr(list, _name)))
+
+
+_MISSING: Any = object()
+
+T = TypeVar("T")
+
+
+class OpTable(Generic[T]):
+    """Side table from Operations to values, stored in a list indexed
+    by op id.
+
+    Ids are handed out densely in creation order, so the ops of one
+    block mostly have neighbouring ids and the list stays about as
+    long as the block. Lookups are an index operation instead of
+    hashing. `OpTable(bb, fill)` preallocates an entry holding `fill`
+    for every op of bb; without fill, missing ops raise KeyError like
+    a dict. When the ids are too far apart for that, e.g. old ops
+    mixed with ones created much later, the table falls back to a
+    dict keyed by id.
+    """
+    __slots__ = ("_base", "_values", "_sparse")
+
+    def __init__(self, ops: Iterable[Operation] = (), fill: Any = _MISSING):
+        ids = [op.id for op in ops]
+        self._base: int = min(ids) if ids else 0
+        self._values: list[Any] = []
+        # the entries by id once the table is sparse, _values is
+        # empty then
+        self._sparse: Optional[dict[int, Any]] = None
+        if not ids:
+            return
+        span = max(ids) - self._base + 1
+        if _is_sparse(len(ids), span):
+            self._base = 0
+            self._sparse = {} if fill is _MISSING else dict.fromkeys(ids, fill)
+        else:
+            self._values = [fill] * span
+
+    def _index(self, op: Operation) -> Optional[int]:
+        """Position of op in _values, growing the list if needed. None
+        if that made the table sparse."""
+        if not self._values:
+            self._base = op.id
+        index = op.id - self._base
+        if index < 0:
+            grow = -index
+        else:
+            grow = index + 1 - len(self._values)
+        # only count the entries on large jumps, every one of them at
+        # least doubles the list
+        if grow > max(_MIN_SPARSE_SPAN, len(self._values)):
+            entries = sum(value is not _MISSING for value in self._values)
+            if _is_sparse(entries + 1, len(self._values) + grow):
+                self._make_sparse()
+                return None
+        if index < 0:
+            self._values[:0] = [_MISSING] * grow
+            self._base = op.id
+            index = 0
+        elif grow > 0:
+            self._values.extend([_MISSING] * grow)
+        return index
+
+    def _make_sparse(self):
+        base = self._base
+        self._sparse = {base + index: value
+                        for index, value in enumerate(self._values)
+                        if value is not _MISSING}
+        self._values = []
+        self._base = 0
+
+    def __getitem__(self, op: Operation) -> T:
+        index = op.id - self._base
+        if 0 <= index < len(self._values):
+            value = self._values[index]
+            if value is not _MISSING:
+                return value
+        elif self._sparse is not None and op.id in self._sparse:
+            return self._sparse[op.id]
+        raise KeyError(op)
+
+    def __setitem__(self, op: Operation, value: T):
+        index = op.id - self._base
+        if 0 <= index < len(self._values):
+            self._values[index] = value
+        elif self._sparse is not None:
+            self._sparse[op.id] = value
+        else:
+            grown = self._index(op)
+            if grown is None:
+                self._sparse[op.id] = value     # type: ignore[index]
+            else:
+                self._values[grown] = value
+
+    def __delitem__(self, op: Operation):
+        self[op]    # raise KeyError if missing
+        if self._sparse is not None:
+            del self._sparse[op.id]
+        else:
+            self._values[op.id - self._base] = _MISSING
+
+    def __contains__(self, op: Operation) -> bool:
+        index = op.id - self._base
+        if 0 <= index < len(self._values):
+            return self._values[index] is not _MISSING
+        return self._sparse is not None and op.id in self._sparse
+
+    def get(self, op: Operation, default: Optional[T] = None) -> Optional[T]:
+        index = op.id - self._base
+        if 0 <= index < len(self._values):
+            value = self._values[index]
+            if value is not _MISSING:
+                return value
+        elif self._sparse is not None:
+            return self._sparse.get(op.id, default)
+        return default
+
+
+# an OpTable switches to a dict when its list would be more than
+# _SPARSE_FACTOR times as long as the number of entries, and longer
+# than _MIN_SPARSE_SPAN
+_SPARSE_FACTOR = 4
+_MIN_SPARSE_SPAN = 64
+
+
+def _is_sparse(entries: int, span: int) -> bool:
+    return span > _MIN_SPARSE_SPAN and span > _SPARSE_FACTOR * entries
+
+
 def bb_to_str(bb: Block, varprefix: str = "var") -> str:
     def arg_to_str(arg: Value):
         if isinstance(arg, Constant):
             return str(arg.value)
         else:
-            assert arg in varnames, "Basic block not valid"
+            assert isinstance(arg, Operation) and arg in varnames, \
+                "Basic block not valid"
             return varnames[arg]
 
-    varnames: dict[Value, str] = {}
+    varnames: OpTable[str] = OpTable()
     res = []
     for index, op in enumerate(bb):
         # give the operation a name used while
@@ -135,6 +655,89 @@ def bb_to_str(bb: Block, varprefix: str = "var") -> str:
     return "\n".join(res)
 
 
+_OP_LINE = re.compile(r"\s*([A-Za-z_]\w*)\s*=\s*([A-Za-z_]\w*)\((.*)\)\s*$")
+_INT = re.compile(r"[+-]?\d+$")
+
+
+class _BlockParser:
+    """Builds a Block from the lines of bb_to_str, one at a time"""
+
+    def __init__(self):
+        self.bb = Block()
+        self.ops: dict[str, Operation] = {}
+
+    def parse_line(self, line: str, lineno: int):
+        match = _OP_LINE.match(line)
+        if match is None:
+            raise ValueError(f"line {lineno}: expected 'var = op(args)': {line!r}")
+        var, name, arguments = match.groups()
+        if var in self.ops:
+            raise ValueError(f"line {lineno}: {var} is defined twice")
+        args: list[Value] = []
+        for arg in arguments.split(","):
+            arg = arg.strip()
+            if not arg:
+                if arguments.strip():
+                    raise ValueError(f"line {lineno}: empty argument")
+                continue
+            if _INT.match(arg):
+                args.append(Constant(int(arg)))
+            elif arg in self.ops:
+                args.append(self.ops[arg])
+            else:
+                raise ValueError(f"line {lineno}: {arg} is not defined")
+        op = Operation(name, args)
+        self.ops[var] = op
+        self.bb.append(op)
+
+
+def _code(line: str) -> str:
+    """line without its comment and surrounding whitespace"""
+    return line.partition("#")[0].strip()
+
+
+def str_to_bb(text: str) -> Block:
+    """Parse the output of bb_to_str back into a Block.
+
+    Any variable names can be used, as long as each one is defined
+    before it's used. Constants must be ints. Blank lines and `#`
+    comments are ignored.
+    """
+    parser = _BlockParser()
+    for lineno, line in enumerate(text.splitlines(), 1):
+        line = _code(line)
+        if line:
+            parser.parse_line(line, lineno)
+    return parser.bb
+
+
+def read_blocks(lines: Iterable[str]) -> Iterator[Block]:
+    """Lazily parse a trace file with many blocks, e.g.
+
+        with open("traces.txt") as f:
+            for bb in read_blocks(f):
+                ...
+
+    Blocks are in the format of str_to_bb and separated by one or
+    more blank lines. Only the block being parsed is held in memory.
+    """
+    parser = None
+    for lineno, line in enumerate(lines, 1):
+        if not line.strip():
+            if parser is not None:
+                yield parser.bb
+                parser = None
+            continue
+        line = _code(line)
+        if not line:
+            continue    # comment lines don't end a block
+        if parser is None:
+            parser = _BlockParser()
+        parser.parse_line(line, lineno)
+    if parser is not None:
+        yield parser.bb
+
+
 def check_dominance(bb: Block) -> bool:
     """Definition of a variable must dominate its usage"""
     # TODO: test this
@@ -149,3 +149,24 @@ class KnownBits:
         unknowns = self.unknowns | other.unknowns | val_borrows
         ones = diff_ones & ~unknowns
         return KnownBits(ones, unknowns)
+
+    def __lshift__(self, amount: int) -> "KnownBits":
+        """Shift by a known amount, the bits shifted in are 0"""
+        return KnownBits(self.ones << amount, self.unknowns << amount)
+
+    def may_be_ones(self) -> int:
+        """return an int where the bits that can be 1 are set"""
+        return self.ones | self.unknowns
+
+    def wrapped(self, width: int) -> "KnownBits":
+        """The known bits after wrapping to `width` bits two's
+        complement: the bits above the sign bit are copies of it"""
+        mask = (1 << width) - 1
+        sign = 1 << (width - 1)
+        ones = self.ones & mask
+        unknowns = self.unknowns & mask
+        if unknowns & sign:
+            unknowns |= ~mask
+        elif ones & sign:
+            ones |= ~mask
+        return KnownBits(ones, unknowns)
@@ -0,0 +1,155 @@
+from collections import OrderedDict
+from dataclasses import dataclass, asdict
+import hashlib
+import os
+import threading
+import time
+from typing import Any, Callable, Optional, Union
+
+from ir import Block, bit_width
+import serialize
+
+
+Pipeline = Callable[[Block], Block]
+
+
+def structural_hash(bb: Block) -> str:
+    """Hash of what bb computes, ignoring op identities: two blocks
+    have the same hash if their ops, with every argument resolved by
+    find() and numbered by position, and their constants are equal."""
+    return hashlib.blake2b(serialize.dumps(bb), digest_size=16).hexdigest()
+
+
+@dataclass
+class CacheStats:
+    hits: int = 0
+    # hits that had to be read from the directory
+    disk_hits: int = 0
+    misses: int = 0
+    evictions: int = 0
+    # time spent answering hits and running the pipeline on misses
+    hit_seconds: float = 0.0
+    miss_seconds: float = 0.0
+
+    @property
+    def lookups(self) -> int:
+        return self.hits + self.misses
+
+    @property
+    def hit_rate(self) -> float:
+        return self.hits / self.lookups if self.lookups else 0.0
+
+    @property
+    def average_hit_latency(self) -> float:
+        return self.hit_seconds / self.hits if self.hits else 0.0
+
+    @property
+    def average_miss_latency(self) -> float:
+        return self.miss_seconds / self.misses if self.misses else 0.0
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            **asdict(self),
+            "hit_rate": self.hit_rate,
+            "average_hit_latency": self.average_hit_latency,
+            "average_miss_latency": self.average_miss_latency,
+        }
+
+
+class OptimizationCache:
+    """Remembers the output of `pipeline` by the structural hash of
+    its input and the bit width it was optimized with.
+
+    The `maxsize` most recently used results are kept in memory,
+    encoded by `serialize`. With a `directory`, every result is also
+    written there and survives evictions and restarts. A hit returns a
+    fresh Block decoded from the cached result, so callers can go on
+    optimizing it; unlike running the pipeline, a hit leaves the input
+    block untouched. An OptimizationCache is a pass itself.
+    """
+
+    def __init__(self, pipeline: Pipeline, maxsize: int = 128,
+                 directory: Union[str, os.PathLike, None] = None):
+        if maxsize < 0:
+            raise ValueError("maxsize must be >= 0")
+        self.pipeline = pipeline
+        self.maxsize = maxsize
+        self.directory = directory
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+        self.stats = CacheStats()
+        self._entries: OrderedDict[str, bytes] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return f"OptimizationCache({self.pipeline!r}, maxsize={self.maxsize})"
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def optimize(self, bb: Block) -> Block:
+        start = time.perf_counter()
+        key = structural_hash(bb)
+        width = bit_width()
+        if width is not None:
+            key += f"-w{width}"
+        data = self._lookup(key)
+        if data is not None:
+            res = serialize.to_block(serialize.loads(data))
+            with self._lock:
+                self.stats.hits += 1
+                self.stats.hit_seconds += time.perf_counter() - start
+            return res
+
+        res = self.pipeline(bb)
+        self._store(key, serialize.dumps(res))
+        with self._lock:
+            self.stats.misses += 1
+            self.stats.miss_seconds += time.perf_counter() - start
+        return res
+
+    __call__ = optimize
+
+    def _path(self, key: str) -> str:
+        assert self.directory is not None
+        return os.path.join(self.directory, key + ".blk")
+
+    def _lookup(self, key: str) -> Optional[bytes]:
+        with self._lock:
+            data = self._entries.get(key)
+            if data is not None:
+                self._entries.move_to_end(key)
+                return data
+        if self.directory is None:
+            return None
+        try:
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        with self._lock:
+            self.stats.disk_hits += 1
+        self._remember(key, data)
+        return data
+
+    def _store(self, key: str, data: bytes):
+        self._remember(key, data)
+        if self.directory is not None:
+            # write and rename, so readers never see half a file
+            tmp = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, "wb") as f:
+                f.write(data)
+            os.replace(tmp, self._path(key))
+
+    def _remember(self, key: str, data: bytes):
+        with self._lock:
+            self._entries[key] = data
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.stats.evictions += 1
+
+    def clear(self):
+        """Forget the results kept in memory, not those on disk"""
+        with self._lock:
+            self._entries.clear()
@@ -0,0 +1,107 @@
+from concurrent.futures import ProcessPoolExecutor
+import traceback
+from typing import Callable, Iterable, Optional, Union
+
+from ir import Block, bit_width, bit_width_mode
+import serialize
+
+
+Pipeline = Callable[[Block], Block]
+
+
+class OptimizationError(Exception):
+    """Optimizing one of the blocks given to optimize_many failed.
+    Carries the formatted traceback of the original exception, which
+    may have been raised in another process."""
+
+    def __init__(self, index: int, message: str, details: str = ""):
+        super().__init__(index, message, details)
+        self.index = index
+        self.message = message
+        self.details = details
+
+    def __str__(self):
+        return f"block {self.index}: {self.message}"
+
+
+def _error(index: int, e: Exception) -> OptimizationError:
+    return OptimizationError(index, f"{type(e).__name__}: {e}",
+                             traceback.format_exc())
+
+
+def _optimize_one(pipeline: Pipeline, index: int, bb: Block) -> Union[Block, OptimizationError]:
+    try:
+        return pipeline(bb)
+    except Exception as e:
+        return _error(index, e)
+
+
+def _optimize_chunk(pipeline: Pipeline, chunk: list[tuple[int, bytes]],
+                    width: Optional[int] = None) -> list[Union[bytes, OptimizationError]]:
+    """Runs in a worker: decode, optimize and encode every block, with
+    the bit width of the caller"""
+    results: list[Union[bytes, OptimizationError]] = []
+    with bit_width_mode(width):
+        for index, data in chunk:
+            try:
+                bb = serialize.to_block(serialize.loads(data))
+                results.append(serialize.dumps(pipeline(bb)))
+            except Exception as e:
+                results.append(_error(index, e))
+    return results
+
+
+def optimize_many(blocks: Iterable[Block], pipeline: Pipeline,
+                  workers: Optional[int] = None,
+                  chunksize: int = 16) -> list[Union[Block, OptimizationError]]:
+    """Run pipeline over every block, in a pool of `workers` processes
+    (default: one per CPU).
+
+    Blocks travel to the workers and back in the `serialize` format,
+    `chunksize` blocks per task. pipeline must be picklable, e.g. a
+    module-level function or a PassManager of those. The results are
+    in the order of blocks; a block whose optimization raised gets an
+    OptimizationError instead, and the others are unaffected. The
+    optimized blocks are fresh copies, the inputs are left untouched.
+
+    With workers=1 everything runs in this process, without any
+    serialization, and the inputs are optimized in place like calling
+    pipeline on them directly. The workers use the bit width that is
+    current when optimize_many is called.
+    """
+    if chunksize < 1:
+        raise ValueError("chunksize must be >= 1")
+    if workers is not None and workers <= 1:
+        return [_optimize_one(pipeline, index, bb)
+                for index, bb in enumerate(blocks)]
+
+    results: list[Union[Block, OptimizationError, None]] = []
+    jobs: list[tuple[int, bytes]] = []
+    for index, bb in enumerate(blocks):
+        results.append(None)
+        try:
+            jobs.append((index, serialize.dumps(bb)))
+        except Exception as e:
+            results[index] = _error(index, e)
+
+    chunks = [jobs[start:start + chunksize]
+              for start in range(0, len(jobs), chunksize)]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_optimize_chunk, pipeline, chunk, bit_width())
+                   for chunk in chunks]
+        for chunk, future in zip(chunks, futures):
+            try:
+                chunk_results = future.result()
+            except Exception as e:
+                # the worker died or the pipeline didn't pickle, the
+                # whole chunk is lost
+                for index, _ in chunk:
+                    results[index] = OptimizationError(
+                        index, f"{type(e).__name__}: {e}")
+                continue
+            for (index, _), res in zip(chunk, chunk_results):
+                if isinstance(res, bytes):
+                    results[index] = serialize.to_block(serialize.loads(res))
+                else:
+                    results[index] = res
+    return results  # type: ignore[return-value]
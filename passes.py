@@ -1,189 +1,682 @@
-from typing import Dict, Tuple
-
-from ir import Value, Constant, Operation, Block
-from interpret import Obj, VirtualObj, get_num, argval
+import functools
+import operator
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Set, Union
+
+from ir import Value, Constant, Operation, Block, OpTable
+from ir import int_ops, lshift_int, wrap_int
+from interpret import Obj, VirtualObj, get_num
+from compact_block import CompactBlock, constant_key
+from rewrite import ALGEBRAIC_RULES, STRENGTH_REDUCTION_RULES, peephole_stream
+
+
+# How to evaluate the ops whose result only depends on their
+# arguments. constfold folds them when all their arguments are
+# constants, a new op only needs an entry here.
+_FOLD_OPS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "mul": operator.mul,
+    "lshift": lshift_int,
+    "bitand": operator.and_,
+}
+
+
+def _fold(op: Operation, args: list[Value],
+          emit: Callable[[Operation], object]) -> Optional[Value]:
+    """The value op is known to be equal to, or None: a Constant when
+    all of args are, or what an algebraic identity gives. Constants
+    are computed with the current bit width. The identities assume
+    the other operands are ints, see ALGEBRAIC_RULES."""
+    fold = _FOLD_OPS.get(op.name)
+    if fold is not None:
+        values = []
+        for arg in args:
+            if not isinstance(arg, Constant):
+                break
+            values.append(arg.value)
+        else:
+            try:
+                wrap = int_ops()[0]
+                return Constant(wrap(fold(*[wrap(value) for value in values])))
+            except (ArithmeticError, TypeError, ValueError):
+                return None     # e.g. negative shift, leave it to runtime
+    return ALGEBRAIC_RULES.rewrite(op, emit, args=args)
+
+
+def constfold_stream(ops: Iterable[Operation]) -> Iterator[Operation]:
+    """Fold ops with constant arguments and algebraic identities like
+    x + 0, and replace loads of a field by the constant stored there"""
+    # the constants known to be stored in fields
+    heap = CompileTimeHeap()
+    new_ops: list[Operation] = []
+    for op in ops:
+        match op.name:
+            case "store":
+                offset = get_num(op, 1)
+                # the store may alias the same offset of any other object
+                heap.invalidate_offset(offset)
+                value = op.arg(2)
+                if isinstance(value, Constant):
+                    heap.set(op.arg(0), offset, value)
+            case "load":
+                value = heap.get(op.arg(0), get_num(op, 1))
+                if value is not None:
+                    op.make_equal_to(value)
+                    continue
+            case _:
+                args = [arg.find() for arg in op.args]
+                res = _fold(op, args, new_ops.append)
+                if res is not None:
+                    op.make_equal_to(res)
+                    yield from new_ops
+                    new_ops.clear()
+                    continue
+        yield op
 
 
 def constfold(bb: Block) -> Block:
-    opt_bb = Block()
+    return Block(constfold_stream(bb))
 
-    for op in bb:
-        match op.name:
-            case "add":
-                arg0, arg1 = op.arg(0), op.arg(1)
-                if isinstance(arg0, Constant) and isinstance(arg1, Constant):
-                    op.make_equal_to(Constant(arg0.value + arg1.value))
-                    continue
-                else: 
-                    opt_bb.append(op)
-            case "mul":
-                arg0, arg1 = op.arg(0), op.arg(1)
-                if isinstance(arg0, Constant) and isinstance(arg1, Constant):
-                    op.make_equal_to(Constant(arg0.value * arg1.value))
-                    continue
-                else: 
-                    opt_bb.append(op)
-            case "lshift":
-                arg0, arg1 = op.arg(0), op.arg(1) 
-                if isinstance(arg0, Constant) and isinstance(arg1, Constant):
-                    op.make_equal_to(Constant(arg0.value << arg1.value))
-                    continue
-                else: 
-                    opt_bb.append(op)
-            case _: # TODO: handle other ops
-                opt_bb.append(op)
 
-    return opt_bb
 
 
+# ops whose result only depends on their arguments
+_PURE_OPS = {"add", "sub", "mul", "lshift", "bitand", "getarg"}
+_COMMUTATIVE_OPS = {"add", "mul", "bitand"}
 
 
-def cse(bb: Block) -> Block:
-    """Common Subexpression Elimination"""
-    opt_bb = Block()
+def _arg_key(arg: Value) -> Any:
+    """arg in a value number key: Constants by type and bits, 0.0 and
+    -0.0 or 1 and 1.0 compute different things"""
+    if not isinstance(arg, Constant):
+        return arg
+    try:
+        return constant_key(arg.value)
+    except TypeError:   # unhashable, only equal to itself
+        return (Constant, id(arg))
+
+
+def _value_number_key(op: Operation,
+                      args: Optional[list[Value]] = None) -> tuple:
+    """Key under which equivalent pure ops are found by cse(). args
+    are the representatives of the arguments of op, if the caller has
+    them already."""
+    if args is None:
+        args = [op.arg(i) for i in range(len(op.args))]
+    key = tuple([_arg_key(arg) for arg in args])
+    if op.name in _COMMUTATIVE_OPS and hash(key[1]) < hash(key[0]):
+        # canonical order, so add(a, b) and add(b, a) share a key.
+        # Unequal args with the same hash keep their order, which
+        # can only miss an elimination, never make a wrong one.
+        key = (key[1], key[0])
+    return (op.name, key)
 
-    def _find_prev_op(op_name, arg0, arg1, bb):
-        for op in bb:
-            if op.name != op_name:
+
+def cse_stream(ops: Iterable[Operation]) -> Iterator[Operation]:
+    """Common Subexpression Elimination"""
+    # Key: (opname, representatives of the args)
+    # Value: the first op emitted computing it
+    value_numbers: Dict[tuple, Operation] = {}
+
+    for op in ops:
+        if op.name in _PURE_OPS:
+            key = _value_number_key(op)
+            prev_op = value_numbers.get(key)
+            if prev_op is not None:
+                op.make_equal_to(prev_op)
                 continue
-            if (op.arg(0) == arg0 and op.arg(1) == arg1) or \
-               (op.arg(0) == arg1 and op.arg(1) == arg0):
-                return op
-        return None
-    
-    for op in bb: 
-        match op.name:
-            case "add" | "mul" | "lshift":
-                arg0, arg1 = op.arg(0), op.arg(1)
-                prev_op = _find_prev_op(op.name, arg0, arg1, opt_bb)
-                if prev_op is not None:
-                    op.make_equal_to(prev_op)
-                    continue
-                else:
-                    opt_bb.append(op)
-            case _: # TODO: handle other ops
-                opt_bb.append(op)
+            value_numbers[key] = op
+        yield op
 
-    return opt_bb
 
+def cse(bb: Block) -> Block:
+    """Common Subexpression Elimination"""
+    return Block(cse_stream(bb))
+
+
+# What lower_mul_stream may emit, relative to an add. Measured on
+# interpret() and execute(): dispatching an op costs far more than the
+# arithmetic, so a mul is only worth replacing by a single op.
+INTERPRETER_COSTS = {"add": 1.0, "sub": 1.0, "lshift": 1.0, "mul": 1.2}
+# cycles on a typical CPU
+MACHINE_COSTS = {"add": 1.0, "sub": 1.0, "lshift": 1.0, "mul": 3.0}
+
+# factors from here on are left to mul
+_MAX_MUL_FACTOR = 2**64
+# the plans of factors with more bits aren't searched, they come from
+# _naf_plan
+_SEARCH_BITS = 24
+
+# A plan computes factor * x: _X is x itself, _ZERO is 0, otherwise
+# (opname, plan, plan) or ("lshift", plan, amount). Equal subplans are
+# emitted once.
+_X = ("x",)
+_ZERO = ("zero",)
+
+
+def _evaluate_plan(plan: tuple, x: int) -> int:
+    if plan == _X:
+        return x
+    if plan == _ZERO:
+        return 0
+    name, arg0, arg1 = plan
+    if name == "lshift":
+        return _evaluate_plan(arg0, x) << arg1
+    return _FOLD_OPS[name](_evaluate_plan(arg0, x), _evaluate_plan(arg1, x))
+
+
+def _cheapest_plan(factor: int, costs: dict[str, float], budget: float,
+                   memo: dict[int, tuple[float, Optional[tuple]]]) -> Optional[tuple[float, tuple]]:
+    """(cost, plan) of the cheapest shift/add/sub sequence found for
+    factor * x, or None if it doesn't cost less than budget. Subplans
+    only get what is left of the budget, so the search is as deep as
+    the number of ops that fit in it."""
+    if budget <= 0:
+        return None
+    known = memo.get(factor)
+    if known is not None:
+        searched, best = known
+        if best is not None:
+            return best if best[0] < budget else None
+        if budget <= searched:
+            return None
+    if factor == 0:
+        best = (0.0, _ZERO)
+    elif factor == 1:
+        best = (0.0, _X)
+    else:
+        candidates: list[tuple[float, tuple]] = []
+
+        def consider(cost: float, sub_factor: int, make: Callable[[tuple], tuple]):
+            """A plan of one more op costing cost on top of the plan of
+            sub_factor"""
+            sub = _cheapest_plan(sub_factor, costs, budget - cost, memo)
+            if sub is not None:
+                candidates.append((sub[0] + cost, make(sub[1])))
+
+        if factor < 0:
+            consider(costs["sub"], -factor, lambda plan: ("sub", _ZERO, plan))
+            # x - (1 - factor) * x, e.g. x - (x << 2) for -3
+            consider(costs["sub"], 1 - factor, lambda plan: ("sub", _X, plan))
+        elif factor % 2 == 0:
+            shift = (factor & -factor).bit_length() - 1
+            consider(costs["lshift"], factor >> shift,
+                     lambda plan: ("lshift", plan, shift))
+        else:
+            consider(costs["add"], factor - 1, lambda plan: ("add", plan, _X))
+            consider(costs["sub"], factor + 1, lambda plan: ("sub", plan, _X))
+            # y * (2**k +- 1) == (y << k) +- y, with y = factor // (2**k +- 1)
+            for shift in range(2, factor.bit_length() + 1):
+                for name, divisor in (("sub", (1 << shift) - 1),
+                                      ("add", (1 << shift) + 1)):
+                    if divisor < factor and factor % divisor == 0:
+                        consider(costs["lshift"] + costs[name], factor // divisor,
+                                 lambda plan: (name, ("lshift", plan, shift), plan))
+        best = min(candidates, key=lambda entry: entry[0]) if candidates else None
+    memo[factor] = (budget, best)
+    return best
+
+
+def _naf_plan(factor: int, costs: dict[str, float]) -> tuple[float, tuple]:
+    """(cost, plan) adding and subtracting x << k for every nonzero
+    digit of the non-adjacent form of factor. Linear in the bits of
+    factor, but often dearer than what _cheapest_plan finds."""
+    terms: list[tuple[int, tuple]] = []
+    shift = 0
+    while factor:
+        if factor & 1:
+            digit = 2 - (factor & 3)    # 1 or -1, the next bit is 0
+            terms.append((digit, _X if shift == 0 else ("lshift", _X, shift)))
+            factor -= digit
+        factor >>= 1
+        shift += 1
+    cost = costs["lshift"] * sum(term != _X for _, term in terms)
+    # the highest digit first, it's positive for positive factors
+    digit, plan = terms.pop()
+    if digit < 0:
+        plan = ("sub", _ZERO, plan)
+        cost += costs["sub"]
+    for digit, term in reversed(terms):
+        name = "add" if digit > 0 else "sub"
+        plan = (name, plan, term)
+        cost += costs[name]
+    return cost, plan
+
+
+@functools.lru_cache(maxsize=1024)
+def _mul_plan(factor: int, costs: tuple[tuple[str, float], ...]) -> Optional[tuple[float, tuple]]:
+    """(cost, plan) for factor * x cheaper than a mul, or None"""
+    cost_of = dict(costs)
+    if factor.bit_length() <= _SEARCH_BITS:
+        found = _cheapest_plan(factor, cost_of, cost_of["mul"], {})
+    else:
+        found = _naf_plan(factor, cost_of)
+        if found[0] >= cost_of["mul"]:
+            found = None
+    assert found is None or _evaluate_plan(found[1], 1) == factor, "wrong plan for mul"
+    return found
+
+
+def _lower_mul(x: Value, factor: int,
+               costs: dict[str, float]) -> Optional[tuple[list[Operation], Value]]:
+    """The new ops computing x * factor and the value holding the
+    result, or None if a mul is cheaper under costs"""
+    if abs(factor) >= _MAX_MUL_FACTOR:
+        return None
+    found = _mul_plan(factor, tuple(sorted(costs.items())))
+    if found is None:
+        return None
+    cost, plan = found
+    ops: list[Operation] = []
+    built: dict[tuple, Value] = {_X: x, _ZERO: Constant(0)}
+
+    def build(plan: tuple) -> Value:
+        res = built.get(plan)
+        if res is None:
+            name, arg0, arg1 = plan
+            arg1 = Constant(arg1) if name == "lshift" else build(arg1)
+            res = built[plan] = Operation(name, [build(arg0), arg1])
+            ops.append(res)
+        return res
+
+    return ops, build(plan)
+
+
+def _mul_by_constant(op: Operation) -> Optional[tuple[Value, int]]:
+    """(x, factor) if op is a mul of a non-constant x by an int, the
+    factor wrapped to the bit width"""
+    if op.name != "mul":
+        return None
+    x, factor = op.arg(0), op.arg(1)
+    if isinstance(x, Constant):
+        x, factor = factor, x
+    if isinstance(x, Constant) or not isinstance(factor, Constant) \
+            or type(factor.value) is not int:
+        return None
+    return x, wrap_int(factor.value)
+
+
+def lower_mul_stream(ops: Iterable[Operation],
+                     costs: dict[str, float] = INTERPRETER_COSTS) -> Iterator[Operation]:
+    """Replace muls by a constant with shifts, adds and subs where
+    that's cheaper according to costs"""
+    for op in ops:
+        mul = _mul_by_constant(op)
+        if mul is not None:
+            lowered = _lower_mul(*mul, costs)
+            if lowered is not None:
+                new_ops, res = lowered
+                op.make_equal_to(res)
+                yield from new_ops
+                continue
+        yield op
 
-def strength_reduce(bb: Block) -> Block:
-    opt_bb = Block()
 
-    for op in bb:
-        match op.name:
-            case "add":
-                arg0, arg1 = op.arg(0), op.arg(1)
-                if arg0 is arg1:
-                    new_op = opt_bb.lshift(arg0, 1)
-                    op.make_equal_to(new_op)
-                    continue
-                else:
-                    opt_bb.append(op)
-            case "mul":
-                # TODO: multiply by power of 2 -> left shift
-                opt_bb.append(op)
-            case _: # TODO: handle other ops
-                opt_bb.append(op)
+def strength_reduce_stream(ops: Iterable[Operation],
+                           costs: dict[str, float] = INTERPRETER_COSTS) -> Iterator[Operation]:
+    return lower_mul_stream(peephole_stream(ops, STRENGTH_REDUCTION_RULES), costs)
 
-    return opt_bb
 
+def strength_reduce(bb: Block, costs: dict[str, float] = INTERPRETER_COSTS) -> Block:
+    return Block(strength_reduce_stream(bb, costs))
 
-def _materialize(bb: Block, value: Value):
+
+def _materialize(value: Value, virtuals: OpTable[VirtualObj]) -> Iterator[Operation]:
+    """The ops that rebuild the virtual object value (if it is one)
+    and the virtual objects it references"""
     if isinstance(value, Constant):
         return
 
     assert isinstance(value, Operation)
-    info = value.info
-    if info is None: # already materialized
+    info = virtuals.get(value)
+    if info is None: # not virtual or already materialized
         return 
 
-    bb.append(value)
-    value.info = None
+    yield value
+    del virtuals[value]
     for i, val in sorted(info.content.items()):
-        _materialize(bb, val)
-        bb.store(value, i, val)
+        yield from _materialize(val, virtuals)
+        yield Operation("store", [value, Constant(i), val])
 
 
-def alloc_removal(bb: Block) -> Block:
-    opt_bb = Block()
+def _virtual(virtuals: OpTable[VirtualObj], value: Value) -> Optional[VirtualObj]:
+    if isinstance(value, Operation):
+        return virtuals.get(value)
+    return None
 
-    for op in bb:
+
+def alloc_removal_stream(ops: Iterable[Operation]) -> Iterator[Operation]:
+    """Removes allocations that don't escape. The ops of an object
+    are held back until it escapes, if it ever does."""
+    # the allocs removed so far and not materialized again
+    virtuals: OpTable[VirtualObj] = OpTable()
+
+    for op in ops:
         match op.name:
             case "alloc":
-                op.info = VirtualObj()
+                virtuals[op] = VirtualObj()
             case "load":
-                info = op.arg(0).info
+                info = _virtual(virtuals, op.arg(0))
                 if info is not None: # virtual object
-                    print(f"{info=}")
                     field = get_num(op, 1)
                     op.make_equal_to(info.load(field))
                 else:
                     for arg in op.args:
-                        _materialize(opt_bb, arg.find())
-                    opt_bb.append(op)
+                        yield from _materialize(arg.find(), virtuals)
+                    yield op
             case "store":
-                info = op.arg(0).info
+                info = _virtual(virtuals, op.arg(0))
                 if info is not None: # virtual object
                     field = get_num(op, 1)
                     value = op.arg(2)
                     info.store(field, value)
                 else:
                     for arg in op.args:
-                        _materialize(opt_bb, arg.find())
-                    opt_bb.append(op)
+                        yield from _materialize(arg.find(), virtuals)
+                    yield op
             case _:
                 for arg in op.args:
-                    _materialize(opt_bb, arg.find())
-                opt_bb.append(op)
-
-    return opt_bb
+                    yield from _materialize(arg.find(), virtuals)
+                yield op
 
 
-def optimize_load_store(bb: Block) -> Block:
-    opt_bb = Block()
-
-    # Model the heap at compile time 
-    # Key: (object, offset) pair. Offset is address of obj 
-    # Value: a prev SSA value we know exists at that address
-    compile_time_heap: Dict[Tuple[Value, int], Value] = {}
-
-    def _eq_value(left: Value | None, right: Value) -> bool:
-        if isinstance(left, Constant) and isinstance(right, Constant):
-            return left.value == right.value
-        else:
-            return left is right
-
-    for op in bb: 
+def alloc_removal(bb: Block) -> Block:
+    return Block(alloc_removal_stream(bb))
+
+
+class CompileTimeHeap:
+    """Model of the heap at compile time: the SSA value we know is
+    stored at an (object, offset) pair.
+
+    Entries are indexed by offset first, because a store to an offset
+    may alias that offset of any other object and has to invalidate
+    all of them, but nothing else. A secondary index lists the known
+    offsets of each object.
+    """
+
+    def __init__(self):
+        self._by_offset: Dict[int, Dict[Value, Value]] = {}
+        self._by_object: Dict[Value, Set[int]] = {}
+
+    def __len__(self) -> int:
+        return sum(len(entries) for entries in self._by_offset.values())
+
+    def get(self, obj: Value, offset: int) -> Optional[Value]:
+        entries = self._by_offset.get(offset)
+        if entries is None:
+            return None
+        return entries.get(obj)
+
+    def set(self, obj: Value, offset: int, value: Value):
+        self._by_offset.setdefault(offset, {})[obj] = value
+        self._by_object.setdefault(obj, set()).add(offset)
+
+    def invalidate_offset(self, offset: int):
+        """Forget the value at `offset` of every object"""
+        entries = self._by_offset.pop(offset, None)
+        if entries is None:
+            return
+        for obj in entries:
+            offsets = self._by_object[obj]
+            offsets.discard(offset)
+            if not offsets:
+                del self._by_object[obj]
+
+    def fields(self, obj: Value) -> Dict[int, Value]:
+        """All the known (offset: value) pairs of `obj`"""
+        return {
+            offset: self._by_offset[offset][obj]
+            for offset in self._by_object.get(obj, ())
+        }
+
+
+def optimize_load_store_stream(ops: Iterable[Operation]) -> Iterator[Operation]:
+    compile_time_heap = CompileTimeHeap()
+
+    for op in ops: 
         if op.name == "store":
             obj = op.arg(0)
             offset = get_num(op, 1)
             new_val = op.arg(2)
-            store_info = (obj, offset)
-            curr_val = compile_time_heap.get(store_info)
+            curr_val = compile_time_heap.get(obj, offset)
 
-            # Re-model the heap 
-            compile_time_heap = {
-                (obj, offset_): val 
-                for (obj, offset_), val in compile_time_heap.items() 
-                if offset_ != offset
-            }
+            # Re-model the heap: the store may alias the same
+            # offset of any other object
+            compile_time_heap.invalidate_offset(offset)
 
-            if _eq_value(curr_val, new_val):
+            # equal ints are the same interned Constant
+            if curr_val is new_val:
                 continue
 
             # Update new info from store
-            compile_time_heap[(obj, offset)] = new_val
+            compile_time_heap.set(obj, offset, new_val)
         elif op.name == "load":
             obj = op.arg(0)
             offset = get_num(op, 1)
-            load_info = (obj, offset)
-            if prev := compile_time_heap.get(load_info):
+            if prev := compile_time_heap.get(obj, offset):
                 op.make_equal_to(prev)
                 continue
 
-            compile_time_heap[load_info] = op
+            compile_time_heap.set(obj, offset, op)
         
+        yield op
+
+
+def optimize_load_store(bb: Block) -> Block:
+    return Block(optimize_load_store_stream(bb))
+
+
+StreamPass = Callable[[Iterable[Operation]], Iterator[Operation]]
+
+
+def stream(ops: Iterable[Operation], *passes: StreamPass) -> Iterator[Operation]:
+    """Chain streaming passes over ops, e.g.
+
+        for op in stream(recorder, constfold_stream, cse_stream):
+            ...
+
+    Every op runs through all the passes before the next one is taken
+    from ops, so ops can still be being recorded. Only
+    alloc_removal_stream holds ops back, those of the objects that
+    haven't escaped yet.
+    """
+    for opt in passes:
+        ops = opt(ops)
+    return iter(ops)
+
+
+def fused_optimize(bb: Block) -> Block:
+    """constfold, cse, strength_reduce, alloc_removal and
+    optimize_load_store in a single forward walk over bb.
+
+    All the passes share their state, so each one sees what the others
+    found out about earlier ops: e.g. loads from virtual objects turn
+    into constants that are folded right away, and ops created by
+    strength reduction are value numbered, too. Time-wise it's only a
+    little ahead of running the passes one by one (~10% in
+    `bench.py fused`), and the shared state makes its peak memory ~50%
+    higher.
+    """
+    opt_bb = Block()
+    value_numbers: Dict[tuple, Operation] = {}
+    heap = CompileTimeHeap()
+    virtuals: OpTable[VirtualObj] = OpTable()
+
+    def materialize(value: Value):
+        info = _virtual(virtuals, value)
+        if info is None:
+            return
+        assert isinstance(value, Operation)
+        opt_bb.append(value)
+        del virtuals[value]
+        for i, val in sorted(info.content.items()):
+            materialize(val)
+            emit_store(Operation("store", [value, Constant(i), val]))
+
+    def emit_store(op: Operation):
+        obj, offset, new_val = op.arg(0), get_num(op, 1), op.arg(2)
+        curr_val = heap.get(obj, offset)
+        heap.invalidate_offset(offset)
+        if curr_val is new_val:
+            return
+        heap.set(obj, offset, new_val)
         opt_bb.append(op)
 
+    for op in bb:
+        name = op.name
+        if name == "alloc":
+            virtuals[op] = VirtualObj()
+            continue
+
+        args = [op.arg(i) for i in range(len(op.args))]
+        if name == "load" or name == "store":
+            obj, offset = args[0], get_num(op, 1)
+            virtual = _virtual(virtuals, obj)
+            if name == "load":
+                if virtual is not None:
+                    op.make_equal_to(virtual.load(offset))
+                    continue
+                prev = heap.get(obj, offset)
+                if prev is not None:
+                    op.make_equal_to(prev)
+                    continue
+                heap.set(obj, offset, op)
+                opt_bb.append(op)
+            elif virtual is not None:
+                virtual.store(offset, args[2])
+            else:
+                materialize(args[2])
+                emit_store(op)
+            continue
+
+        for arg in args:
+            if isinstance(arg, Operation) and arg in virtuals:
+                materialize(arg)
+
+        res = _fold(op, args, opt_bb.append)
+        if res is not None:
+            op.make_equal_to(res)
+            continue
+
+        mul = _mul_by_constant(op)
+        lowered = _lower_mul(*mul, INTERPRETER_COSTS) if mul is not None else None
+        if lowered is not None:
+            new_ops, res = lowered
+            for new_op in new_ops:
+                key = _value_number_key(new_op)
+                prev_op = value_numbers.get(key)
+                if prev_op is not None:
+                    new_op.make_equal_to(prev_op)
+                    continue
+                value_numbers[key] = new_op
+                opt_bb.append(new_op)
+            op.make_equal_to(res.find())
+            continue
+
+        new_op = op
+        if name == "add" and args[0] is args[1]:
+            args = [args[0], Constant(1)]
+            new_op = Operation("lshift", args)
+
+        if new_op.name in _PURE_OPS:
+            key = _value_number_key(new_op, args)
+            prev_op = value_numbers.get(key)
+            if prev_op is not None:
+                op.make_equal_to(prev_op)
+                continue
+            value_numbers[key] = new_op
+
+        opt_bb.append(new_op)
+        if new_op is not op:
+            op.make_equal_to(new_op)
+
     return opt_bb
+
+
+# ops without side effects, dead when nothing uses their result
+_REMOVABLE_OPS = {"getarg", "alloc", "load", "add", "sub", "mul", "lshift",
+                  "bitand"}
+
+
+def _local_allocs(bb: Block) -> Set[Operation]:
+    """The allocs that never escape: they are only ever
+    used as the object of a load or store"""
+    allocs: Set[Operation] = set()
+    escaped: Set[Operation] = set()
+    for op in bb:
+        if op.name == "alloc":
+            allocs.add(op)
+        for i in range(len(op.args)):
+            arg = op.arg(i)
+            if isinstance(arg, Operation) and \
+                    not (i == 0 and op.name in ("load", "store")):
+                escaped.add(arg)
+    return allocs - escaped
+
+
+def dce(bb: Block) -> Block:
+    """Dead Code Elimination
+
+    Walks bb backwards, starting from the ops with side effects:
+    print, escape, ops we know nothing about and stores to objects
+    that escape. A store to a local object only stays if a later kept
+    load reads that field before another store overwrites it.
+    Everything else is kept only if a kept op uses it.
+    """
+    local_allocs = _local_allocs(bb)
+    live: OpTable[bool] = OpTable(bb, False)
+    # (local object, offset) read by a kept load further down
+    live_fields: Set[tuple[Operation, int]] = set()
+    kept = []
+
+    for op in reversed(bb):
+        if op.name == "store" and op.arg(0) in local_allocs:
+            field = (op.arg(0), get_num(op, 1))
+            if field not in live_fields:
+                continue
+            live_fields.discard(field)  # earlier stores are overwritten
+        elif op.name in _REMOVABLE_OPS:
+            if not live[op]:
+                continue
+            if op.name == "load" and op.arg(0) in local_allocs:
+                live_fields.add((op.arg(0), get_num(op, 1)))
+        kept.append(op)
+        for i in range(len(op.args)):
+            arg = op.arg(i)
+            if isinstance(arg, Operation):
+                live[arg] = True
+
+    return Block(reversed(kept))
+
+
+def compact_stream(ops: Iterable[Operation]) -> Iterator[Operation]:
+    """Streaming part of compact(): rewrites the arguments of every op
+    to their representatives as it passes by, so the ops optimized
+    away upstream can be freed while the stream is still running.
+    Must come after the passes that can replace the ops it sees."""
+    for op in ops:
+        args = op.args
+        for i in range(len(args)):
+            args[i] = args[i].find()
+        yield op
+
+
+def compact(bb: Union[Block, CompactBlock]) -> Union[Block, CompactBlock]:
+    """Cut bb loose from the ops optimized away before it.
+
+    Rewrites the arguments of every op to their representatives and
+    clears the forwarding of the ops of bb, so nothing in bb reaches
+    the unoptimized ops any more and they can be garbage collected.
+    Works in place and returns bb, so it can end a pipeline.
+    CompactBlocks are returned unchanged: their arguments are columns
+    that can't be rewritten in place, so their forwarding has to stay.
+    """
+    if isinstance(bb, CompactBlock):
+        return bb
+    for op in compact_stream(bb):
+        pass
+    for op in bb:
+        op._forwarded = None
+    if bb.track_uses:
+        bb.rebuild_uses()   # drop the users that were replaced
+    return bb
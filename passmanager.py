@@ -0,0 +1,103 @@
+from dataclasses import dataclass, field, asdict
+import json
+import time
+from typing import Any, Callable, Sequence
+
+from ir import Block, union_find_stats
+
+
+Pass = Callable[[Block], Block]
+
+
+@dataclass
+class PassStats:
+    """What one run of one pass did"""
+    name: str
+    iteration: int
+    seconds: float
+    ops_in: int
+    ops_out: int
+    # make_equal_to calls, i.e. ops replaced by another value
+    rewrites: int
+    finds: int
+    average_chain: float
+    max_chain: int
+
+
+@dataclass
+class PipelineStats:
+    iterations: int = 0
+    passes: list[PassStats] = field(default_factory=list)
+
+    @property
+    def seconds(self) -> float:
+        return sum(p.seconds for p in self.passes)
+
+    def as_dict(self) -> dict[str, Any]:
+        return {
+            "iterations": self.iterations,
+            "seconds": self.seconds,
+            "ops_in": self.passes[0].ops_in if self.passes else 0,
+            "ops_out": self.passes[-1].ops_out if self.passes else 0,
+            "passes": [asdict(p) for p in self.passes],
+        }
+
+    def to_json(self, **kwargs) -> str:
+        return json.dumps(self.as_dict(), **kwargs)
+
+
+class PassManager:
+    """Run a pipeline of passes over a Block, recording statistics.
+
+    With `fixed_point`, the whole pipeline is repeated while it keeps
+    making the block smaller, at most `max_iterations` times. The
+    statistics of the last run are in `stats`. A PassManager is a
+    pass itself, so pipelines can be nested.
+    """
+
+    def __init__(self, passes: Sequence[Pass], fixed_point: bool = False,
+                 max_iterations: int = 10):
+        self.passes = list(passes)
+        self.fixed_point = fixed_point
+        self.max_iterations = max_iterations
+        self.stats = PipelineStats()
+
+    def __repr__(self):
+        names = ", ".join(_pass_name(p) for p in self.passes)
+        return f"PassManager([{names}], fixed_point={self.fixed_point})"
+
+    def run(self, bb: Block) -> Block:
+        self.stats = stats = PipelineStats()
+        for iteration in range(self.max_iterations):
+            stats.iterations += 1
+            ops_before = len(bb)
+            for opt in self.passes:
+                bb = self._run_pass(opt, bb, iteration)
+            if not self.fixed_point or len(bb) >= ops_before:
+                break
+        return bb
+
+    __call__ = run
+
+    def _run_pass(self, opt: Pass, bb: Block, iteration: int) -> Block:
+        ops_in = len(bb)
+        with union_find_stats() as uf:
+            start = time.perf_counter()
+            opt_bb = opt(bb)
+            seconds = time.perf_counter() - start
+        self.stats.passes.append(PassStats(
+            name=_pass_name(opt),
+            iteration=iteration,
+            seconds=seconds,
+            ops_in=ops_in,
+            ops_out=len(opt_bb),
+            rewrites=uf.unions,
+            finds=uf.finds,
+            average_chain=uf.average_length,
+            max_chain=uf.max_length,
+        ))
+        return opt_bb
+
+
+def _pass_name(opt: Pass) -> str:
+    return getattr(opt, "__name__", None) or repr(opt)
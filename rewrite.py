@@ -0,0 +1,478 @@
+"""Peephole rewrites written in a small rule language:
+
+    add(x, 0) -> x
+    add(x, x) -> lshift(x, 1)
+    mul(x, C) -> lshift(x, {C.bit_length() - 1}) if C > 1 and C & (C - 1) == 0
+
+Left of `->` is a pattern, an op whose arguments are
+- lowercase names: any value. The same name twice must be the same
+  value.
+- uppercase names: any constant, the name is bound to its value
+- int literals: exactly that int constant, 0 doesn't match 0.0 or
+  False
+Right of it is the replacement: a name of the pattern, an int
+literal, a `{python expression}` of the constants of the pattern, or
+a new op of those. An optional `if` guard is a python expression of
+the constants, the rule only fires when it's true. Computed constants
+are wrapped to the current bit width.
+
+Names match operands of any type, nothing is known about the type of
+e.g. a getarg. The rules below, like the passes using them, treat
+every operand as an int: `mul(x, 0) -> 0` is wrong for x = -2.5, whose
+product is -0.0, and `sub(x, x) -> 0` for an infinite x. Blocks
+computing with floats must not be optimized with them.
+"""
+import ast
+from collections import Counter
+import keyword
+import re
+from typing import Any, Callable, Iterable, Iterator, Optional, Union
+
+from ir import Block, Constant, Operation, Value, wrap_int
+
+
+class RuleError(ValueError):
+    """A rule that doesn't parse"""
+
+
+class Var:
+    """Lowercase name: matches any value"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Const:
+    """Uppercase name: matches any constant"""
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+class Literal:
+    def __init__(self, value: int):
+        self.value = value
+
+
+class Expr:
+    """`{...}` in a replacement, computes a constant"""
+
+    def __init__(self, source: str):
+        self.source = source
+        try:
+            self.code = compile(source, "<rule>", "eval")
+        except SyntaxError as e:
+            raise RuleError(f"invalid expression {{{source}}}: {e}") from e
+
+
+class OpPattern:
+    def __init__(self, name: str, args: list):
+        self.name = name
+        self.args = args
+
+
+# the names usable in guards and {expressions}, besides the constants
+_EVAL_GLOBALS = {"__builtins__": {}, "abs": abs, "min": min, "max": max}
+
+_TOKEN = re.compile(r"\s*(?:(?P<int>[+-]?\d+)|(?P<name>[A-Za-z_]\w*)"
+                    r"|(?P<expr>\{[^{}]*\})|(?P<punct>[(),]))")
+
+
+def _tokenize(text: str) -> list[tuple[str, str]]:
+    tokens = []
+    pos = 0
+    text = text.rstrip()
+    while pos < len(text):
+        match = _TOKEN.match(text, pos)
+        if match is None:
+            raise RuleError(f"unexpected {text[pos:].strip()!r}")
+        kind = match.lastgroup
+        assert kind is not None
+        tokens.append((kind, match.group(kind)))
+        pos = match.end()
+    return tokens
+
+
+def _parse_term(tokens: list[tuple[str, str]], pos: int, pattern: bool):
+    """Parse one argument or op at tokens[pos], return (node, next pos)"""
+    if pos >= len(tokens):
+        raise RuleError("unexpected end of rule")
+    kind, text = tokens[pos]
+    if kind == "int":
+        return Literal(int(text)), pos + 1
+    if kind == "expr":
+        if pattern:
+            raise RuleError(f"{text} can only be used in replacements")
+        return Expr(text[1:-1].strip()), pos + 1
+    if kind != "name" or keyword.iskeyword(text):
+        raise RuleError(f"unexpected {text!r}")
+    if pos + 1 < len(tokens) and tokens[pos + 1] == ("punct", "("):
+        args: list = []
+        pos += 2
+        while tokens[pos:pos + 1] != [("punct", ")")]:
+            if args:
+                if tokens[pos:pos + 1] != [("punct", ",")]:
+                    raise RuleError(f"expected ',' in arguments of {text}")
+                pos += 1
+            arg, pos = _parse_term(tokens, pos, pattern)
+            if pattern and isinstance(arg, OpPattern):
+                raise RuleError("patterns can't be nested")
+            args.append(arg)
+        return OpPattern(text, args), pos + 1
+    if text[0].isupper():
+        return Const(text), pos + 1
+    return Var(text), pos + 1
+
+
+def _parse(text: str, pattern: bool):
+    tokens = _tokenize(text)
+    node, pos = _parse_term(tokens, 0, pattern)
+    if pos != len(tokens):
+        raise RuleError(f"unexpected {tokens[pos][1]!r}")
+    return node
+
+
+def _split_guard(text: str) -> tuple[str, Optional[str]]:
+    """Split the replacement from the guard, at the first ` if ` that
+    isn't inside braces"""
+    depth = 0
+    for i, char in enumerate(text):
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+        elif depth == 0 and text.startswith(" if ", i):
+            return text[:i], text[i + 4:]
+    return text, None
+
+
+def _names(node) -> Iterator[Union[Var, Const]]:
+    if isinstance(node, OpPattern):
+        for arg in node.args:
+            yield from _names(arg)
+    elif isinstance(node, (Var, Const)):
+        yield node
+
+
+def _exprs(node) -> Iterator[Expr]:
+    if isinstance(node, OpPattern):
+        for arg in node.args:
+            yield from _exprs(arg)
+    elif isinstance(node, Expr):
+        yield node
+
+
+def _free_names(source: str) -> set[str]:
+    """The names the python expression source reads without binding
+    them itself. Not co_names, that has attribute names as well."""
+    tree = ast.parse(source, mode="eval")
+    read: set[str] = set()
+    bound: set[str] = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Name):
+            (read if isinstance(node.ctx, ast.Load) else bound).add(node.id)
+        elif isinstance(node, ast.arg):
+            bound.add(node.arg)
+    return read - bound
+
+
+class Rule:
+    """One parsed rule. `pattern` is an OpPattern whose arguments are
+    Vars, Consts and Literals."""
+
+    def __init__(self, text: str):
+        self.text = text
+        if "->" not in text:
+            raise RuleError(f"missing '->' in {text!r}")
+        lhs, rhs = text.split("->", 1)
+        self.pattern = _parse(lhs, pattern=True)
+        if not isinstance(self.pattern, OpPattern):
+            raise RuleError(f"the pattern of {text!r} must be an op")
+        replacement, guard = _split_guard(rhs)
+        self.replacement = _parse(replacement, pattern=False)
+        self.guard = guard.strip() if guard else None
+
+        bound = {node.name for node in _names(self.pattern)}
+        for node in _names(self.replacement):
+            if node.name not in bound:
+                raise RuleError(f"{node.name} is not bound by the pattern of {text!r}")
+        sources = [expr.source for expr in _exprs(self.replacement)]
+        if self.guard is not None:
+            try:
+                compile(self.guard, "<rule>", "eval")
+            except SyntaxError as e:
+                raise RuleError(f"invalid guard in {text!r}: {e}") from e
+            sources.append(self.guard)
+        # guards and expressions only see the constants, NameError
+        # when a rule is tried would be too late
+        usable = {node.name for node in _names(self.pattern)
+                  if isinstance(node, Const)} | _EVAL_GLOBALS.keys()
+        for source in sources:
+            unknown = _free_names(source) - usable
+            if unknown:
+                raise RuleError(f"{', '.join(sorted(unknown))} in {source!r} "
+                                f"is not a constant of the pattern of {text!r}")
+        self.match = self._compile()
+
+    def __repr__(self):
+        return f"Rule({self.text!r})"
+
+    def _compile(self) -> Callable[[list[Value]], Optional[dict[str, Any]]]:
+        """A function taking the arguments of an op and returning the
+        bindings of the names of the pattern, or None if they don't
+        match or the guard is false. The operand kinds and the literals
+        are checked by the dispatch already."""
+        lines = ["def match(args):"]
+        seen: set[str] = set()
+        for i, node in enumerate(self.pattern.args):
+            if isinstance(node, Var):
+                if node.name in seen:
+                    lines.append(f"    if args[{i}] is not _v_{node.name}: return None")
+                else:
+                    lines.append(f"    _v_{node.name} = args[{i}]")
+                seen.add(node.name)
+            elif isinstance(node, Const):
+                if node.name in seen:
+                    lines.append(f"    if args[{i}].value != {node.name}: return None")
+                else:
+                    lines.append(f"    {node.name} = args[{i}].value")
+                seen.add(node.name)
+        if self.guard is not None:
+            lines.append(f"    if not ({self.guard}): return None")
+        names = sorted(seen)
+        values = ", ".join(
+            f"{name!r}: {name}" if name[0].isupper() else f"{name!r}: _v_{name}"
+            for name in names)
+        lines.append(f"    return {{{values}}}")
+        namespace: dict[str, Any] = dict(_EVAL_GLOBALS)
+        try:
+            exec(compile("\n".join(lines), "<rule>", "exec"), namespace)
+        except SyntaxError as e:
+            raise RuleError(f"invalid guard in {self.text!r}: {e}") from e
+        return namespace["match"]
+
+    def swapped(self) -> "Rule":
+        """The same rule with the two arguments of the pattern swapped"""
+        res = Rule.__new__(Rule)
+        res.__dict__.update(self.__dict__)
+        res.pattern = OpPattern(self.pattern.name, self.pattern.args[::-1])
+        res.match = res._compile()
+        return res
+
+    def symmetric(self) -> bool:
+        """Whether swapping the two arguments of the pattern changes
+        nothing, like for add(x, x)"""
+        def key(node):
+            return (type(node), getattr(node, "name", None),
+                    getattr(node, "value", None))
+        arg0, arg1 = self.pattern.args
+        return key(arg0) == key(arg1)
+
+    def build(self, node, bindings: dict[str, Any],
+              emit: Callable[[Operation], Value]) -> Value:
+        if isinstance(node, Var):
+            return bindings[node.name]
+        if isinstance(node, Const):
+            return Constant(bindings[node.name])
+        if isinstance(node, Literal):
+            return Constant(node.value)
+        if isinstance(node, Expr):
+            return Constant(wrap_int(eval(node.code, _EVAL_GLOBALS, bindings)))
+        assert isinstance(node, OpPattern)
+        args = [self.build(arg, bindings, emit) for arg in node.args]
+        return emit(Operation(node.name, args))
+
+
+def _kinds(node) -> list[tuple[bool, ...]]:
+    """Whether the operands a pattern argument matches are
+    Constants: either for names, only constants otherwise"""
+    if isinstance(node, Var):
+        return [(True,), (False,)]
+    return [(True,)]
+
+
+# ops where f(a, b) == f(b, a), rules for them match both ways
+COMMUTATIVE = frozenset({"add", "mul", "bitand"})
+
+# how deep replacement ops are rewritten again
+_MAX_DEPTH = 8
+
+# [(rule number, rule)] by the values of the literal operands
+_ByValues = dict[tuple, list[tuple[int, Rule]]]
+
+# stands for constants that aren't ints, equal to no literal
+_NOT_INT = object()
+
+
+def _literal_values(args: list[Value], positions: tuple[int, ...]) -> tuple:
+    """The values of args at positions, to look up the literals they
+    match. Literals are ints and only match ints: 0 == 0.0 == False, but
+    add(x, 0.0) isn't x."""
+    values = []
+    for i in positions:
+        # the dispatch only looks up literals for constant operands
+        value = args[i].value   # type: ignore[attr-defined]
+        values.append(value if type(value) is int else _NOT_INT)
+    return tuple(values)
+
+
+class RuleSet:
+    """Rules compiled into a dispatch tree.
+
+    The first level is the opname together with which operands are
+    constants, the second the values of the literal operands. Matching
+    an op only looks at the few rules that can match its opname,
+    operand kinds and constants, however many rules there are. When
+    several rules match, the one given first wins. `counts` tells how
+    often each rule fired.
+    """
+
+    def __init__(self, rules: Iterable[str] = (),
+                 commutative: Iterable[str] = COMMUTATIVE):
+        self.commutative = frozenset(commutative)
+        self.rules: list[Rule] = []
+        self.counts: Counter[str] = Counter()
+        self._opnames: set[str] = set()
+        # (opname, operand is a constant...) ->
+        # [(positions of the literals, by their values)]
+        self._dispatch: dict[tuple, list[tuple[tuple[int, ...], _ByValues]]] = {}
+        for rule in rules:
+            self.add(rule)
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def add(self, text: str) -> Rule:
+        rule = Rule(text)
+        number = len(self.rules)
+        self.rules.append(rule)
+        variants = [rule]
+        pattern = rule.pattern
+        if pattern.name in self.commutative and len(pattern.args) == 2 \
+                and not rule.symmetric():
+            variants.append(rule.swapped())
+        for variant in variants:
+            self._register(number, variant)
+        return rule
+
+    def _register(self, number: int, rule: Rule):
+        args = rule.pattern.args
+        positions = tuple(i for i, arg in enumerate(args)
+                          if isinstance(arg, Literal))
+        values = tuple(args[i].value for i in positions)
+        self._opnames.add(rule.pattern.name)
+        combos: list[tuple[bool, ...]] = [()]
+        for arg in args:
+            combos = [combo + kind for combo in combos for kind in _kinds(arg)]
+        for kinds in combos:
+            groups = self._dispatch.setdefault((rule.pattern.name, kinds), [])
+            for group_positions, by_values in groups:
+                if group_positions == positions:
+                    break
+            else:
+                by_values = {}
+                groups.append((positions, by_values))
+            entries = by_values.setdefault(values, [])
+            if all(existing is not rule for _, existing in entries):
+                entries.append((number, rule))
+
+    def _candidates(self, op: Operation, args: list[Value]) -> list[tuple[int, Rule]]:
+        groups = self._dispatch.get(
+            (op.name, tuple([type(arg) is Constant for arg in args])))
+        if groups is None:
+            return []
+        return self._in_groups(groups, args)
+
+    @staticmethod
+    def _in_groups(groups: list[tuple[tuple[int, ...], _ByValues]],
+                   args: list[Value]) -> list[tuple[int, Rule]]:
+        if len(groups) == 1:
+            positions, by_values = groups[0]
+            if not positions:
+                return by_values[()]
+            return by_values.get(_literal_values(args, positions), [])
+        candidates: list[tuple[int, Rule]] = []
+        for positions, by_values in groups:
+            found = by_values.get(_literal_values(args, positions))
+            if found:
+                candidates.extend(found)
+        if len(candidates) > 1:
+            candidates.sort(key=lambda entry: entry[0])
+        return candidates
+
+    def rewrite(self, op: Operation, emit: Callable[[Operation], Any],
+                depth: int = 0, args: Optional[list[Value]] = None) -> Optional[Value]:
+        """The value op can be replaced by, or None. New ops the
+        replacement needs are passed to emit, in order, after being
+        rewritten themselves. args are the representatives of the
+        arguments of op, if the caller has them already."""
+        if op.name not in self._opnames:
+            return None
+        if args is None:
+            args = [arg.find() for arg in op.args]
+        groups = self._dispatch.get(
+            (op.name, tuple([type(arg) is Constant for arg in args])))
+        if groups is None:
+            return None
+        for _, rule in self._in_groups(groups, args):
+            try:
+                bindings = rule.match(args)
+                if bindings is None:
+                    continue
+                new_ops: list[Operation] = []
+                res = rule.build(rule.replacement, bindings,
+                                 lambda new_op: self._emit(new_op, new_ops.append, depth))
+            except (ArithmeticError, TypeError, ValueError):
+                continue    # e.g. a negative shift in an expression
+            for new_op in new_ops:
+                emit(new_op)
+            self.counts[rule.text] += 1
+            return res
+        return None
+
+    def _emit(self, op: Operation, emit: Callable[[Operation], Any],
+              depth: int) -> Value:
+        if depth < _MAX_DEPTH:
+            res = self.rewrite(op, emit, depth + 1)
+            if res is not None:
+                return res
+        emit(op)
+        return op
+
+
+def peephole_stream(ops: Iterable[Operation], rules: RuleSet) -> Iterator[Operation]:
+    """Replace every op a rule of `rules` matches"""
+    new_ops: list[Operation] = []
+    emit = new_ops.append
+    for op in ops:
+        res = rules.rewrite(op, emit)
+        if res is None:
+            yield op
+            continue
+        op.make_equal_to(res)
+        yield from new_ops
+        new_ops.clear()
+
+
+def peephole(bb: Block, rules: RuleSet) -> Block:
+    return Block(peephole_stream(bb, rules))
+
+
+# algebraic identities that hold for all ints, but not all floats
+ALGEBRAIC_RULES = RuleSet([
+    "add(x, 0) -> x",
+    "sub(x, 0) -> x",
+    "sub(x, x) -> 0",
+    "mul(x, 1) -> x",
+    "mul(x, 0) -> 0",
+    "lshift(x, 0) -> x",
+    "bitand(x, 0) -> 0",
+    "bitand(x, -1) -> x",
+    "bitand(x, x) -> x",
+])
+
+# muls by constants are lowered by passes.lower_mul_stream, which
+# weighs the alternatives
+STRENGTH_REDUCTION_RULES = RuleSet([
+    "add(x, x) -> lshift(x, 1)",
+])
@@ -0,0 +1,273 @@
+"""Binary encoding of Blocks.
+
+The layout is the columns of a `CompactBlock`, each section starting
+at a multiple of 8 bytes, all little-endian:
+
+    header      magic, format version and the section sizes
+    opnames     the opcode table, names separated by newlines
+    opcodes     uint16 per op, index into opnames
+    argstarts   int32 per op + 1, see CompactBlock
+    argslots    int32 per argument, see CompactBlock
+    kinds       uint8 per constant: _INT, _FLOAT, _STR, _BOOL or _NONE
+    offsets     int32 per constant + 1, into the constant data
+    data        ints as signed little-endian bytes, floats as
+                little-endian doubles, strs as UTF-8, bools as one byte
+
+Only constants of these types can be encoded, and loading decodes
+nothing else, so opening a file never runs code from it.
+
+Loading maps the sections as read-only memoryviews instead of copying
+them, so opening a large block takes constant time; ops and constants
+are decoded when they are accessed.
+"""
+from array import array
+import mmap
+import os
+import struct
+import sys
+from typing import Any, BinaryIO, Union
+
+from ir import Block, Constant, Operation, OpTable, Value
+from compact_block import CompactBlock, constant_key
+
+
+_MAGIC = b"TOYBLK\x00\x00"
+_VERSION = 2
+# magic, version, number of ops, argument slots, constants,
+# size of the opnames and of the constant data
+_HEADER = struct.Struct("<8sQQQQQQ")
+
+_INT = 0
+_FLOAT = 1
+_STR = 2
+_BOOL = 3
+_NONE = 4
+
+_DOUBLE = struct.Struct("<d")
+
+# the index columns are int32 in the file, half the size of the
+# int64 arrays of CompactBlock
+_INDEX = "i"
+_INDEX_LIMIT = 2**31
+
+
+def _padding(size: int) -> bytes:
+    return b"\x00" * (-size % 8)
+
+
+def _little_endian(typecode: str, column) -> bytes:
+    """The bytes of an array or memoryview column"""
+    if sys.byteorder == "little":
+        return memoryview(column).tobytes()
+    swapped = array(typecode, column)
+    swapped.byteswap()
+    return swapped.tobytes()
+
+
+def _as_index(column):
+    """column as int32s, without a copy if it already is"""
+    if isinstance(column, memoryview):
+        typecode = column.format
+    else:
+        typecode = getattr(column, "typecode", None)
+    if typecode == _INDEX:
+        return column
+    return array(_INDEX, column)
+
+
+def _encode_constant(value: Any) -> tuple[int, bytes]:
+    kind = type(value)
+    if kind is int:
+        return _INT, value.to_bytes((value.bit_length() + 8) // 8, "little",
+                                    signed=True)
+    if kind is float:
+        return _FLOAT, _DOUBLE.pack(value)
+    if kind is str:
+        return _STR, value.encode("utf-8", "surrogatepass")
+    if kind is bool:
+        return _BOOL, bytes([value])
+    if value is None:
+        return _NONE, b""
+    raise ValueError(f"can't serialize constant {value!r}")
+
+
+def _decode_constant(kind: int, chunk: memoryview) -> Any:
+    if kind == _INT:
+        return int.from_bytes(chunk, "little", signed=True)
+    if kind == _FLOAT and len(chunk) == _DOUBLE.size:
+        return _DOUBLE.unpack(chunk)[0]
+    if kind == _STR:
+        return str(chunk, "utf-8", "surrogatepass")
+    if kind == _BOOL and len(chunk) == 1:
+        return chunk[0] != 0
+    if kind == _NONE and not chunk:
+        return None
+    raise ValueError(f"invalid constant of kind {kind}")
+
+
+def _columns(bb: Union[Block, CompactBlock]):
+    """The opnames, opcodes, argstarts, argslots and constant values of
+    bb, encoded like CompactBlock does, without building one"""
+    opnames: list[str] = []
+    opcode_of: dict[str, int] = {}
+    opcodes = array("H")
+    argstarts = array(_INDEX, [0])
+    argslots = array(_INDEX)
+    constants: list[Any] = []
+    constant_index: dict[tuple, int] = {}
+    positions: OpTable[int] = OpTable()
+    for pos, op in enumerate(bb):
+        positions[op] = pos
+        code = opcode_of.get(op.name)
+        if code is None:
+            code = opcode_of[op.name] = len(opnames)
+            opnames.append(op.name)
+        opcodes.append(code)
+        for i in range(len(op.args)):
+            arg = op.arg(i)
+            if isinstance(arg, Constant):
+                value = arg.value
+                try:
+                    key = constant_key(value)
+                    index = constant_index.get(key)
+                except TypeError:   # unhashable, don't share it
+                    key, index = None, None
+                if index is None:
+                    index = len(constants)
+                    constants.append(value)
+                    if key is not None:
+                        constant_index[key] = index
+                argslots.append(~index)
+            else:
+                assert arg in positions, "Basic block not valid"
+                argslots.append(positions[arg])
+        argstarts.append(len(argslots))
+    return opnames, opcodes, argstarts, argslots, constants
+
+
+def dumps(bb: Union[Block, CompactBlock]) -> bytes:
+    """Encode bb, with every argument resolved to its representative"""
+    if isinstance(bb, CompactBlock) and not bb._forwarded:
+        opnames, opcodes, argstarts, argslots = \
+            bb.opnames, bb.opcodes, bb.argstarts, bb.argslots
+        constants = [const.value for const in bb.constants]
+    else:
+        opnames, opcodes, argstarts, argslots, constants = _columns(bb)
+    names = "\n".join(opnames).encode()
+    kinds = array("B")
+    offsets = array(_INDEX, [0])
+    data = []
+    for value in constants:
+        kind, encoded = _encode_constant(value)
+        kinds.append(kind)
+        data.append(encoded)
+        offsets.append(offsets[-1] + len(encoded))
+    data_bytes = b"".join(data)
+    if max(len(argslots), len(constants), len(data_bytes)) >= _INDEX_LIMIT:
+        raise ValueError("block too large to serialize")
+
+    parts = [_HEADER.pack(_MAGIC, _VERSION, len(opcodes), len(argslots),
+                          len(constants), len(names), len(data_bytes))]
+    for section in (names, _little_endian("H", opcodes),
+                    _little_endian(_INDEX, _as_index(argstarts)),
+                    _little_endian(_INDEX, _as_index(argslots)),
+                    kinds.tobytes(), _little_endian(_INDEX, offsets),
+                    data_bytes):
+        parts.append(section)
+        parts.append(_padding(len(section)))
+    return b"".join(parts)
+
+
+def dump(bb: Union[Block, CompactBlock], file: BinaryIO):
+    file.write(dumps(bb))
+
+
+class _LazyConstants:
+    """The constant pool of a loaded block, decoded on access"""
+
+    def __init__(self, kinds: memoryview, offsets, data: memoryview):
+        self._kinds = kinds
+        self._offsets = offsets
+        self._data = data
+        # decoded so far, so the same slot is always the same Constant
+        self._decoded: dict[int, Constant] = {}
+
+    def __len__(self) -> int:
+        return len(self._kinds)
+
+    def __getitem__(self, index: int) -> Constant:
+        const = self._decoded.get(index)
+        if const is not None:
+            return const
+        if index < 0:
+            index += len(self)
+        chunk = self._data[self._offsets[index]:self._offsets[index + 1]]
+        value = _decode_constant(self._kinds[index], chunk)
+        return self._decoded.setdefault(index, Constant(value))
+
+
+def _column(buffer: memoryview, pos: int, typecode: str, length: int):
+    """A typecode column of length items at pos, and the position of
+    the next section"""
+    size = length * array(typecode).itemsize
+    if pos + size > len(buffer):
+        raise ValueError("truncated serialized Block")
+    column: Any = buffer[pos:pos + size].cast(typecode)  # type: ignore[call-overload]
+    if sys.byteorder != "little":
+        column = array(typecode, column)
+        column.byteswap()
+    return column, pos + size + (-size % 8)
+
+
+def loads(data) -> CompactBlock:
+    """Open an encoded block without copying data: bytes, an mmap or
+    anything else supporting the buffer protocol. The block keeps
+    data alive."""
+    buffer = memoryview(data).cast("B")
+    if len(buffer) < _HEADER.size:
+        raise ValueError("not a serialized Block")
+    magic, version, nops, nslots, nconsts, names_size, data_size = \
+        _HEADER.unpack_from(buffer)
+    if magic != _MAGIC:
+        raise ValueError("not a serialized Block")
+    if version != _VERSION:
+        raise ValueError(f"unsupported format version {version}")
+    pos = _HEADER.size
+    if pos + names_size > len(buffer):
+        raise ValueError("truncated serialized Block")
+    opnames = bytes(buffer[pos:pos + names_size]).decode().split("\n") \
+        if names_size else []
+    pos += names_size + (-names_size % 8)
+    opcodes, pos = _column(buffer, pos, "H", nops)
+    argstarts, pos = _column(buffer, pos, _INDEX, nops + 1)
+    argslots, pos = _column(buffer, pos, _INDEX, nslots)
+    kinds, pos = _column(buffer, pos, "B", nconsts)
+    offsets, pos = _column(buffer, pos, _INDEX, nconsts + 1)
+    if pos + data_size > len(buffer):
+        raise ValueError("truncated serialized Block")
+    constants = _LazyConstants(kinds, offsets, buffer[pos:pos + data_size])
+    return CompactBlock.from_columns(opnames, opcodes, argstarts, argslots,
+                                     constants)
+
+
+def to_block(bb: CompactBlock) -> Block:
+    """Decode every row of bb into a fresh Block of Operations"""
+    res = Block()
+    ops: list[Operation] = []
+    opnames, opcodes, constants = bb.opnames, bb.opcodes, bb.constants
+    argstarts, argslots = bb.argstarts, bb.argslots
+    for index in range(len(opcodes)):
+        args: list[Value] = [
+            constants[~slot] if slot < 0 else ops[slot]
+            for slot in argslots[argstarts[index]:argstarts[index + 1]]
+        ]
+        ops.append(Operation(opnames[opcodes[index]], args))
+    res.extend(ops)
+    return res
+
+
+def load(path: Union[str, os.PathLike]) -> CompactBlock:
+    """Memory-map the encoded block in the file at path"""
+    with open(path, "rb") as f:
+        mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    return loads(mapped)
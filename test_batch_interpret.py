@@ -0,0 +1,129 @@
+from hypothesis import given, strategies
+import pytest
+
+np = pytest.importorskip("numpy")
+
+from ir import Block, bit_width_mode
+from interpret import interpret
+from batch_interpret import interpret_batch, BatchObj
+
+
+def _arith_block():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, 5)
+    var3 = bb.mul(var2, var1)
+    var4 = bb.lshift(var3, 3)
+    var5 = bb.bitand(var4, var1)
+    var5 = bb.sub(var5, var3)
+    obj = bb.alloc()
+    bb.store(obj, 0, var5)
+    bb.store(obj, 1, var4)
+    bb.escape(obj)
+    var6 = bb.load(obj, 0)
+    var7 = bb.load(obj, 1)
+    var8 = bb.add(var6, var7)
+    bb.print(var8)
+    return bb
+
+
+def _scalar_results(bb, *columns):
+    return [interpret(bb, *row) for row in zip(*columns)]
+
+
+def test_batch_matches_scalar():
+    bb = _arith_block()
+    xs = np.arange(-50, 50)
+    ys = np.arange(100) * 3 - 7
+
+    res = interpret_batch(bb, xs, ys)
+    assert res.dtype == np.int64
+    assert list(res) == _scalar_results(bb, xs.tolist(), ys.tolist())
+
+
+def test_batch_falls_back_to_python_ints():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, var0)
+    var2 = bb.lshift(var1, 40)
+    bb.print(var2)
+
+    xs = [2**31, -2**40, 3]
+    res = interpret_batch(bb, xs)
+    # would overflow int64, the result must still be exact
+    assert res.dtype == object
+    assert list(res) == _scalar_results(bb, xs)
+
+
+def test_batch_constant_result_and_broadcast():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, var1)
+    bb.escape(var2)
+    bb.print(bb.add(2, 3))
+
+    res = interpret_batch(bb, np.arange(4), 10)
+    assert list(res) == [5, 5, 5, 5]
+
+
+def test_batch_objects_are_columnar():
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, var0)
+    bb.print(obj)
+
+    res = interpret_batch(bb, np.arange(3))
+    assert isinstance(res, BatchObj)
+    column, _ = res.load(0)
+    assert list(column) == [0, 1, 2]
+
+
+def test_batch_negative_shift():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    bb.print(bb.lshift(var0, var1))
+
+    with pytest.raises(ValueError):
+        interpret(bb, 1, -1)
+    with pytest.raises(ValueError):
+        interpret_batch(bb, np.array([1, 1]), np.array([2, -1]))
+
+
+@given(strategies.lists(strategies.tuples(strategies.integers(), strategies.integers()),
+                        min_size=1, max_size=20))
+def test_hypothesis_batch_matches_scalar(rows):
+    bb = _arith_block()
+    xs = [x for x, _ in rows]
+    ys = [y for _, y in rows]
+    res = interpret_batch(bb, np.array(xs, dtype=object), np.array(ys, dtype=object))
+    assert list(res) == _scalar_results(bb, xs, ys)
+
+
+@given(strategies.sampled_from([8, 16, 32, 64]),
+       strategies.lists(strategies.tuples(strategies.integers(), strategies.integers()),
+                        min_size=1, max_size=20))
+def test_hypothesis_batch_bit_width(width, rows):
+    bb = _arith_block()
+    xs = [x for x, _ in rows]
+    ys = [y for _, y in rows]
+    with bit_width_mode(width):
+        res = interpret_batch(bb, np.array(xs, dtype=object), np.array(ys, dtype=object))
+        # every value fits a machine word, no Python int fallback
+        assert res.dtype == np.int64
+        assert list(res) == _scalar_results(bb, xs, ys)
+
+
+def test_batch_bit_width_large_shift():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    bb.print(bb.lshift(var0, var1))
+
+    xs, ys = [3, -1, 5, 7], [0, 63, 64, 100]
+    with bit_width_mode(64):
+        res = interpret_batch(bb, np.array(xs), np.array(ys))
+        assert list(res) == _scalar_results(bb, xs, ys) == [3, -2**63, 0, 0]
@@ -0,0 +1,128 @@
+import math
+import struct
+
+import pytest
+
+from ir import Block, bit_width_mode
+from interpret import interpret
+from bytecode import lower, Program
+
+
+def _example_block():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, 5)
+    var3 = bb.mul(var2, var1)
+    var4 = bb.lshift(var3, 2)
+    var5 = bb.bitand(var4, 1023)
+    var5 = bb.sub(var5, var0)
+    obj = bb.alloc()
+    bb.store(obj, 0, var5)
+    bb.store(obj, 1, 2**100)
+    bb.escape(obj)
+    var6 = bb.load(obj, 0)
+    var7 = bb.load(obj, 1)
+    var8 = bb.add(var6, var7)
+    bb.print(var8)
+    return bb
+
+
+def test_lower_matches_interpret():
+    bb = _example_block()
+    program = lower(bb)
+    for args in [(0, 0), (3, 4), (-7, 11)]:
+        assert program.run(*args) == interpret(bb, *args)
+
+
+def test_main_example():
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, var0)
+    var1 = bb.load(obj, 0)
+    bb.print(var1)
+
+    program = lower(bb)
+    assert program.run(42) == 42
+
+
+def test_registers_are_reused():
+    bb = Block()
+    acc = bb.getarg(0)
+    for i in range(1000):
+        acc = bb.add(acc, i)
+    bb.print(acc)
+
+    program = lower(bb)
+    # only one value is live at any time
+    assert program.nregs == 1
+    assert program.run(0) == interpret(bb, 0) == sum(range(1000))
+
+
+def test_code_after_print_is_dropped():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.print(var0)
+    bb.dummy(var0)  # never reached, fine to not support it
+
+    assert lower(bb).run(3) == 3
+
+
+@pytest.mark.parametrize("opname, first, second, arg", [
+    ("mul", 0.0, -0.0, 2.5),
+    ("add", 1, 1.0, 2),
+])
+def test_equal_constants_of_different_values(opname, first, second, arg):
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = getattr(bb, opname)(var0, first)
+    var2 = getattr(bb, opname)(var0, second)
+    bb.store(bb.alloc(), 0, var1)
+    bb.print(var2)
+
+    program = lower(bb)
+    assert len(program.constants) == 2
+    result = program.run(arg)
+    assert type(result) is type(second)
+    assert math.copysign(1, result) == math.copysign(1, interpret(bb, arg))
+
+
+def test_unsupported_op():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.dummy(var0)
+    with pytest.raises(NotImplementedError):
+        lower(bb)
+
+
+def test_serialization_roundtrip():
+    bb = _example_block()
+    program = lower(bb)
+    loaded = Program.from_bytes(program.to_bytes())
+
+    assert loaded.nregs == program.nregs
+    assert loaded.constants == program.constants
+    assert loaded.code == program.code
+    assert loaded.run(3, 4) == interpret(bb, 3, 4)
+
+    with pytest.raises(ValueError):
+        Program.from_bytes(b"nope" + program.to_bytes())
+
+
+def test_serialized_code_is_little_endian_int64():
+    bb = _example_block()
+    program = lower(bb)
+    data = program.to_bytes()
+    start = struct.calcsize("<6sQQQ")
+    code = struct.unpack_from(f"<{len(program.code)}q", data, start)
+    assert list(code) == list(program.code)
+
+
+@pytest.mark.parametrize("width", [8, 16, 32, 64])
+def test_bit_width(width):
+    bb = _example_block()
+    program = lower(bb)
+    for args in [(0, 0), (3, 4), (-7, 11), (2**70, 2**65 + 3)]:
+        with bit_width_mode(width):
+            assert program.run(*args) == interpret(bb, *args)
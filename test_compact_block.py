@@ -0,0 +1,118 @@
+import pytest
+
+from ir import Block, Constant, bb_to_str
+from compact_block import CompactBlock, OpView
+from interpret import interpret
+from passes import constfold, cse, strength_reduce
+from passes import alloc_removal, optimize_load_store
+
+
+def _example(bb):
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var1, 17)
+    var3 = bb.mul(var0, var2)
+    var4 = bb.add(var1, 17)
+    var5 = bb.add(var3, var4)
+    var6 = bb.add(var5, var5)
+    obj = bb.alloc()
+    bb.store(obj, 0, var6)
+    var7 = bb.load(obj, 0)
+    bb.print(var7)
+    return bb
+
+
+def test_columns():
+    bb = CompactBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 5)
+    bb.add(var1, 5)
+
+    assert len(bb) == 3
+    assert list(bb.opcodes) == [0, 1, 1]
+    assert bb.opnames == ["getarg", "add"]
+    assert list(bb.argstarts) == [0, 1, 3, 5]
+    # constants are pooled, operands are indices
+    assert list(bb.argslots) == [~0, 0, ~1, 1, ~1]
+    assert bb.constants == [Constant(0), Constant(5)]
+
+
+def test_views_are_stable():
+    bb = CompactBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, var0)
+
+    assert isinstance(var1, OpView)
+    assert bb[1] is var1
+    assert var1.arg(0) is var0
+    assert var1.arg(1) is var1.arg(0)
+    assert var1.name == "add"
+    assert bb[-1] is var1
+    with pytest.raises(IndexError):
+        bb[2]
+
+
+def test_view_ids_survive_the_view():
+    bb = CompactBlock()
+    bb.getarg(0)
+    first_id = bb[0].id
+    # the view above is gone, a new one has the same id and hash
+    assert bb[0].id == first_id == hash(bb[0])
+    assert bb.getarg(1).id > first_id
+
+
+def test_union_find_on_views():
+    bb = CompactBlock()
+    a1 = bb.dummy(1)
+    a2 = bb.dummy(2)
+    a2.make_equal_to(a1)
+    assert a2.find() is a1
+
+    c = Constant(6)
+    a1.make_equal_to(c)
+    assert bb[1].find() is c
+
+
+def test_reject_foreign_operation():
+    other = Block()
+    foreign = other.getarg(0)
+    bb = CompactBlock()
+    with pytest.raises(ValueError):
+        bb.add(foreign, 1)
+
+
+def test_from_block():
+    bb = _example(Block())
+    compact = CompactBlock.from_block(bb)
+    assert bb_to_str(compact) == bb_to_str(bb)
+
+
+def test_signed_zeros_are_not_pooled():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 0.0)
+    var2 = bb.mul(var1, -0.0)
+    bb.print(var2)
+    compact = CompactBlock.from_block(bb)
+    assert bb_to_str(compact) == bb_to_str(bb)
+    assert len(compact.constants) == 3
+
+
+def test_interpret_and_print():
+    bb = _example(Block())
+    compact = _example(CompactBlock())
+
+    assert bb_to_str(compact) == bb_to_str(bb)
+    assert interpret(compact, 3, 4) == interpret(bb, 3, 4)
+
+
+@pytest.mark.parametrize("opt", [
+    constfold, cse, strength_reduce, alloc_removal, optimize_load_store
+])
+def test_passes_run_unchanged(opt):
+    bb = _example(Block())
+    compact = _example(CompactBlock())
+
+    opt_compact, opt_bb = opt(compact), opt(bb)
+    assert bb_to_str(opt_compact) == bb_to_str(opt_bb)
+    assert interpret(opt_compact, 3, 4) == interpret(opt_bb, 3, 4)
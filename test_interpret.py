@@ -1,7 +1,15 @@
 from ir import Block, Operation, Constant, Value
-from ir import bb_to_str
+from ir import bb_to_str, bit_width_mode
 from abstract_interpret import Parity, TOP, BOTTOM, EVEN, ODD
-from abstract_interpret import _analyze_parity, simplify
+from abstract_interpret import _analyze_parity, simplify, simplify_masks
+from interpret import interpret, interpret_compiled, compile_block, execute
+from interpret import frame_program
+from passes import constfold, alloc_removal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+import gc
+import pickle
+import weakref
+import pytest
 
 
 def test_analyze_parity_simple():
@@ -47,3 +55,325 @@ optvar5 = dummy(0)
 
     assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
 
+
+def _example_block():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, 5)
+    var3 = bb.mul(var2, var1)
+    var4 = bb.lshift(var3, 2)
+    obj = bb.alloc()
+    bb.store(obj, 0, var4)
+    bb.escape(obj)
+    var5 = bb.load(obj, 0)
+    bb.print(var5)
+    return bb
+
+
+def test_compiled_matches_interpret():
+    bb = _example_block()
+    for args in [(0, 0), (3, 4), (-7, 11)]:
+        assert interpret_compiled(bb, *args) == interpret(bb, *args)
+
+
+def test_compiled_doesnt_touch_ir():
+    bb = _example_block()
+    before = [(op.name, list(op.args), op._forwarded) for op in bb]
+    interpret_compiled(bb, 1, 2)
+    assert [(op.name, list(op.args), op._forwarded) for op in bb] == before
+
+
+def test_compile_cache():
+    bb = _example_block()
+    compiled = compile_block(bb)
+    assert compile_block(bb) is compiled
+
+    # mutating the block invalidates the cached code
+    bb.pop()
+    bb.print(bb[2])
+    assert compile_block(bb) is not compiled
+    assert interpret_compiled(bb, 1, 2) == 6
+
+
+def test_compile_cache_sees_forwarding():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(2, 3)
+    var2 = bb.add(var1, var0)
+    bb.print(var2)
+    assert interpret_compiled(bb, 1) == 6
+
+    opt_bb = constfold(bb)
+    assert interpret_compiled(opt_bb, 1) == 6
+    # the old block still runs correctly after var1 was folded away
+    assert interpret_compiled(bb, 10) == 15
+
+
+def test_compile_cache_survives_other_blocks():
+    bb = _example_block()
+    compiled = compile_block(bb)
+    program = frame_program(bb)
+
+    other = Block()
+    var0 = other.getarg(0)
+    other.print(other.add(var0, other.add(2, 3)))
+    constfold(other)
+    assert compile_block(bb) is compiled
+    assert frame_program(bb) is program
+
+
+def test_compiled_unknown_op():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.dummy(var0)
+    bb.print(var0)
+    with pytest.raises(NotImplementedError):
+        interpret_compiled(bb, 1)
+
+
+def test_execute_matches_interpret():
+    bb = _example_block()
+    for args in [(0, 0), (3, 4), (-7, 11)]:
+        assert execute(bb, *args) == interpret(bb, *args)
+
+
+def test_execute_doesnt_touch_ir():
+    bb = _example_block()
+    before = [(op.name, list(op.args), op._forwarded) for op in bb]
+    execute(bb, 1, 2)
+    assert [(op.name, list(op.args), op._forwarded) for op in bb] == before
+
+
+def test_execute_concurrently():
+    bb = _example_block()
+    inputs = [(i, i % 7) for i in range(200)]
+    expected = [((a + 5) * b) << 2 for a, b in inputs]
+
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(lambda args: execute(bb, *args), inputs))
+
+    assert results == expected
+
+
+def test_execute_while_optimizing():
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, var0)
+    var1 = bb.load(obj, 0)
+    bb.print(var1)
+
+    opt_bb = alloc_removal(bb)
+    assert execute(bb, 42) == execute(opt_bb, 42) == 42
+
+
+def test_analyses_coexist():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.lshift(var0, 1)
+    obj = bb.alloc()
+    bb.store(obj, 0, var1)
+    var2 = bb.load(obj, 0)
+    bb.print(var2)
+
+    parity = _analyze_parity(Block(bb[:2]))
+    assert interpret(bb, 21) == 42
+    opt_bb = alloc_removal(bb)
+    # neither run overwrote what the other one computed
+    assert parity[var1] is EVEN
+    assert interpret(opt_bb, 21) == 42
+    assert not hasattr(var0, "info")
+
+
+def test_interpret_doesnt_keep_values_alive():
+    class Arg:
+        pass
+
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.escape(var0)
+    bb.print(bb.getarg(1))
+
+    arg = Arg()
+    ref = weakref.ref(arg)
+    interpret(bb, arg, 1)
+    del arg
+    gc.collect()
+    assert ref() is None
+
+
+def _execute_pickled(data, arg):
+    return execute(pickle.loads(data), arg, 3)
+
+
+def test_execute_in_process_pool():
+    bb = _example_block()
+    execute(bb, 1, 1)   # fill the caches, they must not get pickled
+    data = pickle.dumps(bb)
+
+    with ProcessPoolExecutor(max_workers=2) as pool:
+        results = list(pool.map(_execute_pickled, [data] * 4, range(4)))
+
+    assert results == [execute(bb, i, 3) for i in range(4)]
+
+
+def test_bitand():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.bitand(var0, 0b1010)
+    bb.print(var1)
+    for runner in (interpret, interpret_compiled, execute):
+        assert runner(bb, 0b0110) == 0b0010
+        assert runner(bb, -1) == 0b1010
+
+
+def test_sub():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.sub(var0, var1)
+    var3 = bb.sub(var2, 3)
+    bb.print(var3)
+    for runner in (interpret, interpret_compiled, execute):
+        assert runner(bb, 10, 4) == 3
+        assert runner(bb, -1, 2**70) == -2**70 - 4
+
+
+def test_parity_of_sub():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.lshift(var0, 1)
+    var2 = bb.sub(var1, 3)
+    bb.dummy(var2)
+    assert _analyze_parity(bb)[var2] == ODD
+
+
+def test_simplify_masks():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.bitand(var0, 15)
+    var2 = bb.bitand(var1, 255)     # var1 is in range(16) already
+    var3 = bb.lshift(var2, 4)
+    var4 = bb.bitand(var3, 15)      # low bits are known 0
+    var5 = bb.add(var3, var4)
+    var6 = bb.bitand(var5, -16)     # so are these
+    var7 = bb.sub(var6, var0)
+    bb.print(var7)
+
+    opt_bb = simplify_masks(bb)
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = bitand(var0, 15)
+var2 = lshift(var1, 4)
+var3 = add(var2, 0)
+var4 = sub(var3, var0)
+var5 = print(var4)"""
+    for arg in (0, 7, 100, -100):
+        assert interpret(opt_bb, arg) == interpret(bb, arg)
+
+
+def test_simplify_masks_keeps_unknown_bits():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.sub(var0, 1)
+    var2 = bb.bitand(var1, 255)     # var1 may be negative
+    bb.print(var2)
+    assert bb_to_str(simplify_masks(bb)) == bb_to_str(bb)
+
+
+def test_simplify_masks_non_int_constant():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 1.5)
+    var2 = bb.bitand(var0, 0.0)
+    bb.print(var1)
+    bb.print(var2)
+    assert bb_to_str(simplify_masks(bb)) == bb_to_str(bb)
+
+
+def _wrapping_block():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.mul(var0, 300)
+    var3 = bb.lshift(var2, var1)
+    var4 = bb.sub(var3, 2**40)
+    var5 = bb.bitand(var4, 0xfff0)
+    var6 = bb.add(var5, var0)
+    obj = bb.alloc()
+    bb.store(obj, 200, var6)
+    var7 = bb.load(obj, 200)
+    bb.print(var7)
+    return bb
+
+
+@pytest.mark.parametrize("width", [8, 16, 32, 64])
+def test_bit_width_runners_agree(width):
+    bb = _wrapping_block()
+    mask = (1 << width) - 1
+    for args in [(0, 0), (1, 3), (-7, 11), (2**70 + 5, 2), (1, width - 1)]:
+        unbounded = interpret(bb, *args)
+        with bit_width_mode(width):
+            expected = interpret(bb, *args)
+            assert -2**(width - 1) <= expected < 2**(width - 1)
+            # two's complement wrapping doesn't change the low bits
+            assert expected & mask == unbounded & mask
+            for runner in (interpret_compiled, execute):
+                assert runner(bb, *args) == expected
+
+
+def test_bit_width_large_shift():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.lshift(var0, 10**9)
+    var2 = bb.add(var1, 1)
+    bb.print(var2)
+    with bit_width_mode(64):
+        for runner in (interpret, interpret_compiled, execute):
+            assert runner(bb, 12345) == 1
+
+
+def test_compile_cache_per_bit_width():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 1)
+    bb.print(var1)
+    assert interpret_compiled(bb, 127) == 128
+    with bit_width_mode(8):
+        assert interpret_compiled(bb, 127) == -128
+        assert execute(bb, 127) == -128
+    assert interpret_compiled(bb, 127) == 128
+    assert execute(bb, 127) == 128
+
+
+def test_simplify_masks_bit_width():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.bitand(var0, 255)     # all the bits there are with 8
+    var2 = bb.lshift(var1, 6)
+    var3 = bb.lshift(var2, 2)       # everything shifted out
+    var4 = bb.add(var3, 200)
+    bb.print(var4)
+    with bit_width_mode(8):
+        opt_bb = simplify_masks(bb)
+        assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 6)
+var2 = print(-56)"""
+        for arg in (0, 1, 3, -100):
+            assert interpret(opt_bb, arg) == interpret(bb, arg)
+
+
+def _run_with_width(bb, width):
+    with bit_width_mode(width):
+        return [(execute(bb, i, 1), interpret_compiled(bb, i, 1)) for i in range(50)]
+
+
+def test_bit_width_in_concurrent_threads():
+    bb = _wrapping_block()
+    widths = [None, 8, 16, 32, 64] * 4
+    expected = {width: _run_with_width(bb, width) for width in set(widths)}
+    with ThreadPoolExecutor(max_workers=8) as pool:
+        results = list(pool.map(_run_with_width, [bb] * len(widths), widths))
+    assert results == [expected[width] for width in widths]
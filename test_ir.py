@@ -1,5 +1,12 @@
-from ir import Value, Constant, Operation, Block
-from ir import bb_to_str
+import io
+import pickle
+import threading
+
+import pytest
+
+from ir import Value, Constant, Operation, Block, OpTable
+from ir import bb_to_str, str_to_bb, read_blocks, union_find_stats
+from ir import bit_width, bit_width_mode, set_bit_width, wrap_int, lshift_int
 
 
 def test_construct_example():
@@ -136,3 +143,352 @@ def test_union_find():
 
     # union with the same constant again is fine
     a2.make_equal_to(c)
+
+
+def test_find_compresses_path():
+    bb = Block()
+    ops = [bb.dummy(i) for i in range(5)]
+    # build the chain ops[4] -> ops[3] -> ... -> ops[0] by hand,
+    # make_equal_to would already compress it
+    for prev, op in zip(ops, ops[1:]):
+        op._forwarded = prev
+
+    assert ops[4].find() is ops[0]
+    # every op on the chain now points at the representative
+    assert all(op._forwarded is ops[0] for op in ops[1:])
+
+    c = Constant(7)
+    ops[2].make_equal_to(c)
+    assert ops[4].find() is c
+    assert ops[0].find() is c
+
+
+def test_union_find_stats():
+    bb = Block()
+    ops = [bb.dummy(i) for i in range(4)]
+    for prev, op in zip(ops, ops[1:]):
+        op._forwarded = prev
+
+    with union_find_stats() as stats:
+        assert ops[3].find() is ops[0]  # walks 3 links, compresses
+        assert ops[3].find() is ops[0]  # a single link now
+        ops[1].make_equal_to(Constant(1))
+
+    assert stats.unions == 1
+    assert stats.max_length == 3
+    # the union did its own find(), walking ops[1] -> ops[0]
+    assert stats.finds == 3
+    assert stats.average_length == (3 + 1 + 1) / 3
+    assert stats.as_dict()["max_length"] == 3
+
+    # not recording outside of the with block
+    ops[2].find()
+    assert stats.finds == 3
+
+
+def test_constant_hash():
+    assert hash(Constant(5)) == hash(Constant(5))
+    assert len({Constant(5), Constant(5), Constant(6)}) == 2
+    assert {(Constant(1), "x"): 1}[(Constant(1), "x")] == 1
+
+
+def test_constant_interning():
+    assert Constant(5) is Constant(5)
+    assert Constant(2**100) is Constant(2**100)
+    assert Constant(1) is not Constant(True)
+    assert Constant("x") is Constant("x")
+    # 0.0 == -0.0, but they are different constants
+    assert Constant(0.0) is not Constant(-0.0)
+    assert Constant(0.5) == Constant(0.5)
+
+    bb = Block()
+    var0 = bb.add(bb.getarg(0), 17)
+    assert var0.args[1] is Constant(17)
+    assert pickle.loads(pickle.dumps(Constant(17))) is Constant(17)
+
+
+def test_union_find_stats_nested():
+    bb = Block()
+    a1 = bb.dummy(1)
+    a2 = bb.dummy(2)
+    with union_find_stats() as outer:
+        with union_find_stats() as inner:
+            a2.make_equal_to(a1)
+        a1.find()
+    assert inner.unions == 1
+    # make_equal_to finds the representatives of both sides
+    assert inner.finds == 2
+    assert outer.unions == 1
+    assert outer.finds == 3
+
+
+def test_union_find_stats_in_threads():
+    # the contexts of two threads are exited in the order they were
+    # entered, not nested
+    entered = [threading.Event(), threading.Event()]
+    leave = [threading.Event(), threading.Event()]
+    collected = []
+
+    def count(i):
+        with union_find_stats() as stats:
+            entered[i].set()
+            leave[i].wait(5)
+            Operation("dummy", []).find()
+        collected.append(stats)
+
+    threads = [threading.Thread(target=count, args=(i,)) for i in range(2)]
+    threads[0].start()
+    assert entered[0].wait(5)
+    threads[1].start()
+    assert entered[1].wait(5)
+    for i in range(2):
+        leave[i].set()
+        threads[i].join()
+
+    # nothing is left counting after both are done
+    Operation("dummy", []).find()
+    assert [stats.finds for stats in collected] == [1, 1]
+
+
+def test_use_lists():
+    bb = Block(track_uses=True)
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, var1)
+    var3 = bb.mul(var0, 2)
+    var4 = bb.add(var2, var3)
+
+    assert bb.users(var0) == [var2, var3]
+    assert bb.users(var1) == [var2]
+    assert bb.users(var4) == []
+    assert bb.users(Constant(2)) == []
+
+    # rewrite all uses of var3 to var1: the users move along
+    var3.make_equal_to(var1)
+    assert set(map(id, bb.users(var1))) == {id(var2), id(var4)}
+    assert bb.users(var3) == bb.users(var1)
+    # var3 itself was replaced, it doesn't use var0 anymore
+    assert bb.users(var0) == [var2]
+
+    var5 = bb.escape(var3)
+    assert var5 in bb.users(var1)
+
+    var1.make_equal_to(Constant(5))
+    assert bb.users(var1) == []
+
+
+def test_use_lists_rebuild():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 1)
+    var2 = bb.add(var0, 2)
+    with pytest.raises(ValueError):
+        bb.users(var0)
+
+    tracked = Block(bb, track_uses=True)
+    assert tracked.users(var0) == [var1, tracked[2]]
+
+    del tracked[2]
+    tracked.rebuild_uses()
+    assert tracked.users(var0) == [var1]
+
+    tracked[1] = Operation("mul", [var0, var0])
+    tracked += [Operation("escape", [var0])]
+    # the replaced add is still listed until the next rebuild
+    assert [op.name for op in tracked.users(var0)] == ["add", "mul", "escape"]
+    tracked.rebuild_uses()
+    assert [op.name for op in tracked.users(var0)] == ["mul", "escape"]
+
+
+def test_operation_hash_is_stable():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 1)
+    var2 = bb.add(var0, 1)
+    assert var0.id < var1.id < var2.id
+    names = {var1: "a", var2: "b"}
+
+    var2.make_equal_to(var1)
+    var1.args[1] = Constant(2)
+    assert hash(var2) == var2.id
+    assert names[var1] == "a"
+    assert names[var2] == "b"
+
+
+def test_op_table():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    table = OpTable(bb, 0)
+    assert table[var0] == 0 and table[var1] == 0
+
+    var2 = bb.add(var0, var1)
+    assert var2 not in table
+    assert table.get(var2) is None
+    with pytest.raises(KeyError):
+        table[var2]
+    table[var2] = 5
+    assert table[var2] == 5
+    del table[var2]
+    assert var2 not in table
+
+    empty: OpTable[str] = OpTable()
+    empty[var2] = "c"
+    # ops older than the first entry extend the table downwards
+    empty[var0] = "a"
+    assert empty[var0] == "a"
+    assert var1 not in empty
+    assert empty[var2] == "c"
+
+
+def test_op_table_far_apart_ids():
+    bb = Block()
+    var0 = bb.getarg(0)
+    for _ in range(10_000):
+        Operation("dummy", [])
+    var1 = bb.add(var0, 1)
+
+    for table in (OpTable(bb, 0), OpTable()):
+        table[var0] = "a"
+        table[var1] = "b"
+        # not a list entry for every op created in between
+        assert len(table._values) < 100
+        assert table[var0] == "a" and table.get(var1) == "b"
+        assert Operation("dummy", []) not in table
+        del table[var1]
+        assert var1 not in table
+        with pytest.raises(KeyError):
+            table[var1]
+
+
+def test_unpickled_ops_get_fresh_ids():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.add(var0, 1)
+    copy = pickle.loads(pickle.dumps(bb))
+    assert bb_to_str(copy) == bb_to_str(bb)
+    assert {op.id for op in copy}.isdisjoint(op.id for op in bb)
+
+
+def _roundtrip_example():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, -17)
+    var2 = bb.mul(var1, 2**70)
+    obj = bb.alloc()
+    bb.store(obj, 0, var2)
+    bb.escape(obj)
+    bb.print(bb.load(obj, 0))
+    return bb
+
+
+def test_str_to_bb_roundtrip():
+    bb = _roundtrip_example()
+    text = bb_to_str(bb)
+    parsed = str_to_bb(text)
+    assert bb_to_str(parsed) == text
+    assert bb_to_str(parsed, "optvar") == bb_to_str(bb, "optvar")
+    assert parsed[1].args[1] is Constant(-17)
+
+
+def test_str_to_bb_forwarded_args():
+    bb = _roundtrip_example()
+    bb[1].make_equal_to(bb[0])
+    text = bb_to_str(bb)
+    assert bb_to_str(str_to_bb(text)) == text
+
+
+def test_str_to_bb_names_and_comments():
+    bb = str_to_bb("""
+        # a comment
+        a = getarg(0)
+        sum = add(a, a)   # trailing comment
+
+        res = dummy(sum, +3)
+    """)
+    assert bb_to_str(bb) == """\
+var0 = getarg(0)
+var1 = add(var0, var0)
+var2 = dummy(var1, 3)"""
+
+
+@pytest.mark.parametrize("text", [
+    "var0 = getarg(0)\nvar1 = add(var2, 1)",
+    "var0 = getarg(0)\nvar0 = getarg(1)",
+    "var0 = getarg(0.5)",
+    "var0 = getarg(0",
+    "var0 = add(1, )",
+])
+def test_str_to_bb_errors(text):
+    with pytest.raises(ValueError):
+        str_to_bb(text)
+
+
+def test_read_blocks():
+    first = _roundtrip_example()
+    second = Block()
+    second.print(second.getarg(0))
+    text = ("# trace file\n" + bb_to_str(first) + "\n\n\n"
+            + bb_to_str(second, "x") + "\n# the end\n\n")
+    blocks = read_blocks(io.StringIO(text))
+    assert bb_to_str(next(blocks)) == bb_to_str(first)
+    assert bb_to_str(next(blocks)) == bb_to_str(second)
+    assert list(blocks) == []
+
+
+def test_read_blocks_is_lazy():
+    def lines():
+        yield "var0 = getarg(0)\n"
+        yield "\n"
+        raise AssertionError("read past the first block")
+
+    assert len(next(read_blocks(lines()))) == 1
+
+
+def test_bit_width_mode():
+    assert bit_width() is None
+    assert wrap_int(2**100) == 2**100
+    with bit_width_mode(8):
+        assert bit_width() == 8
+        assert wrap_int(127) == 127
+        assert wrap_int(128) == -128
+        assert wrap_int(-129) == 127
+        assert wrap_int("x") == "x"
+        assert lshift_int(3, 6) == -64
+        # no 2**(10**9) bit int is built to find out it's all zeros
+        assert lshift_int(3, 10**9) == 0
+        with pytest.raises(ValueError):
+            lshift_int(1, -1)
+        with bit_width_mode(64):
+            assert wrap_int(2**63) == -2**63
+        assert bit_width() == 8
+    assert bit_width() is None
+
+
+def test_invalid_bit_width():
+    with pytest.raises(ValueError):
+        set_bit_width(12)
+    assert bit_width() is None
+
+
+def test_bit_width_is_per_thread():
+    inside = threading.Event()
+    done = threading.Event()
+    seen = []
+
+    def other_thread():
+        seen.append(bit_width())
+        with bit_width_mode(16):
+            inside.set()
+            done.wait(5)
+
+    with bit_width_mode(8):
+        thread = threading.Thread(target=other_thread)
+        thread.start()
+        assert inside.wait(5)
+        # neither thread sees the width of the other
+        assert bit_width() == 8
+        assert wrap_int(255) == -1
+        done.set()
+        thread.join()
+    assert seen == [None]
@@ -119,3 +119,37 @@ def test_hypothesis_sub(t1, t2):
     (k1, n1), (k2, n2) = t1, t2
     k3, n3 = k1 - k2, n1 - n2
     assert k3.contains(n3)
+
+
+def test_lshift_simple():
+    k1       = KnownBits.from_str("1?0")
+    expected = KnownBits.from_str("1?0000")
+    assert k1 << 3 == expected
+    assert str(KnownBits.all_unknown() << 2) == "...?00"
+
+
+@given(_knownbits_and_contained_value, strategies.integers(0, 100))
+def test_hypothesis_lshift(t1, amount):
+    k1, n1 = t1
+    assert (k1 << amount).contains(n1 << amount)
+
+
+@given(_knownbits_and_contained_value)
+def test_hypothesis_may_be_ones(t1):
+    k1, n1 = t1
+    assert n1 & ~k1.may_be_ones() == 0
+
+
+def test_wrapped_simple():
+    assert KnownBits.from_str("1?01").wrapped(3) == KnownBits.from_str("...?01")
+    assert KnownBits.from_str("?101").wrapped(3) == KnownBits.from_str("...101")
+    assert KnownBits.from_str("?001").wrapped(3) == KnownBits.from_constant(1)
+    assert KnownBits.all_unknown().wrapped(8) == KnownBits.all_unknown()
+
+
+@given(_knownbits_and_contained_value, strategies.sampled_from([8, 16, 32, 64]))
+def test_hypothesis_wrapped(t1, width):
+    k1, n1 = t1
+    sign = 1 << (width - 1)
+    wrapped = ((n1 + sign) & ((1 << width) - 1)) - sign
+    assert k1.wrapped(width).contains(wrapped)
@@ -1,6 +1,6 @@
 from ir import Block
 from ir import bb_to_str
-from passes import optimize_load_store
+from passes import optimize_load_store, CompileTimeHeap
 
 
 def test_two_loads():
@@ -98,3 +98,54 @@ var1 = store(var0, 0, 5)
     """
 
     assert bb_to_str(opt_bb).strip() == expected.strip()
+
+
+def test_store_to_same_offset_of_other_object_invalidates_load():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.load(var0, 0)
+    var3 = bb.load(var0, 1)
+    bb.store(var1, 0, 5)            # var1 may alias var0
+    var5 = bb.load(var0, 0)
+    var6 = bb.load(var0, 1)
+    bb.escape(var5)
+    bb.escape(var6)
+
+    opt_bb = optimize_load_store(bb)
+
+    expected = """
+var0 = getarg(0)
+var1 = getarg(1)
+var2 = load(var0, 0)
+var3 = load(var0, 1)
+var4 = store(var1, 0, 5)
+var5 = load(var0, 0)
+var6 = escape(var5)
+var7 = escape(var3)
+    """
+
+    assert bb_to_str(opt_bb).strip() == expected.strip()
+
+
+def test_compile_time_heap_indexes():
+    bb = Block()
+    obj0 = bb.getarg(0)
+    obj1 = bb.getarg(1)
+    val = bb.getarg(2)
+
+    heap = CompileTimeHeap()
+    heap.set(obj0, 0, val)
+    heap.set(obj0, 1, val)
+    heap.set(obj1, 0, val)
+    assert len(heap) == 3
+    assert heap.get(obj0, 1) is val
+    assert heap.get(obj1, 1) is None
+    assert heap.fields(obj0) == {0: val, 1: val}
+
+    heap.invalidate_offset(0)
+    assert len(heap) == 1
+    assert heap.get(obj0, 0) is None
+    assert heap.get(obj1, 0) is None
+    assert heap.fields(obj0) == {1: val}
+    assert heap.fields(obj1) == {}
@@ -0,0 +1,126 @@
+import pytest
+
+from ir import Block, bb_to_str, bit_width_mode
+from interpret import interpret
+from passes import constfold, cse, strength_reduce, alloc_removal
+from passmanager import PassManager
+from optcache import OptimizationCache, structural_hash
+
+
+def _example_block(const=5):
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, const)
+    var1 = bb.load(obj, 0)
+    var2 = bb.add(var1, 2)
+    var3 = bb.add(var0, var2)
+    var4 = bb.add(var0, var2)
+    bb.print(bb.add(var3, var4))
+    return bb
+
+
+class CountingPipeline:
+    def __init__(self):
+        self.calls = 0
+        self.pm = PassManager([alloc_removal, constfold, cse, strength_reduce])
+
+    def __call__(self, bb):
+        self.calls += 1
+        return self.pm(bb)
+
+
+def test_structural_hash():
+    assert structural_hash(_example_block()) == structural_hash(_example_block())
+    assert structural_hash(_example_block()) != structural_hash(_example_block(6))
+
+    # forwarded args hash like their representatives
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 0)
+    var1.make_equal_to(var0)
+    bb.print(bb.mul(var1, 3))
+    expected = Block()
+    var0 = expected.getarg(0)
+    expected.add(var0, 0)
+    expected.print(expected.mul(var0, 3))
+    assert structural_hash(bb) == structural_hash(expected)
+
+
+def test_signed_zeros_have_different_keys():
+    def block(zero):
+        bb = Block()
+        var0 = bb.getarg(0)
+        var1 = bb.mul(var0, 0.0)
+        bb.print(bb.mul(var1, zero))
+        return bb
+
+    assert structural_hash(block(0.0)) != structural_hash(block(-0.0))
+    cache = OptimizationCache(cse)
+    cache(block(0.0))
+    assert str(interpret(cache(block(-0.0)), 1.0)) == "-0.0"
+    assert cache.stats.hits == 0
+
+
+def test_hit_skips_pipeline():
+    pipeline = CountingPipeline()
+    cache = OptimizationCache(pipeline)
+    first = cache(_example_block())
+    second = cache(_example_block())
+
+    assert pipeline.calls == 1
+    assert bb_to_str(second) == bb_to_str(first)
+    assert interpret(second, 4) == interpret(_example_block(), 4)
+    # a fresh block every time
+    assert set(second).isdisjoint(first)
+    assert cache.stats.hits == 1 and cache.stats.misses == 1
+    assert cache.stats.hit_rate == 0.5
+
+
+def test_lru_eviction():
+    pipeline = CountingPipeline()
+    cache = OptimizationCache(pipeline, maxsize=2)
+    for const in (1, 2, 1, 3, 1, 2):
+        cache(_example_block(const))
+    # 2 was evicted by 3, 1 stayed because it was used
+    assert pipeline.calls == 4
+    assert cache.stats.evictions == 2
+    assert len(cache) == 2
+
+
+def test_disk_tier(tmp_path):
+    pipeline = CountingPipeline()
+    cache = OptimizationCache(pipeline, maxsize=0, directory=tmp_path)
+    expected = bb_to_str(cache(_example_block()))
+
+    other = OptimizationCache(pipeline, directory=tmp_path)
+    assert bb_to_str(other(_example_block())) == expected
+    assert bb_to_str(other(_example_block())) == expected
+    assert pipeline.calls == 1
+    assert other.stats.disk_hits == 1
+    assert other.stats.hits == 2
+
+
+def test_cache_in_pipeline():
+    cache = OptimizationCache(PassManager([alloc_removal, constfold]))
+    pm = PassManager([cache, cse])
+    expected = bb_to_str(pm(_example_block()))
+    assert bb_to_str(pm(_example_block())) == expected
+    assert cache.stats.hits == 1
+
+
+def test_negative_maxsize():
+    with pytest.raises(ValueError):
+        OptimizationCache(constfold, maxsize=-1)
+
+
+def test_bit_width_has_its_own_entries():
+    pipeline = CountingPipeline()
+    cache = OptimizationCache(pipeline)
+    cache(_example_block(2**70))
+    with bit_width_mode(64):
+        # 2**70 is 0 with 64 bits, the unbounded result must not be reused
+        assert interpret(cache(_example_block(2**70)), 0) == 4
+        cache(_example_block(2**70))
+    assert pipeline.calls == 2
+    assert len(cache) == 2
@@ -0,0 +1,73 @@
+import pytest
+
+from ir import Block, bb_to_str, bit_width_mode
+from interpret import interpret
+from passes import constfold, cse, alloc_removal
+from passmanager import PassManager
+from parallel import optimize_many, OptimizationError
+
+
+def _block(i):
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, i)
+    var1 = bb.load(obj, 0)
+    var2 = bb.add(var1, 1)
+    bb.print(bb.add(var0, var2))
+    return bb
+
+
+def _fail_on_three(bb):
+    if bb[0].name == "getarg" and bb[0].arg(0).value == 3:
+        raise RuntimeError("boom")
+    return constfold(bb)
+
+
+PIPELINE = PassManager([alloc_removal, constfold, cse])
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_optimize_many_in_order(workers):
+    expected = [bb_to_str(PIPELINE(_block(i))) for i in range(10)]
+    results = optimize_many([_block(i) for i in range(10)], PIPELINE,
+                            workers=workers, chunksize=3)
+    assert [bb_to_str(bb) for bb in results] == expected
+    assert [interpret(bb, 1) for bb in results] == [i + 2 for i in range(10)]
+
+
+@pytest.mark.parametrize("workers", [1, 2])
+def test_errors_are_isolated(workers):
+    blocks = []
+    for i in range(6):
+        bb = Block()
+        bb.print(bb.add(bb.getarg(i), 1))
+        blocks.append(bb)
+    results = optimize_many(blocks, _fail_on_three, workers=workers, chunksize=2)
+
+    assert isinstance(results[3], OptimizationError)
+    assert results[3].index == 3
+    assert "boom" in str(results[3])
+    assert "RuntimeError" in results[3].details
+    for i in (0, 1, 2, 4, 5):
+        assert isinstance(results[i], Block)
+
+
+def test_unpicklable_pipeline():
+    results = optimize_many([_block(1), _block(2)], lambda bb: bb, workers=2)
+    assert all(isinstance(res, OptimizationError) for res in results)
+
+
+def test_chunksize():
+    with pytest.raises(ValueError):
+        optimize_many([], constfold, chunksize=0)
+
+
+def test_workers_use_bit_width():
+    blocks = [_block(127) for _ in range(3)]
+    with bit_width_mode(8):
+        expected = [bb_to_str(PIPELINE(_block(127))) for _ in range(3)]
+        results = optimize_many(blocks, PIPELINE, workers=2, chunksize=1)
+    assert [bb_to_str(res) for res in results] == expected
+    # 127 + 1 was folded with 8 bits
+    assert "-128" in expected[0]
@@ -1,9 +1,15 @@
+from hypothesis import given, strategies
 import pytest
 
 from ir import Value, Constant, Operation, Block
-from ir import bb_to_str
+from ir import bb_to_str, bit_width_mode
+from compact_block import CompactBlock
 from passes import constfold, cse, strength_reduce
-from passes import alloc_removal
+from passes import alloc_removal, optimize_load_store, fused_optimize
+from passes import dce, compact
+from passes import INTERPRETER_COSTS, MACHINE_COSTS
+from passes import stream, constfold_stream, cse_stream, strength_reduce_stream
+from passes import alloc_removal_stream, optimize_load_store_stream
 from interpret import interpret
 
 
@@ -22,6 +28,79 @@ optvar1 = add(9, optvar0)
     assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
 
 
+@pytest.mark.parametrize("name, arg0, arg1, expected", [
+    ("add", 5, 4, 9),
+    ("sub", 5, 7, -2),
+    ("mul", -3, 4, -12),
+    ("lshift", 3, 4, 48),
+    ("bitand", 12, 10, 8),
+])
+def test_constfold_every_op(name, arg0, arg1, expected):
+    bb = Block()
+    var0 = getattr(bb, name)(arg0, arg1)
+    bb.print(var0)
+
+    assert bb_to_str(constfold(bb)) == f"var0 = print({expected})"
+
+
+def test_constfold_leaves_errors_to_runtime():
+    bb = Block()
+    var0 = bb.lshift(1, -1)
+    bb.print(var0)
+
+    assert bb_to_str(constfold(bb)) == bb_to_str(bb)
+
+
+@pytest.mark.parametrize("name, arg0, arg1, expected", [
+    ("add", "x", 0, "x"),
+    ("add", 0, "x", "x"),
+    ("sub", "x", 0, "x"),
+    ("sub", "x", "x", 0),
+    ("mul", "x", 1, "x"),
+    ("mul", 0, "x", 0),
+    ("lshift", "x", 0, "x"),
+    ("bitand", "x", -1, "x"),
+    ("bitand", 0, "x", 0),
+    ("bitand", "x", "x", "x"),
+])
+def test_constfold_identities(name, arg0, arg1, expected):
+    bb = Block()
+    x = bb.getarg(0)
+    var1 = getattr(bb, name)(x if arg0 == "x" else arg0, x if arg1 == "x" else arg1)
+    bb.print(var1)
+
+    opt_bb = constfold(bb)
+    assert bb_to_str(opt_bb) == \
+        f"var0 = getarg(0)\nvar1 = print({'var0' if expected == 'x' else expected})"
+
+
+def test_constfold_loads():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    bb.store(var0, 0, 5)
+    bb.store(var0, 1, var1)
+    var2 = bb.load(var0, 0)     # 5
+    var3 = bb.load(var0, 1)     # not a constant
+    bb.store(var1, 0, 6)        # var1 may be var0
+    var4 = bb.load(var0, 0)
+    var5 = bb.add(var2, var4)
+    var6 = bb.add(var3, var5)
+    bb.print(var6)
+
+    opt_bb = constfold(bb)
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = getarg(1)
+var2 = store(var0, 0, 5)
+var3 = store(var0, 1, var1)
+var4 = load(var0, 1)
+var5 = store(var1, 0, 6)
+var6 = load(var0, 0)
+var7 = add(5, var6)
+var8 = add(var4, var7)
+var9 = print(var8)"""
+
 def test_constfold_multifold():
     bb = Block()
     var0 = bb.getarg(0)
@@ -59,6 +138,61 @@ optvar4 = add(optvar3, optvar2)
     assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
 
 
+def test_cse_commutative_and_pure_ops():
+    bb = Block()
+    a = bb.getarg(0)
+    b = bb.getarg(1)
+    a_again = bb.getarg(0)          # same as a
+    var1 = bb.mul(a, b)
+    var2 = bb.mul(b, a_again)       # same as var1
+    var3 = bb.bitand(var1, 255)
+    var4 = bb.bitand(255, var2)     # same as var3
+    var5 = bb.lshift(a, b)
+    var6 = bb.lshift(b, a)          # not commutative, kept
+    bb.escape(var4)
+
+    opt_bb = cse(bb)
+    expected = """
+optvar0 = getarg(0)
+optvar1 = getarg(1)
+optvar2 = mul(optvar0, optvar1)
+optvar3 = bitand(optvar2, 255)
+optvar4 = lshift(optvar0, optvar1)
+optvar5 = lshift(optvar1, optvar0)
+optvar6 = escape(optvar3)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+
+
+@pytest.mark.parametrize("opt", [cse, fused_optimize])
+@pytest.mark.parametrize("name, const0, const1", [
+    ("mul", 0.0, -0.0),
+    ("add", 1, 1.0),
+])
+def test_cse_keeps_equal_constants_of_different_values(opt, name, const0, const1):
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = getattr(bb, name)(var0, const0)
+    var2 = getattr(bb, name)(var0, const1)
+    bb.dummy(var1, var2)
+    bb.print(var2)
+
+    expected = bb_to_str(bb)
+    assert bb_to_str(opt(bb)) == expected
+
+
+def test_cse_keeps_impure_ops():
+    bb = Block()
+    a = bb.getarg(0)
+    var1 = bb.load(a, 0)
+    var2 = bb.load(a, 0)
+    obj1 = bb.alloc()
+    obj2 = bb.alloc()
+
+    opt_bb = cse(bb)
+    assert bb_to_str(opt_bb) == bb_to_str(bb)
+
+
 def test_strength_reduce():
     # TODO: parametrize this test on different ops
     bb = Block()
@@ -74,6 +208,104 @@ optvar1 = lshift(optvar0, 1)
     assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
 
 
+@pytest.mark.parametrize("factor, expected", [
+    (8, "var1 = lshift(var0, 3)\nvar2 = print(var1)"),
+    (1, "var1 = print(var0)"),
+    (0, "var1 = print(0)"),
+    (-1, "var1 = sub(0, var0)\nvar2 = print(var1)"),
+    # two ops cost more than a mul when interpreted
+    (10, "var1 = mul(10, var0)\nvar2 = print(var1)"),
+])
+def test_strength_reduce_mul(factor, expected):
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(factor, var0)
+    bb.print(var1)
+
+    opt_bb = strength_reduce(bb)
+    assert bb_to_str(opt_bb) == "var0 = getarg(0)\n" + expected
+
+
+def test_lower_mul_costs():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 15)
+    var2 = bb.mul(var1, -3)
+    var3 = bb.mul(var2, 10)
+    var4 = bb.mul(var3, 45)
+    bb.print(var4)
+
+    opt_bb = strength_reduce(bb, MACHINE_COSTS)
+    # 10 * x takes three ops, as much as the mul
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 4)
+var2 = sub(var1, var0)
+var3 = lshift(var2, 2)
+var4 = sub(var2, var3)
+var5 = mul(var4, 10)
+var6 = mul(var5, 45)
+var7 = print(var6)"""
+
+
+def test_lower_mul_shares_subexpressions():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.print(bb.mul(var0, 45))
+
+    opt_bb = strength_reduce(bb, {**MACHINE_COSTS, "mul": 5})
+    # 45 * x = 3 * (15 * x), and 15 * x is computed once
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 4)
+var2 = sub(var1, var0)
+var3 = lshift(var2, 2)
+var4 = sub(var3, var2)
+var5 = print(var4)"""
+
+
+@given(strategies.integers(-2**20, 2**20), strategies.integers())
+def test_hypothesis_lower_mul(factor, arg):
+    def build():
+        bb = Block()
+        var0 = bb.getarg(0)
+        bb.print(bb.mul(var0, factor))
+        return bb
+
+    expected = interpret(build(), arg)
+    for costs in (INTERPRETER_COSTS, MACHINE_COSTS, {**MACHINE_COSTS, "mul": 100}):
+        lowered = strength_reduce(build(), costs)
+        assert interpret(lowered, arg) == expected
+        assert all(op.name != "mul" for op in lowered) or costs["mul"] < 100
+
+
+def test_lower_mul_large_factor():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.print(bb.mul(var0, (1 << 63) - 1))
+
+    opt_bb = strength_reduce(bb, {**MACHINE_COSTS, "mul": 100})
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 63)
+var2 = sub(var1, var0)
+var3 = print(var2)"""
+
+
+# within the default deadline, however large the factor
+@given(strategies.integers(-2**64 + 1, 2**64 - 1), strategies.integers())
+def test_hypothesis_lower_mul_large_factors(factor, arg):
+    def build():
+        bb = Block()
+        var0 = bb.getarg(0)
+        bb.print(bb.mul(var0, factor))
+        return bb
+
+    expected = interpret(build(), arg)
+    for costs in (MACHINE_COSTS, {**MACHINE_COSTS, "mul": 100}):
+        assert interpret(strength_reduce(build(), costs), arg) == expected
+
+
 def test_remove_unused_allocation():
     bb = Block()
     var0 = bb.getarg(0)
@@ -271,3 +503,348 @@ optvar5 = store(optvar0, 1, optvar2)
     """
 
     assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+
+
+def test_dce_removes_unused_pure_ops():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)             # unused
+    var2 = bb.add(var0, 1)
+    var3 = bb.mul(var2, var2)       # unused
+    var4 = bb.load(var0, 0)         # unused
+    var5 = bb.lshift(var2, 1)
+    bb.print(var5)
+
+    opt_bb = dce(bb)
+    expected = """
+optvar0 = getarg(0)
+optvar1 = add(optvar0, 1)
+optvar2 = lshift(optvar1, 1)
+optvar3 = print(optvar2)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+    assert interpret(opt_bb, 4) == 10
+
+
+def test_dce_stores():
+    bb = Block()
+    var0 = bb.getarg(0)
+    local = bb.alloc()
+    bb.store(local, 0, 1)           # dead, never loaded afterwards
+    unused = bb.alloc()
+    bb.store(unused, 0, var0)       # dead, the object is unused
+    bb.store(local, 1, 2)           # dead, overwritten before the load
+    bb.store(local, 1, var0)        # kept, loaded below
+    var1 = bb.load(local, 1)
+    bb.store(local, 2, 3)           # dead, after the last use of local
+    escaping = bb.alloc()
+    bb.store(escaping, 0, var1)     # kept, the object escapes
+    bb.escape(escaping)
+    bb.store(var0, 0, 5)            # kept, var0 comes from outside
+
+    opt_bb = dce(bb)
+    expected = """
+optvar0 = getarg(0)
+optvar1 = alloc()
+optvar2 = store(optvar1, 1, optvar0)
+optvar3 = load(optvar1, 1)
+optvar4 = alloc()
+optvar5 = store(optvar4, 0, optvar3)
+optvar6 = escape(optvar4)
+optvar7 = store(optvar0, 0, 5)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+
+
+def test_dce_keeps_unknown_ops():
+    bb = Block()
+    var0 = bb.getarg(0)
+    bb.dummy(var0)
+    assert bb_to_str(dce(bb)) == bb_to_str(bb)
+
+
+def test_dce_after_pipeline():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 1)
+    obj = bb.alloc()
+    bb.store(obj, 0, var1)          # obj is virtual and never escapes
+    var2 = bb.add(var0, 2)
+    bb.print(var2)
+
+    opt_bb = dce(alloc_removal(constfold(bb)))
+    # alloc_removal removes the store, dce the add feeding it
+    expected = """
+optvar0 = getarg(0)
+optvar1 = add(optvar0, 2)
+optvar2 = print(optvar1)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+
+
+def _sequential(bb):
+    for opt in (constfold, cse, strength_reduce, alloc_removal,
+                optimize_load_store):
+        bb = opt(bb)
+    return bb
+
+
+def test_fused_sink_allocation():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.alloc()
+    var2 = bb.store(var1, 0, 123)
+    var3 = bb.store(var1, 1, 456)
+    var4 = bb.load(var1, 0)
+    var5 = bb.load(var1, 1)
+    var6 = bb.add(var4, var5)
+    var7 = bb.store(var1, 0, var6)
+    var8 = bb.store(var0, 1, var1)
+
+    opt_bb = fused_optimize(bb)
+
+    # unlike in test_sink_allocation, add(123, 456) is folded
+    expected = """
+optvar0 = getarg(0)
+optvar1 = alloc()
+optvar2 = store(optvar1, 0, 579)
+optvar3 = store(optvar1, 1, 456)
+optvar4 = store(optvar0, 1, optvar1)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+
+
+def test_fused_combines_all_passes():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(0)             # cse
+    var2 = bb.add(var0, var1)       # strength reduced to lshift(var0, 1)
+    var3 = bb.lshift(var0, 1)       # same as var2 now
+    var4 = bb.load(var0, 0)
+    var5 = bb.load(var1, 0)         # load/store forwarding
+    obj = bb.alloc()                # virtual
+    bb.store(obj, 0, var4)
+    var6 = bb.load(obj, 0)
+    var7 = bb.add(var6, var5)       # lshift(var4, 1) -> cse with itself
+    var8 = bb.mul(2, 3)             # constfold
+    var9 = bb.add(var3, var8)
+    var10 = bb.add(var7, var9)
+    var11 = bb.add(var2, var10)
+    bb.print(var11)
+
+    opt_bb = fused_optimize(bb)
+    expected = """
+optvar0 = getarg(0)
+optvar1 = lshift(optvar0, 1)
+optvar2 = load(optvar0, 0)
+optvar3 = lshift(optvar2, 1)
+optvar4 = add(optvar1, 6)
+optvar5 = add(optvar3, optvar4)
+optvar6 = add(optvar1, optvar5)
+optvar7 = print(optvar6)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+
+
+_recipe = strategies.lists(
+    strategies.tuples(
+        strategies.sampled_from(["add", "mul", "lshift", "const", "alloc",
+                                 "store", "load", "escape", "nest"]),
+        strategies.integers(0, 100),
+        strategies.integers(0, 100),
+    ),
+    max_size=40,
+)
+
+
+def _build(recipe):
+    """Build a valid Block out of a hypothesis recipe"""
+    bb = Block()
+    ints = [bb.getarg(0), bb.getarg(1)]
+    objs = []   # (alloc, fields holding ints)
+    for kind, i, j in recipe:
+        x, y = ints[i % len(ints)], ints[j % len(ints)]
+        if kind == "add":
+            ints.append(bb.add(x, y))
+        elif kind == "mul":
+            ints.append(bb.mul(x, y))
+        elif kind == "lshift":
+            ints.append(bb.lshift(x, j % 4))
+        elif kind == "const":
+            ints.append(bb.add(i, bb.add(j, 1)))
+        elif kind == "alloc":
+            objs.append((bb.alloc(), set()))
+        elif objs:
+            obj, fields = objs[i % len(objs)]
+            if kind == "store":
+                bb.store(obj, j % 3, y)
+                fields.add(j % 3)
+            elif kind == "load" and fields:
+                ints.append(bb.load(obj, sorted(fields)[j % len(fields)]))
+            elif kind == "escape":
+                bb.escape(obj)
+            elif kind == "nest":
+                other, _ = objs[j % len(objs)]
+                bb.store(other, 5, obj)
+    bb.print(ints[-1])
+    return bb
+
+
+def test_compact():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, var0)
+    var2 = bb.add(var0, var0)
+    var3 = bb.mul(var1, var2)
+    bb.print(var3)
+    expected = interpret(bb, 3)
+
+    opt_bb = cse(strength_reduce(bb))
+    before = bb_to_str(opt_bb)
+    assert var3.args[0] is var1     # still reaches the old adds
+    assert compact(opt_bb) is opt_bb
+    assert bb_to_str(opt_bb) == before
+    assert interpret(opt_bb, 3) == expected
+
+    ops = set(opt_bb)
+    for op in opt_bb:
+        assert op._forwarded is None
+        assert all(arg in ops or isinstance(arg, Constant) for arg in op.args)
+
+
+def test_compact_leaves_compact_blocks_alone():
+    bb = CompactBlock()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 0)
+    var2 = bb.mul(var1, 3)
+    bb.print(var2)
+    var1.make_equal_to(var0)
+    before = bb_to_str(bb)
+
+    assert compact(bb) is bb
+    assert bb_to_str(bb) == before
+    assert interpret(bb, 5) == 15
+
+
+_STREAM_PIPELINE = (constfold_stream, cse_stream, strength_reduce_stream,
+                    alloc_removal_stream, optimize_load_store_stream)
+
+
+def test_stream_while_recording():
+    log = []
+
+    def record():
+        bb = Block()
+        var0 = bb.getarg(0)
+        log.append("recorded getarg")
+        yield var0
+        obj = bb.alloc()
+        log.append("recorded alloc")
+        yield obj
+        yield bb.store(obj, 0, var0)
+        var1 = bb.load(obj, 0)
+        yield var1
+        var2 = bb.add(var1, var1)
+        yield var2
+        var3 = bb.add(2, 3)
+        yield var3
+        log.append("recorded add")
+        var4 = bb.add(var2, var3)
+        yield var4
+        yield bb.print(var4)
+
+    ops = stream(record(), *_STREAM_PIPELINE)
+    first = next(ops)
+    # the getarg came out before the rest was recorded
+    assert first.name == "getarg"
+    assert log == ["recorded getarg"]
+    opt_bb = Block([first, *ops])
+    assert log[-1] == "recorded add"
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 1)
+var2 = add(var1, 5)
+var3 = print(var2)"""
+
+
+def test_stream_holds_back_virtuals():
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, var0)
+    bb.escape(obj)
+
+    ops = alloc_removal_stream(bb)
+    assert next(ops) is var0
+    # the alloc and its store only come out when obj escapes
+    assert [op.name for op in ops] == ["alloc", "store", "escape"]
+
+
+@given(_recipe)
+def test_hypothesis_stream_matches_blocks(recipe):
+    expected = interpret(_build(recipe), 3, 5)
+    streamed = Block(stream(iter(_build(recipe)), *_STREAM_PIPELINE))
+    assert interpret(streamed, 3, 5) == expected
+    for opt, opt_stream in zip((constfold, cse, strength_reduce, alloc_removal,
+                                optimize_load_store), _STREAM_PIPELINE):
+        assert bb_to_str(opt(_build(recipe))) == \
+            bb_to_str(Block(opt_stream(_build(recipe))))
+
+
+@given(_recipe)
+def test_hypothesis_compact_preserves_result(recipe):
+    expected = interpret(_build(recipe), 3, 5)
+    assert interpret(compact(_sequential(_build(recipe))), 3, 5) == expected
+
+
+@given(_recipe)
+def test_hypothesis_fused_at_least_as_good(recipe):
+    sequential = _sequential(_build(recipe))
+    fused = fused_optimize(_build(recipe))
+    expected = interpret(_build(recipe), 3, 5)
+
+    assert interpret(sequential, 3, 5) == expected
+    assert interpret(fused, 3, 5) == expected
+    assert len(fused) <= len(sequential)
+
+
+@given(_recipe)
+def test_hypothesis_dce_preserves_result(recipe):
+    expected = interpret(_build(recipe), 3, 5)
+    assert interpret(dce(_build(recipe)), 3, 5) == expected
+    assert interpret(dce(_sequential(_build(recipe))), 3, 5) == expected
+
+
+@pytest.mark.parametrize("name, arg0, arg1, expected", [
+    ("add", 127, 1, -128),
+    ("sub", -128, 1, 127),
+    ("mul", 16, 16, 0),
+    ("lshift", 3, 100, 0),
+    ("lshift", 1, 7, -128),
+    ("bitand", 255, 7, 7),
+    ("add", 300, 0, 44),
+])
+def test_constfold_bit_width(name, arg0, arg1, expected):
+    bb = Block()
+    var0 = getattr(bb, name)(arg0, arg1)
+    bb.print(var0)
+
+    with bit_width_mode(8):
+        assert bb_to_str(constfold(bb)) == f"var0 = print({expected})"
+
+
+@given(strategies.sampled_from([8, 16, 32, 64]), strategies.integers(),
+       strategies.integers())
+def test_hypothesis_bit_width_optimize(width, factor, arg):
+    def build():
+        bb = Block()
+        var0 = bb.getarg(0)
+        var1 = bb.mul(var0, factor)
+        var2 = bb.add(var1, bb.lshift(factor, 3))
+        bb.print(var2)
+        return bb
+
+    with bit_width_mode(width):
+        expected = interpret(build(), arg)
+        for opt in (constfold, strength_reduce, fused_optimize):
+            assert interpret(opt(build()), arg) == expected
@@ -0,0 +1,84 @@
+import json
+
+from ir import Block, bb_to_str
+from passes import constfold, cse, strength_reduce
+from passes import alloc_removal, optimize_load_store
+from passmanager import PassManager
+
+
+def _example_block():
+    bb = Block()
+    var0 = bb.getarg(0)
+    obj = bb.alloc()
+    bb.store(obj, 0, 4)
+    bb.store(obj, 1, 5)
+    var1 = bb.load(obj, 0)
+    var2 = bb.load(obj, 1)
+    var3 = bb.add(var1, var2)      # foldable once the loads are
+    var4 = bb.add(var0, var3)
+    var5 = bb.add(var0, var3)
+    var6 = bb.add(var4, var5)
+    bb.print(var6)
+    return bb
+
+
+def test_pipeline_matches_manual_chain():
+    manual = _example_block()
+    for opt in (constfold, cse, strength_reduce):
+        manual = opt(manual)
+
+    pm = PassManager([constfold, cse, strength_reduce])
+    assert bb_to_str(pm.run(_example_block())) == bb_to_str(manual)
+    assert pm.stats.iterations == 1
+    assert [p.name for p in pm.stats.passes] == \
+        ["constfold", "cse", "strength_reduce"]
+
+
+def test_fixed_point():
+    pm = PassManager([constfold, cse, strength_reduce, alloc_removal],
+                     fixed_point=True)
+    opt_bb = pm.run(_example_block())
+
+    expected = """
+optvar0 = getarg(0)
+optvar1 = add(optvar0, 9)
+optvar2 = lshift(optvar1, 1)
+optvar3 = print(optvar2)
+    """
+    assert bb_to_str(opt_bb, "optvar").strip() == expected.strip()
+    # constfold folds the loads and add(4, 5) in the first round, the
+    # second one changes nothing
+    assert pm.stats.iterations == 2
+    assert pm.stats.passes[-1].ops_in == pm.stats.passes[-1].ops_out
+
+
+def test_stats():
+    pm = PassManager([constfold, cse, alloc_removal, optimize_load_store])
+    bb = _example_block()
+    pm.run(bb)
+
+    # constfold folds the two loads and their add
+    assert pm.stats.passes[0].ops_out == len(bb) - 3
+    cse_stats = pm.stats.passes[1]
+    assert cse_stats.ops_in == len(bb) - 3
+    assert cse_stats.ops_out == len(bb) - 4
+    assert cse_stats.rewrites == 1
+    assert cse_stats.seconds >= 0
+
+    data = json.loads(pm.stats.to_json())
+    assert data["iterations"] == 1
+    assert data["ops_in"] == len(bb)
+    assert data["ops_out"] == pm.stats.passes[-1].ops_out
+    assert [p["name"] for p in data["passes"]] == \
+        ["constfold", "cse", "alloc_removal", "optimize_load_store"]
+
+
+def test_nested_pass_manager():
+    inner = PassManager([constfold, cse])
+    outer = PassManager([inner, strength_reduce])
+    opt_bb = outer.run(_example_block())
+
+    assert len(outer.stats.passes) == 2
+    assert outer.stats.passes[0].rewrites == \
+        sum(p.rewrites for p in inner.stats.passes)
+    assert "lshift" in bb_to_str(opt_bb)
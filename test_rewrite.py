@@ -0,0 +1,197 @@
+from hypothesis import given, strategies
+import pytest
+
+from ir import Constant, Block, bb_to_str
+from interpret import interpret
+from rewrite import RuleSet, RuleError, peephole
+from rewrite import ALGEBRAIC_RULES, STRENGTH_REDUCTION_RULES
+
+
+def test_identity():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, 0)
+    var2 = bb.add(0, var1)
+    bb.print(var2)
+
+    rules = RuleSet(["add(x, 0) -> x"])
+    opt_bb = peephole(bb, rules)
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = print(var0)"""
+    # add is commutative, the rule matched both orders
+    assert rules.counts == {"add(x, 0) -> x": 2}
+
+
+def test_constant_result():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.bitand(var0, 0)
+    bb.print(var1)
+
+    opt_bb = peephole(bb, RuleSet(["bitand(x, 0) -> 0"]))
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = print(0)"""
+
+
+def test_same_variable():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, var1)
+    var3 = bb.add(var2, var2)
+    bb.print(var3)
+
+    opt_bb = peephole(bb, RuleSet(["add(x, x) -> lshift(x, 1)"]))
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = getarg(1)
+var2 = add(var0, var1)
+var3 = lshift(var2, 1)
+var4 = print(var3)"""
+
+
+def test_guard_and_expression():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 8)
+    var2 = bb.mul(3, var1)
+    var3 = bb.mul(1, var2)
+    bb.print(var3)
+
+    rules = RuleSet([
+        "mul(x, C) -> lshift(x, {C.bit_length() - 1}) if C > 1 and C & (C - 1) == 0",
+    ])
+    opt_bb = peephole(bb, rules)
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 3)
+var2 = mul(3, var1)
+var3 = mul(1, var2)
+var4 = print(var3)"""
+
+
+def test_replacement_is_rewritten():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 4)
+    bb.print(var1)
+
+    rules = RuleSet([
+        "mul(x, 4) -> add(add(x, x), add(x, x))",
+        "add(x, x) -> lshift(x, 1)",
+    ])
+    opt_bb = peephole(bb, rules)
+    assert bb_to_str(opt_bb) == """\
+var0 = getarg(0)
+var1 = lshift(var0, 1)
+var2 = lshift(var0, 1)
+var3 = add(var1, var2)
+var4 = print(var3)"""
+    # the two lshifts are different ops, so the outer add stays
+    assert rules.counts["add(x, x) -> lshift(x, 1)"] == 2
+
+
+def test_first_rule_wins():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 2)
+    bb.print(var1)
+
+    rules = RuleSet([
+        "mul(x, C) -> add(x, x) if C == 2",
+        "mul(x, 2) -> lshift(x, 1)",
+    ])
+    opt_bb = peephole(bb, rules)
+    assert [op.name for op in opt_bb] == ["getarg", "add", "print"]
+    assert rules.counts == {"mul(x, C) -> add(x, x) if C == 2": 1}
+
+
+def test_failing_expression_doesnt_fire():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.lshift(var0, 1)
+    bb.print(var1)
+
+    rules = RuleSet(["lshift(x, C) -> lshift(x, {1 >> -C})"])
+    opt_bb = peephole(bb, rules)
+    assert bb_to_str(opt_bb) == bb_to_str(bb)
+    assert not rules.counts
+
+
+@pytest.mark.parametrize("const", [0.0, -0.0, False, "0"])
+def test_literals_only_match_ints(const):
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(var0, const)
+    var2 = bb.mul(var1, const)
+    bb.print(var2)
+
+    opt_bb = peephole(bb, ALGEBRAIC_RULES)
+    assert bb_to_str(opt_bb) == bb_to_str(bb)
+
+
+def test_dispatch_scales():
+    # rules for other ops and other constants are never looked at
+    rules = RuleSet(f"add(x, {i}) -> x" for i in range(1, 1000))
+    rules.add("mul(x, C) -> x if C == 1")
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 1)
+    var2 = bb.add(var1, 500)
+    assert len(rules._candidates(var1, [var0, Constant(1)])) == 1
+    assert len(rules._candidates(var2, [var1, Constant(500)])) == 1
+    assert len(rules._candidates(var2, [var1, Constant(5000)])) == 0
+    assert len(rules._candidates(var2, [var1, var0])) == 0
+
+
+@pytest.mark.parametrize("text", [
+    "add(x, 0)",
+    "x -> x",
+    "add(x, 0) -> y",
+    "add(x, 0) -> {C}x",
+    "add(add(x, 0), 1) -> x",
+    "add(x, {1}) -> x",
+    "add(x, 0) -> x if",
+    "add(x 0) -> x",
+    "add(x, 0) -> {1 +}",
+    "add(x, C) -> x if D == 0",
+    "add(x, C) -> {D}",
+    "add(x, C) -> x if x == 0",
+    "add(x, C) -> {open(C)}",
+    "add(x, C) -> x if C and",
+])
+def test_invalid_rules(text):
+    with pytest.raises(RuleError):
+        RuleSet([text])
+
+
+_ops = strategies.lists(
+    strategies.tuples(
+        strategies.sampled_from(["add", "sub", "mul", "lshift", "bitand"]),
+        strategies.integers(0, 100),
+        strategies.sampled_from([-1, 0, 1, 2, 3, 4, 8, 64, None]),
+    ),
+    max_size=30,
+)
+
+
+@given(_ops, strategies.integers(-1000, 1000))
+def test_hypothesis_rules_preserve_result(ops, arg):
+    def build():
+        bb = Block()
+        values = [bb.getarg(0)]
+        for name, i, const in ops:
+            x = values[i % len(values)]
+            if name == "lshift":
+                y = abs(const) if const is not None else 1
+            else:
+                y = const if const is not None else values[-1]
+            values.append(getattr(bb, name)(x, y))
+        bb.print(values[-1])
+        return bb
+
+    expected = interpret(build(), arg)
+    for rules in (ALGEBRAIC_RULES, STRENGTH_REDUCTION_RULES):
+        assert interpret(peephole(build(), rules), arg) == expected
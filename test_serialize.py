@@ -0,0 +1,135 @@
+import pickle
+
+import pytest
+
+from ir import Block, Constant, Operation, bb_to_str
+from compact_block import CompactBlock
+from interpret import interpret
+from passes import constfold, cse, strength_reduce, alloc_removal
+from serialize import dumps, dump, loads, load, to_block
+from serialize import _HEADER, _FLOAT
+
+
+def _example():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.getarg(1)
+    var2 = bb.add(var0, -5)
+    var3 = bb.mul(var2, 2**80)
+    obj = bb.alloc()
+    bb.store(obj, 0, var3)
+    bb.store(obj, 1, var1)
+    var4 = bb.load(obj, 0)
+    bb.print(bb.add(var4, var1))
+    return bb
+
+
+def test_roundtrip():
+    bb = _example()
+    loaded = loads(dumps(bb))
+    assert isinstance(loaded, CompactBlock)
+    assert bb_to_str(loaded) == bb_to_str(bb)
+    assert interpret(loaded, 3, 4) == interpret(bb, 3, 4)
+    assert dumps(loaded) == dumps(bb)
+
+
+def test_forwarding_is_resolved():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.add(2, 3)
+    bb.print(bb.add(var0, var1))
+    opt_bb = constfold(bb)
+    assert bb_to_str(loads(dumps(opt_bb))) == bb_to_str(opt_bb)
+
+
+def test_other_constants():
+    bb = Block()
+    bb.dummy("text", "\udc80", 1.5, True, False, None)
+    loaded = loads(dumps(bb))
+    values = [arg.value for arg in loaded[0].args]
+    assert values == ["text", "\udc80", 1.5, True, False, None]
+    assert [type(value) for value in values] == \
+        [str, str, float, bool, bool, type(None)]
+
+
+@pytest.mark.parametrize("value", [(1, 2), 1j, b"bytes", Block()])
+def test_unsupported_constants(value):
+    bb = Block()
+    bb.dummy(value)
+    with pytest.raises(ValueError):
+        dumps(bb)
+
+
+def test_invalid_constant_kind():
+    bb = Block()
+    bb.dummy(1.5)
+    data = bytearray(dumps(bb))
+    # after the header, opnames, opcodes, argstarts and argslots, 8
+    # bytes each here, is the kind of 1.5
+    pos = _HEADER.size + 4 * 8
+    assert data[pos] == _FLOAT
+    data[pos] = 99
+    loaded = loads(bytes(data))
+    with pytest.raises(ValueError):
+        loaded[0].args
+
+
+def test_signed_zeros_survive():
+    bb = Block()
+    var0 = bb.getarg(0)
+    var1 = bb.mul(var0, 0.0)
+    var2 = bb.mul(var1, -0.0)
+    bb.print(var2)
+    assert bb_to_str(loads(dumps(bb))) == bb_to_str(bb)
+    assert bb_to_str(loads(dumps(CompactBlock.from_block(bb)))) == bb_to_str(bb)
+
+
+def test_load_is_lazy(tmp_path):
+    path = tmp_path / "block.bin"
+    with open(path, "wb") as f:
+        dump(_example(), f)
+    loaded = load(path)
+    assert isinstance(loaded.opcodes, memoryview)
+    assert loaded.constants._decoded == {}
+
+    var2 = loaded[2]
+    assert var2.arg(1) is Constant(-5)
+    assert list(loaded.constants._decoded) == [var2._block.argslots[3] ^ -1]
+    assert loaded[2].id == var2.id
+
+
+def test_append_to_loaded_block():
+    loaded = loads(dumps(_example()))
+    first_id = loaded[0].id
+    var = loaded.add(loaded[0], -5)
+    assert bb_to_str(loaded).splitlines()[-1] == f"var{len(loaded) - 1} = add(var0, -5)"
+    assert var.arg(1) is loaded[2].arg(1)
+    assert loaded[0].id == first_id
+
+
+@pytest.mark.parametrize("opt", [constfold, cse, strength_reduce, alloc_removal])
+def test_passes_on_loaded_block(opt):
+    bb = _example()
+    expected = interpret(bb, 3, 4)
+    assert interpret(opt(loads(dumps(bb))), 3, 4) == expected
+
+
+def test_smaller_than_pickle():
+    bb = _example()
+    for _ in range(100):
+        bb.add(bb[-2], 1)
+    assert len(dumps(bb)) < len(pickle.dumps(bb))
+
+
+@pytest.mark.parametrize("data", [b"", b"x" * 100, dumps(_example())[:-20]])
+def test_invalid_data(data):
+    with pytest.raises(ValueError):
+        loads(data)
+
+
+def test_to_block():
+    bb = _example()
+    decoded = to_block(loads(dumps(bb)))
+    assert type(decoded) is Block
+    assert all(type(op) is Operation for op in decoded)
+    assert bb_to_str(decoded) == bb_to_str(bb)